@@ -0,0 +1,130 @@
+import copy
+import queue
+import threading
+
+import torch
+
+# Values filling the masked center of the input, per channel
+MASK_VALUES = (2 * 117.0 / 255.0 - 1.0, 2 * 104.0 / 255.0 - 1.0, 2 * 123.0 / 255.0 - 1.0)
+
+
+# Copy a loader batch into a persistent buffer. uint8 batches (--uint8Loader) are cast to float
+# by the copy itself, on the device of the buffer, and scaled once per batch as ToTensor would.
+def copy_batch(batch, buffer):
+    buffer.resize_(batch.size()).copy_(batch)
+    if batch.dtype == torch.uint8:
+        buffer.div_(255)
+    return buffer
+
+
+# Load a batch in input_real and its copy with the masked center in input_cropped
+def load_masked_batch(batch, input_real, input_cropped, opt):
+    copy_batch(batch, input_real)
+    input_cropped.resize_(input_real.size()).copy_(input_real)
+    start = int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred)
+    end = int(opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)
+    for c in range(min(opt.nc, len(MASK_VALUES))):
+        input_cropped[:, c, start:end, start:end] = MASK_VALUES[c]
+    return input_real, input_cropped
+
+
+# Slices of the masked center, of the real center and of the center with margin, computed once
+class BatchGeometry(object):
+    def __init__(self, opt):
+        def centered(size):
+            return slice(int(opt.imageSize / 2 - size / 2), int(opt.imageSize / 2 + size / 2))
+        self.mask = slice(int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred),
+                          int(opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred))
+        self.center = centered(opt.patchSize)
+        self.margin = centered(opt.patch_with_margin_size)
+        self.mask_values = MASK_VALUES[:min(opt.nc, len(MASK_VALUES))]
+
+
+# The tensors a training step needs, built from a loader batch on the CPU
+class AssembledBatch(object):
+    def __init__(self, batch, geometry, pin_memory=False):
+        real = batch.float()
+        if batch.dtype == torch.uint8:
+            real.div_(255)
+        cropped = real.clone()
+        for c, value in enumerate(geometry.mask_values):
+            cropped[:, c, geometry.mask, geometry.mask] = value
+        self.tensors = (real, cropped,
+                        real[:, :, geometry.center, geometry.center].contiguous(),
+                        real[:, :, geometry.margin, geometry.margin].contiguous())
+        if pin_memory:
+            self.tensors = tuple(t.pin_memory() for t in self.tensors)
+
+    def size(self, dim):
+        return self.tensors[0].size(dim)
+
+    # Split in n micro-batches of (almost) equal size, views of this batch
+    def split(self, n):
+        parts = []
+        for tensors in zip(*[t.chunk(n) for t in self.tensors]):
+            part = copy.copy(self)
+            part.tensors = tensors
+            parts.append(part)
+        return parts
+
+    # Copy into the persistent buffers (input_real, input_cropped, real_center, real_center_plus_margin)
+    def load(self, *buffers):
+        for tensor, buffer in zip(self.tensors, buffers):
+            buffer.resize_(tensor.size()).copy_(tensor, non_blocking=tensor.is_pinned())
+        return buffers
+
+
+# Iterate a DataLoader yielding an AssembledBatch per batch. With depth > 0 batches are assembled ahead
+# by a background thread, so the slicing and masking overlap with the forward and backward passes
+# of the main thread (tensor operations release the GIL). With depth = 0 they are assembled inline.
+class BatchPrefetcher(object):
+    def __init__(self, loader, opt, depth=2):
+        self.loader = loader
+        self.geometry = BatchGeometry(opt)
+        self.depth = depth
+        self.pin_memory = bool(opt.cuda) and depth > 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for data in self.loader:
+                yield AssembledBatch(data[0], self.geometry)
+            return
+
+        batches = queue.Queue(self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for data in self.loader:
+                    if not put(AssembledBatch(data[0], self.geometry, self.pin_memory)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,170 @@
+import copy
+import hashlib
+import os
+import pickle
+import queue
+import random
+import tempfile
+import threading
+
+import torch
+
+# Suffix of the previous version of a checkpoint file, kept until the next generation is committed
+PREVIOUS_SUFFIX = '.prev'
+
+# Permissions of the files written, those open() would give them. The umask is read once at import,
+# os.umask() cannot be read without setting it and the writer thread would race with the main thread.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+
+# Read a checkpoint once, on the CPU
+def load(path):
+    return torch.load(path, map_location=lambda storage, location: storage)
+
+
+# Copy of a state (nested dicts, lists and tuples of tensors and python values) on the CPU, detached
+# from the tensors that training keeps updating in place
+def snapshot(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return copy.deepcopy(state)
+
+
+# States of the random number generators used in training
+def rng_state():
+    state = {'python': random.getstate(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# SHA-1 of the content of a file
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Write an object with torch.save, or pickle with use_pickle, to a temporary file in the directory
+# of path, then rename it to path. Readers and crashes only ever see a complete file. With
+# keep_previous the file replaced stays at path + PREVIOUS_SUFFIX. Returns the digest of the file.
+def atomic_save(state, path, use_pickle=False, keep_previous=False):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if use_pickle:
+                pickle.dump(state, f)
+            else:
+                torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp, FILE_MODE)
+        digest = file_digest(tmp)
+        if keep_previous and os.path.exists(path):
+            previous = path + PREVIOUS_SUFFIX
+            if os.path.exists(previous):
+                os.remove(previous)
+            os.link(path, previous)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return digest
+
+
+# Load the manifest of a checkpoint generation written by CheckpointWriter.commit() and make the files
+# it lists those of the generation: a file already replaced by a later save that was interrupted before
+# its commit is rolled back to its previous version. Raises a RuntimeError when a file is of another
+# generation and cannot be rolled back.
+def load_generation(path):
+    manifest = load(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    for name, digest in sorted(manifest.get('files', {}).items()):
+        target = os.path.join(directory, name)
+        if os.path.exists(target) and file_digest(target) == digest:
+            continue
+        previous = target + PREVIOUS_SUFFIX
+        if not (os.path.exists(previous) and file_digest(previous) == digest):
+            raise RuntimeError("%s is not the file saved with %s, the checkpoint cannot be resumed" % (target, path))
+        print("Rolling back", target, "to the version saved with", path)
+        os.replace(previous, target)
+    return manifest
+
+
+# Writes checkpoints from a background thread. save() snapshots the state on the CPU, which is all
+# the training loop waits for, and queues the write. At most `depth` writes are pending, further
+# saves wait for them; the default holds the four files of a training checkpoint (netG, netD,
+# measures and training state). An error of a write is raised by the next call.
+# The files saved since the last commit() form a generation, whose manifest is written by the next
+# commit() once they are all written. load_generation() resumes from a consistent set of files.
+class CheckpointWriter(object):
+    def __init__(self, depth=4):
+        self.writes = queue.Queue(depth)
+        self.error = None
+        self.digests = {}
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.writes.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    state, path, use_pickle, manifest = item
+                    if manifest:
+                        directory = os.path.dirname(os.path.abspath(path))
+                        files = dict((os.path.relpath(p, directory), d) for p, d in self.digests.items())
+                        atomic_save(dict(state, files=files), path)
+                        self.digests = {}
+                    else:
+                        self.digests[os.path.abspath(path)] = atomic_save(state, path, use_pickle,
+                                                                          keep_previous=True)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.writes.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, path, use_pickle=False):
+        self._raise()
+        self.writes.put((snapshot(state), path, use_pickle, False))
+
+    # Queue the manifest of the files saved since the last commit, a dict state with their digests
+    # added under 'files'. It is not written when one of the files failed.
+    def commit(self, state, path):
+        self._raise()
+        self.writes.put((snapshot(state), path, False, True))
+
+    # Wait for the pending writes
+    def wait(self):
+        self.writes.join()
+        self._raise()
+
+    def close(self):
+        self.writes.put(None)
+        self.thread.join()
+        self._raise()
@@ -6,93 +6,122 @@ Requires:
 - './images' 		contains all the subdirectories with lungs dataset images
 - 'testdata.csv'	contains list of image names, one per row, with one header line at the beginning
 - 'traindata.csv'	contains list of image names, one per row, with one header line at the beginning
+
+Images are materialized with a pool of processes, either copied or linked ('--link hardlink' or
+'--link symlink' avoid duplicating the dataset on disk). Files already present in the output are
+skipped, so rebuilding after a change in the csv files only touches the difference.
+A 'manifest.txt' with the relative path of every image is written in the root of each split, the
+training and test loaders (datasets.IndexedImageFolder) index the split from it instead of walking it.
 '''
 
+import argparse
 import os.path
+from multiprocessing import Pool
 from os import listdir
-from os.path import isfile, join
-from shutil import copyfile
 from shutil import copy2
 
-mypath = "./images"
-output_train = "./dataset_lungs/train/train"
-output_test = "./dataset_lungs/test/test"
-
-try:
-    os.makedirs(output_train)
-    os.makedirs(output_test)
-except OSError:
-    pass
-
-print("Directories found:")
-print(listdir(mypath))
+parser = argparse.ArgumentParser()
+parser.add_argument('--images', default='./images', help='directory with all the ChestX-ray14 subdirectories')
+parser.add_argument('--output', default='./dataset_lungs', help='root of the generated dataset')
+parser.add_argument('--link', default='copy', choices=['copy', 'hardlink', 'symlink'],
+                    help='how images are materialized in the dataset')
+parser.add_argument('--workers', type=int, default=8, help='number of processes materializing images')
+parser.add_argument('--prune', action='store_true', help='remove images in the output which are not listed anymore')
 
-images_list = []
 
-# Find all images in every subdirectory
-def recursive_image_finder(path):
-    file_list = listdir(path)
-    for f in file_list:
+# Find all images in every subdirectory, as a dictionary from file name to path
+def recursive_image_finder(path, images):
+    for f in listdir(path):
         if ".png" not in f:
-            recursive_image_finder(path+"/"+f)
+            recursive_image_finder(path + "/" + f, images)
         else:
-            images_list.append((path+"/"+f,f))
-
-
-
-# Find all images in ./images
-recursive_image_finder(mypath)
-print("\nTotal images file found:", len(images_list))
-            
-# Parse file with no_findings images list
-with open("testdata.csv","r") as f:
-    no_findings_test = f.readlines()
-with open("traindata.csv","r") as f:
-    no_findings_train = f.readlines()
-    
-#Remove headers
-del no_findings_test[0]
-del no_findings_train[0]
-    
-for k in range(len(no_findings_test)):
-    no_findings_test[k] = no_findings_test[k].replace("\n","")
-for k in range(len(no_findings_train)):
-    no_findings_train[k] = no_findings_train[k].replace("\n","")
-    
-print("Images with no findings in test: ", len(no_findings_test)," and in train: ", len(no_findings_train))
-
-# Select images with no findings
-healthy_images_test = []
-healthy_images_train = []
-
-print("\nStarting to parse images")
-for i, h in enumerate(images_list):
-    pth, img = h
-    if img in no_findings_test:
-        healthy_images_test.append((pth,img))
-    if img in no_findings_train:
-        healthy_images_train.append((pth,img))
-    if(i % int(len(images_list)/10) == 0):
-        print(int(i/len(images_list)*100), "%...")
-        
-print("Images saved with no findings in test:", len(healthy_images_test), " and in train: ", len(healthy_images_train))
-
-
-print("\nGenerating trainset (takes longer)...")
-
-for i, h in enumerate(healthy_images_train):
-    pth, img = h
-    copy2(pth, output_train)
-    
-    if(i % int(len(healthy_images_train)/10) == 0):
-        print(int(i/len(healthy_images_train)*100), "%...")
-   
-print("\nGenerating testset (takes longer)...")
-
-for i, h in enumerate(healthy_images_test):
-    pth, img = h
-    copy2(pth, output_test)
-    
-    if(i % int(len(healthy_images_test)/10) == 0):
-        print(int(i/len(healthy_images_test)*100), "%...")
-        
\ No newline at end of file
+            images[f] = path + "/" + f
+    return images
+
+
+# Parse file with no_findings images list, removing the header
+def read_image_names(csv_file):
+    with open(csv_file, "r") as f:
+        lines = f.readlines()
+    del lines[0]
+    return set(line.replace("\n", "") for line in lines)
+
+
+def materialize(job):
+    pth, dst, link = job
+    if os.path.lexists(dst):
+        return 0
+    if link == "symlink":
+        os.symlink(os.path.abspath(pth), dst)
+    elif link == "hardlink":
+        try:
+            os.link(pth, dst)
+        except OSError:  # e.g. output on a different filesystem
+            copy2(pth, dst)
+    else:
+        copy2(pth, dst)
+    return 1
+
+
+def generate_split(name, selected, images, split_root, class_dir, pool, opt):
+    output = os.path.join(split_root, class_dir)
+    try:
+        os.makedirs(output)
+    except OSError:
+        pass
+
+    if opt.prune:
+        pruned = 0
+        for f in listdir(output):
+            if f not in selected:
+                os.remove(os.path.join(output, f))
+                pruned += 1
+        print("Removed", pruned, "images not listed anymore in", name)
+
+    jobs = [(images[img], os.path.join(output, img), opt.link) for img in sorted(selected)]
+    step = max(1, len(jobs) // 10)
+    created = 0
+    for i, n in enumerate(pool.imap_unordered(materialize, jobs, chunksize=64)):
+        created += n
+        if i % step == 0:
+            print(int(i / len(jobs) * 100), "%...")
+    print("Materialized", created, "new images,", len(jobs) - created, "already present")
+
+    # Manifest of the split, so that loaders do not need to scan the directory tree. Written after the
+    # images and replaced atomically, loaders only use it while it is newer than the class directory.
+    tmp = os.path.join(split_root, "manifest.txt.tmp")
+    with open(tmp, "w") as f:
+        for img in sorted(selected):
+            f.write(class_dir + "/" + img + "\n")
+    os.replace(tmp, os.path.join(split_root, "manifest.txt"))
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+
+    print("Directories found:")
+    print(listdir(opt.images))
+
+    # Find all images in ./images
+    images = recursive_image_finder(opt.images, {})
+    print("\nTotal images file found:", len(images))
+
+    no_findings_test = read_image_names("testdata.csv")
+    no_findings_train = read_image_names("traindata.csv")
+    print("Images with no findings in test: ", len(no_findings_test), " and in train: ", len(no_findings_train))
+
+    # Select images with no findings
+    healthy_images_test = no_findings_test.intersection(images)
+    healthy_images_train = no_findings_train.intersection(images)
+    print("Images saved with no findings in test:", len(healthy_images_test), " and in train: ", len(healthy_images_train))
+
+    pool = Pool(opt.workers)
+
+    print("\nGenerating trainset...")
+    generate_split("train", healthy_images_train, images, os.path.join(opt.output, "train"), "train", pool, opt)
+
+    print("\nGenerating testset...")
+    generate_split("test", healthy_images_test, images, os.path.join(opt.output, "test"), "test", pool, opt)
+
+    pool.close()
+    pool.join()
@@ -1,98 +1,178 @@
-import os.path
-from os import listdir
-from os.path import isfile, join
-from shutil import copyfile
-from shutil import copy2
-import random
-from PIL import Image
-import numpy as np
+'''
+Generate random 128x128 crops inside the lungs bounding boxes of the train images
 
-random.seed(1234)
+Requires:
+- './dataset_lungs/train/train'	the train images generated by generate_dataset.py
+- 'traindata_bb.csv'			bounding boxes of left and right lung for every train image
 
-mypath = "./dataset_lungs/train/"
-output_train = "./dataset_lungs/train_randomPatches/train_randomPatches/"
+Every source image is decoded once as uint8 by a pool of processes. Crops are not written as
+separate PNG files but appended to a few large .npy shards, described by an 'index.json' which
+datasets.PackedImageDataset reads directly (see train.py --packedPatches).
+Every shard is committed atomically together with a small '.json' sidecar: if the script is
+interrupted, running it again skips the completed shards. Sidecars record the parameters and source
+images of their shard, a rerun with other ones stops instead of mixing both outputs. Crops are sampled
+with a random generator seeded per image, so the output does not depend on the number of workers or
+on resumes.
+'''
 
-try:
-    os.makedirs(output_train)
-except OSError:
-    pass
+import argparse
+import hashlib
+import json
+import os
+import random
+from multiprocessing import Pool
 
-print("Directories found:")
-print(listdir(mypath))
+import numpy as np
+from PIL import Image
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--images', default='./dataset_lungs/train/', help='ImageFolder root of the train images')
+parser.add_argument('--bbox', default='traindata_bb.csv', help='csv with the lungs bounding boxes')
+parser.add_argument('--output', default='./dataset_lungs/train_randomPatches_packed/', help='output directory of the shards')
+parser.add_argument('--crops', type=int, default=20, help='number of random crops per image')
+parser.add_argument('--images_per_shard', type=int, default=1000, help='source images whose crops go in the same shard')
+parser.add_argument('--workers', type=int, default=8, help='number of processes decoding and cropping images')
+parser.add_argument('--seed', type=int, default=1234)
 
-images_list = []
+opt = None
 
-def load_image( infilename ) :
-    img = Image.open( infilename )
+
+def load_image(infilename):
+    img = Image.open(infilename)
     img.load()
-    data = np.asarray( img, dtype="int32" )
+    data = np.asarray(img, dtype="uint8")
+    if len(data.shape) > 2:
+        data = data[:, :, 0]
     return data
 
-def save_image( npdata, outfilename ) :
-    img = Image.fromarray( np.asarray( np.clip(npdata,0,255), dtype="uint8"), "L" )
-    img.save( outfilename )
-
-with open("traindata_bb.csv","r") as f:
-    coordinates = f.readlines()
-    
-del coordinates[0]
-
-
-crop = np.zeros((128,128))
-for index, c in enumerate(coordinates):
-    if index % 1000 == 0:
-        print(index, "/", len(coordinates))
-    c.replace("\n","")
-#     print(c)
-    
-    _, filename,llx0,lly0,llx1,lly1,rlx0,rly0,rlx1,rly1 = c.split(",")
-    inname = mypath + "train/" + filename + ".png"
-    image = load_image(inname)
-    
-    for k in range(20):
-        outname = output_train + filename + "_" + str(k) + ".png"
-        coin = random.randint(0, 1)
+
+# Random crops of a single image, following the lung selected by a coin flip
+def crop_image(job):
+    index, c = job
+    rng = random.Random(opt.seed * 1000003 + index)
+    _, filename, llx0, lly0, llx1, lly1, rlx0, rly0, rlx1, rly1 = c.split(",")
+    image = load_image(opt.images + "train/" + filename + ".png")
+
+    crops = []
+    names = []
+    for k in range(opt.crops):
+        coin = rng.randint(0, 1)
         if not coin:
             x0, x1, y0, y1 = int(llx0), int(llx1), int(lly0), int(lly1)
         else:
             x0, x1, y0, y1 = int(rlx0), int(rlx1), int(rly0), int(rly1)
 
-#         print(inname)
-#         print(coin, x0, x1, y0, y1)
-        if (x1-x0 > 128):
-            X = random.randint(x0+64, x1-64)
+        if (x1 - x0 > 128):
+            X = rng.randint(x0 + 64, x1 - 64)
         else:
-            x0 = max(64,x0)
-            x1 = min(1024-64,x1)
+            x0 = max(64, x0)
+            x1 = min(1024 - 64, x1)
             if x0 > x1:
-#                 print("skip", index)
                 continue
-            X = random.randint(x0, x1)
-#             print(k, filename)
-            
-        if (y1-y0) >128:
-            Y = random.randint(y0+64, y1-64)
+            X = rng.randint(x0, x1)
+
+        if (y1 - y0) > 128:
+            Y = rng.randint(y0 + 64, y1 - 64)
         else:
-            y0 = max(64,y0)
-            y1 = min(1024-64,y1)
+            y0 = max(64, y0)
+            y1 = min(1024 - 64, y1)
             if y0 > y1:
-#                 print("skip", index)
                 continue
-            Y = random.randint(y0, y1)
-#             print(k, filename)
-#         print(X, Y)
-        s = image[X-64:X+64, Y-64:Y+64].shape
-        if (s[0], s[1]) != (128,128):
+            Y = rng.randint(y0, y1)
+
+        crop = image[X - 64:X + 64, Y - 64:Y + 64]
+        if crop.shape != (128, 128):
             print("SIZE ERROR", crop.shape, c, X, Y)
             continue
-            
-        if len(image.shape) > 2:
-            crop[:,:] = image[X-64:X+64, Y-64:Y+64, 0]
-        else:
-            crop[:,:] = image[X-64:X+64, Y-64:Y+64]
+        crops.append(crop)
+        names.append("train_randomPatches/" + filename + "_" + str(k) + ".png")
+
+    return crops, names
+
+
+def init_worker(options):
+    global opt
+    opt = options
+
+
+# Write a file of the output atomically: write(f) fills a temporary file, which is synced to disk and
+# renamed to name
+def commit(name, write, mode="w"):
+    tmp = os.path.join(opt.output, name + ".tmp")
+    with open(tmp, mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(opt.output, name))
+
+
+# Parameters a shard depends on, with a hash of the csv rows of its source images
+def shard_params(jobs):
+    rows = hashlib.sha1("".join(c for _, c in jobs).encode("utf-8")).hexdigest()
+    return {"images": opt.images, "crops": opt.crops, "images_per_shard": opt.images_per_shard,
+            "seed": opt.seed, "sources": rows}
+
+
+# Crop all the images of a shard and commit it, the sidecar json marks the shard as done
+def generate_shard(pool, shard, jobs):
+    shard_file = "images_%05d.npy" % shard
+    crops = []
+    names = []
+    for image_crops, image_names in pool.imap(crop_image, jobs, chunksize=4):
+        crops.extend(image_crops)
+        names.extend(image_names)
+
+    commit(shard_file, lambda f: np.save(f, np.stack(crops) if crops else np.zeros((0, 128, 128), dtype=np.uint8)),
+           "wb")
+
+    info = {"file": shard_file, "count": len(names), "names": names, "params": shard_params(jobs)}
+    commit("images_%05d.json" % shard, lambda f: json.dump(info, f))
+    return info
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+
+    try:
+        os.makedirs(opt.output)
+    except OSError:
+        pass
+
+    with open(opt.bbox, "r") as f:
+        coordinates = f.readlines()
+    del coordinates[0]
+
+    n_shards = (len(coordinates) + opt.images_per_shard - 1) // opt.images_per_shard
+    pool = Pool(opt.workers, initializer=init_worker, initargs=(opt,))
+
+    shards = []
+    for shard in range(n_shards):
+        start = shard * opt.images_per_shard
+        jobs = list(enumerate(coordinates[start:start + opt.images_per_shard], start))
+
+        sidecar = os.path.join(opt.output, "images_%05d.json" % shard)
+        if os.path.exists(sidecar):
+            with open(sidecar, "r") as f:
+                info = json.load(f)
+            if info.get("params") != shard_params(jobs):
+                pool.terminate()
+                raise SystemExit("Shard %d in %s was generated with other parameters or source images: %s, "
+                                 "remove the output directory or choose another --output"
+                                 % (shard, opt.output, info.get("params")))
+            shards.append(info)
+            print("Shard", shard, "already generated, skipping")
+            continue
+
+        shards.append(generate_shard(pool, shard, jobs))
+        print(min(start + opt.images_per_shard, len(coordinates)), "/", len(coordinates), "images,",
+              sum(s["count"] for s in shards), "crops")
+
+    pool.close()
+    pool.join()
+
+    commit("names.txt", lambda f: f.writelines(name + "\n" for s in shards for name in s["names"]))
 
-#         print(crop.shape)
-#         save_image(image[:,0:20], outname)
-#         save_image(image, outname)
-        save_image(crop, outname)
-#     input()
\ No newline at end of file
+    index = {"height": 128, "width": 128, "count": sum(s["count"] for s in shards),
+             "shards": [{"file": s["file"], "count": s["count"]} for s in shards], "names": "names.txt"}
+    commit("index.json", lambda f: json.dump(index, f, indent=1))
+    print("Generated", index["count"], "crops in", len(shards), "shards")
@@ -0,0 +1,100 @@
+'''
+Pack a folder of equally sized images into a memory-mapped uint8 store
+
+Every image is decoded once, converted to grayscale and written into a contiguous
+N x H x W uint8 array (one or more .npy shards), together with a small 'index.json'
+and the list of source file names. The store is read by datasets.PackedImageDataset.
+
+Requires:
+- '--input'		ImageFolder style directory, e.g. './dataset_lungs/train_randomPatches'
+
+Example:
+python pack_dataset.py --input ./dataset_lungs/train_randomPatches --output ./dataset_lungs/train_randomPatches_packed
+'''
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', default='./dataset_lungs/train_randomPatches', help='ImageFolder directory to pack')
+parser.add_argument('--output', default='./dataset_lungs/train_randomPatches_packed', help='output directory of the packed store')
+parser.add_argument('--workers', type=int, default=4, help='number of decoding processes')
+parser.add_argument('--shard_size', type=int, default=0, help='images per shard file, 0 packs everything in a single file')
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+# Find all images following the same ordering used by torchvision ImageFolder
+def find_images(root):
+    images = []
+    classes = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    for target in classes:
+        for path, _, fnames in sorted(os.walk(os.path.join(root, target), followlinks=True)):
+            for fname in sorted(fnames):
+                if fname.lower().endswith(IMG_EXTENSIONS):
+                    images.append(os.path.join(path, fname))
+    return images
+
+
+def load_image(infilename):
+    img = Image.open(infilename)
+    img = img.convert('L')
+    return np.asarray(img, dtype="uint8")
+
+
+# Write the index describing shards, image size and the names file
+def write_index(output, shards, height, width, names_file):
+    index = {"height": height, "width": width, "count": sum(s["count"] for s in shards),
+             "shards": shards, "names": names_file}
+    tmp = os.path.join(output, "index.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(output, "index.json"))
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+
+    try:
+        os.makedirs(opt.output)
+    except OSError:
+        pass
+
+    images_list = find_images(opt.input)
+    print("Total images file found:", len(images_list))
+    if not images_list:
+        raise RuntimeError("No images found in " + opt.input)
+
+    height, width = load_image(images_list[0]).shape
+    shard_size = opt.shard_size if opt.shard_size > 0 else len(images_list)
+
+    with open(os.path.join(opt.output, "names.txt"), "w") as f:
+        for pth in images_list:
+            f.write(os.path.relpath(pth, opt.input) + "\n")
+
+    shards = []
+    pool = Pool(opt.workers)
+    for start in range(0, len(images_list), shard_size):
+        chunk = images_list[start:start + shard_size]
+        shard_file = "images_%05d.npy" % len(shards)
+        packed = np.lib.format.open_memmap(os.path.join(opt.output, shard_file), mode="w+", dtype=np.uint8,
+                                           shape=(len(chunk), height, width))
+        for k, image in enumerate(pool.imap(load_image, chunk, chunksize=256)):
+            if image.shape != (height, width):
+                raise ValueError("Image %s has size %s, expected %s" % (chunk[k], image.shape, (height, width)))
+            packed[k] = image
+            if (start + k) % 10000 == 0:
+                print(start + k, "/", len(images_list))
+        packed.flush()
+        del packed
+        shards.append({"file": shard_file, "count": len(chunk)})
+    pool.close()
+    pool.join()
+
+    write_index(opt.output, shards, height, width, "names.txt")
+    print("Packed", len(images_list), "images of size", height, "x", width, "in", opt.output)
@@ -0,0 +1,472 @@
+import hashlib
+import json
+import os
+import pickle
+import random
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.datasets as dset
+import torchvision.transforms as transforms
+from PIL import Image
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
+
+
+# Load the index of a packed uint8 store written by dataset_scripts/pack_dataset.py
+def load_packed_index(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, "index.json")
+    with open(path, "r") as f:
+        index = json.load(f)
+    index["root"] = os.path.dirname(path)
+    return index
+
+
+# Temporary file next to path, private to this process so that concurrent writers do not clobber it
+def _tmp_path(path):
+    return "%s.%d.tmp" % (path, os.getpid())
+
+
+# Atomically write the index of a packed store
+def write_packed_index(directory, index):
+    tmp = _tmp_path(os.path.join(directory, "index.json"))
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(directory, "index.json"))
+
+
+# uint8 (C, H, W) image tensor to float in [0, 1], as ToTensor converts PIL images
+def to_float_tensor(image):
+    return image.float().div(255)
+
+
+# Dataset over a packed N x H x W uint8 store. Shards are memory-mapped and every item is a
+# zero-copy slice of the map, so no PNG is opened or decoded during training.
+# Items are (image, 0) like ImageFolder; by default the image is converted as ToTensor would,
+# with transform=None the uint8 slice itself is returned.
+class PackedImageDataset(torch.utils.data.Dataset):
+    def __init__(self, path, transform=to_float_tensor):
+        self.index = load_packed_index(path)
+        self.transform = transform
+        self.offsets = np.cumsum([0] + [s["count"] for s in self.index["shards"]])
+        self.shards = None  # Opened lazily, so that every DataLoader worker maps the files itself
+
+    def _open(self):
+        # Copy-on-write maps are writable views for torch.from_numpy, pages are never written back
+        self.shards = [np.load(os.path.join(self.index["root"], s["file"]), mmap_mode="c")
+                       for s in self.index["shards"]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    # H x W uint8 view of an image, directly on the memory map
+    def raw(self, idx):
+        if self.shards is None:
+            self._open()
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return self.shards[shard][idx - self.offsets[shard]]
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(self.raw(idx)).unsqueeze(0)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, 0
+
+    # Relative paths of the packed source images, in dataset order
+    def names(self):
+        with open(os.path.join(self.index["root"], self.index["names"]), "r") as f:
+            return [line.rstrip("\n") for line in f]
+
+
+# Parse the lungs bounding boxes csv used by dataset_scripts/generate_randomCrop.py. Returns the image
+# names and an int32 array with a row (llx0, lly0, llx1, lly1, rlx0, rly0, rlx1, rly1) per image.
+# As in generate_randomCrop.py, x coordinates index the rows of the image array.
+def load_lung_boxes(csv_file):
+    names = []
+    boxes = []
+    with open(csv_file, "r") as f:
+        next(f)  # Header
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) < 10:
+                continue
+            names.append(fields[1])
+            boxes.append([int(v) for v in fields[2:10]])
+    return names, np.array(boxes, dtype=np.int32).reshape(-1, 8)
+
+
+# Range of the crop centers along one axis with the rules of generate_randomCrop.py, None if the crop does not fit
+def _center_range(c0, c1, half, size):
+    if c1 - c0 > 2 * half:
+        return c0 + half, c1 - half
+    c0 = max(half, c0)
+    c1 = min(size - half, c1)
+    if c0 > c1:
+        return None
+    return c0, c1
+
+
+# Random crop center along one axis, None if the crop does not fit
+def _sample_center(c0, c1, half, size):
+    bounds = _center_range(c0, c1, half, size)
+    return None if bounds is None else random.randint(*bounds)
+
+
+# Whether a crop fits in a lung box (x0, x1, y0, y1) of an image of the given shape
+def _box_fits(box, half, shape):
+    x0, x1, y0, y1 = box
+    return _center_range(x0, x1, half, shape[0]) is not None and _center_range(y0, y1, half, shape[1]) is not None
+
+
+# Decode an image file as a 2D uint8 array, the first channel of color images
+def _load_gray(path):
+    image = np.asarray(Image.open(path), dtype=np.uint8)
+    if len(image.shape) > 2:
+        image = image[:, :, 0]
+    return image
+
+
+# Training patches sampled on the fly inside the lungs bounding boxes, instead of the crops
+# frozen on disk by generate_randomCrop.py. Every epoch draws 'samples_per_image' fresh crops per
+# image: a coin flip selects the left or right lung, and the crop center keeps a margin of half
+# the patch size from the box borders. As in generate_randomCrop.py no crop is taken outside the
+# lungs: if the selected lung cannot hold a crop the other one is used, and images where neither can
+# are skipped. Images are read from a packed store of the full images (dataset_scripts/pack_dataset.py,
+# memory-mapped). A folder of '<images>/<name>.png' files is packed once in cache_dir, without
+# cache_dir every crop decodes its whole image.
+class LungPatchDataset(torch.utils.data.Dataset):
+    def __init__(self, bbox_csv, images, patch_size=128, samples_per_image=20, transform=to_float_tensor,
+                 cache_dir=None):
+        names, self.boxes = load_lung_boxes(bbox_csv)
+        self.patch_size = patch_size
+        self.samples_per_image = samples_per_image
+        self.transform = transform
+
+        packed_index = images if images.endswith(".json") else os.path.join(images, "index.json")
+        if not os.path.exists(packed_index) and cache_dir is not None:
+            paths = [os.path.join(images, n + ".png") for n in names]
+            packed_index = build_image_cache([p for p in paths if os.path.exists(p)], cache_dir, images)
+        if os.path.exists(packed_index):
+            self.packed = PackedImageDataset(packed_index, transform=None)
+            positions = dict((os.path.splitext(os.path.basename(n))[0], k) for k, n in enumerate(self.packed.names()))
+            keep = [k for k, n in enumerate(names) if n in positions]
+            if len(keep) < len(names):
+                print("LungPatchDataset:", len(names) - len(keep), "images of", bbox_csv, "are not in", images)
+            self.boxes = self.boxes[keep]
+            self.sources = np.array([positions[names[k]] for k in keep], dtype=np.int64)
+
+            shape = (self.packed.index["height"], self.packed.index["width"])
+            fits = [k for k in range(len(self.boxes))
+                    if any(_box_fits(lung, patch_size // 2, shape) for lung in self._lungs(k))]
+            if len(fits) < len(self.boxes):
+                print("LungPatchDataset:", len(self.boxes) - len(fits), "images skipped, no lung box fits a crop")
+            self.boxes = self.boxes[fits]
+            self.sources = self.sources[fits]
+        else:
+            self.packed = None
+            self.sources = [os.path.join(images, n + ".png") for n in names]
+
+    def __len__(self):
+        return len(self.boxes) * self.samples_per_image
+
+    def _load(self, image_idx):
+        if self.packed is not None:
+            return self.packed.raw(int(self.sources[image_idx]))
+        return _load_gray(self.sources[image_idx])
+
+    # Lung boxes (x0, x1, y0, y1) of an image, left then right
+    def _lungs(self, image_idx):
+        llx0, lly0, llx1, lly1, rlx0, rly0, rlx1, rly1 = self.boxes[image_idx].tolist()
+        return [(llx0, llx1, lly0, lly1), (rlx0, rlx1, rly0, rly1)]
+
+    def __getitem__(self, idx):
+        image_idx = idx // self.samples_per_image
+        image = self._load(image_idx)
+        half = self.patch_size // 2
+        lungs = self._lungs(image_idx)
+        if random.randint(0, 1):
+            lungs.reverse()
+
+        center = None
+        for x0, x1, y0, y1 in lungs:
+            X = _sample_center(x0, x1, half, image.shape[0])
+            Y = _sample_center(y0, y1, half, image.shape[1])
+            if X is not None and Y is not None:
+                center = X, Y
+                break
+        if center is None:
+            # Neither lung box fits a crop, only possible for decoded images that are not checked when
+            # the dataset is built: another image is sampled
+            return self[random.randrange(len(self))]
+
+        X, Y = center
+        crop = torch.from_numpy(np.ascontiguousarray(image[X - half:X + half, Y - half:Y + half])).unsqueeze(0)
+        if self.transform is not None:
+            crop = self.transform(crop)
+        return crop, 0
+
+
+# Fingerprint of a list of files from their paths, sizes and modification times
+def files_fingerprint(paths):
+    h = hashlib.sha1()
+    for p in paths:
+        st = os.stat(p)
+        h.update(("%s %d %d\n" % (p, st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+# Write a packed store of equally sized uint8 images in cache_dir, image(k) returning the k-th of the
+# given paths, and return its index path
+def _write_image_cache(cache_dir, image, paths, names, fingerprint, source):
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+
+    height, width = image(0).shape
+    shard = os.path.join(cache_dir, "images_00000.npy")
+    packed = np.lib.format.open_memmap(_tmp_path(shard), mode="w+", dtype=np.uint8,
+                                       shape=(len(paths), height, width))
+    for k in range(len(paths)):
+        pixels = image(k)
+        if pixels.shape != (height, width):
+            raise ValueError("Image %s has size %s, expected %s" % (paths[k], pixels.shape, (height, width)))
+        packed[k] = pixels
+    packed.flush()
+    del packed
+    os.replace(_tmp_path(shard), shard)
+
+    names_file = os.path.join(cache_dir, "names.txt")
+    with open(_tmp_path(names_file), "w") as f:
+        for name in names:
+            f.write(name + "\n")
+    os.replace(_tmp_path(names_file), names_file)
+    write_packed_index(cache_dir, {"height": height, "width": width, "count": len(paths),
+                                   "shards": [{"file": "images_00000.npy", "count": len(paths)}],
+                                   "names": "names.txt", "source": source, "fingerprint": fingerprint})
+    return os.path.join(cache_dir, "index.json")
+
+
+# Store every image of an ImageFolder once, converted to grayscale and resized, in a packed uint8 store.
+# The stored pixels are those of Grayscale() + Resize(size) before ToTensor(). The cache is reused
+# while the source files and the size are unchanged, otherwise it is rebuilt. Returns the index path.
+def build_resized_cache(root, cache_dir, size):
+    folder = IndexedImageFolder(root=root, transform=transforms.Compose([
+        transforms.Grayscale(),
+        transforms.Resize(size),
+    ]))
+    paths = [p for p, _ in folder.samples]
+    fingerprint = "%s-%d" % (files_fingerprint(paths), size)
+    index_file = os.path.join(cache_dir, "index.json")
+    if os.path.exists(index_file) and load_packed_index(index_file).get("fingerprint") == fingerprint:
+        return index_file
+
+    print("Building resized image cache of", root, "in", cache_dir)
+    return _write_image_cache(cache_dir, lambda k: np.asarray(folder[k][0], dtype=np.uint8), paths,
+                              [os.path.relpath(p, root) for p in paths], fingerprint, root)
+
+
+# Store the image files at the given paths once, decoded as by LungPatchDataset, in a packed uint8 store
+# named after their file names. Reused while the files are unchanged. Returns the index path.
+def build_image_cache(paths, cache_dir, source):
+    fingerprint = files_fingerprint(paths)
+    index_file = os.path.join(cache_dir, "index.json")
+    if os.path.exists(index_file) and load_packed_index(index_file).get("fingerprint") == fingerprint:
+        return index_file
+
+    print("Building image cache of", source, "in", cache_dir)
+    return _write_image_cache(cache_dir, lambda k: _load_gray(paths[k]), paths,
+                              [os.path.basename(p) for p in paths], fingerprint, source)
+
+
+# Random crops of the images of a packed store, equivalent to CenterCrop(center_size) followed by
+# RandomCrop(crop_size, padding) on the stored images. Every image is sampled 'repeats' times per
+# pass, in the same order as a ConcatDataset of 'repeats' copies of the image folder.
+class PackedRandomCropDataset(torch.utils.data.Dataset):
+    def __init__(self, path, center_size, crop_size, repeats=1, padding=0, transform=to_float_tensor):
+        self.images = PackedImageDataset(path, transform=None)
+        self.center_size = center_size
+        self.crop_size = crop_size
+        self.repeats = repeats
+        self.padding = padding
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images) * self.repeats
+
+    def __getitem__(self, idx):
+        image = self.images.raw(idx % len(self.images))
+        top = int(round((image.shape[0] - self.center_size) / 2.))
+        left = int(round((image.shape[1] - self.center_size) / 2.))
+        image = image[top:top + self.center_size, left:left + self.center_size]
+        if self.padding > 0:
+            image = np.pad(image, self.padding, mode="constant")
+
+        i = int(torch.randint(0, image.shape[0] - self.crop_size + 1, (1,)))
+        j = int(torch.randint(0, image.shape[1] - self.crop_size + 1, (1,)))
+        crop = torch.from_numpy(np.ascontiguousarray(image[i:i + self.crop_size, j:j + self.crop_size])).unsqueeze(0)
+        if self.transform is not None:
+            crop = self.transform(crop)
+        return crop, 0
+
+
+FILE_INDEX_SUFFIX = ".file_index.pkl"
+MANIFEST = "manifest.txt"
+_file_indexes = {}
+
+
+# Modification times of the directories of an indexed tree: adding, removing or renaming an image
+# or a directory changes the mtime of its parent, so they validate the index with a few stats
+def _directories_fingerprint(root, directories):
+    return [os.stat(os.path.join(root, d)).st_mtime_ns for d in directories]
+
+
+# Image list of a split written by dataset_scripts/generate_dataset.py, 'class/file' per line, None
+# when it is missing, lists other classes or is older than a class directory (images were added or
+# removed after it was written)
+def _read_manifest(root, classes):
+    path = os.path.join(root, MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, "r") as f:
+            paths = [line.rstrip("\n") for line in f if line.strip()]
+    except OSError:
+        return None
+    if sorted(set(p.split("/", 1)[0] for p in paths)) != classes:
+        return None
+    if any(os.stat(os.path.join(root, c)).st_mtime_ns > mtime for c in classes):
+        return None
+    return paths
+
+
+# Walk an image tree like ImageFolder: sorted class directories, sorted walk, sorted file names.
+# With use_manifest the flat class directories listed in the manifest of the split are not walked,
+# the index then has no file stats.
+def _scan_image_folder(root, use_manifest=True):
+    classes = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    paths = _read_manifest(root, classes) if use_manifest else None
+    if paths is not None:
+        targets = dict((c, k) for k, c in enumerate(classes))
+        samples = sorted(((p, targets[p.split("/", 1)[0]]) for p in paths if p.lower().endswith(IMG_EXTENSIONS)),
+                         key=lambda sample: (sample[1], sample[0]))
+        directories = ["."] + classes
+        return {"classes": classes, "directories": directories, "samples": samples, "stats": None,
+                "fingerprint": _directories_fingerprint(root, directories)}
+    directories = ["."]
+    samples = []
+    stats = []
+    for target, class_name in enumerate(classes):
+        for path, _, fnames in sorted(os.walk(os.path.join(root, class_name), followlinks=True)):
+            directories.append(os.path.relpath(path, root))
+            for fname in sorted(fnames):
+                if fname.lower().endswith(IMG_EXTENSIONS):
+                    st = os.stat(os.path.join(path, fname))
+                    samples.append((os.path.relpath(os.path.join(path, fname), root), target))
+                    stats.append((st.st_size, st.st_mtime_ns))
+    return {"classes": classes, "directories": directories, "samples": samples, "stats": stats,
+            "fingerprint": _directories_fingerprint(root, directories)}
+
+
+# Persistent index of the images of an ImageFolder tree, stored next to it in '<root>.file_index.pkl'
+# (inside the tree, writing it would change the fingerprint). A missing or stale index is rebuilt from
+# the manifest of the split when it is up to date, otherwise by walking the tree.
+# It is reused while the directory fingerprint matches, with deep=True the size and mtime of every
+# file are checked as well. The tree is rescanned and the index rewritten when it is stale.
+def load_file_index(root, deep=False):
+    key = os.path.abspath(root)
+    if key in _file_indexes:
+        return _file_indexes[key]
+
+    index_file = os.path.normpath(root) + FILE_INDEX_SUFFIX
+    index = None
+    try:
+        with open(index_file, "rb") as f:
+            index = pickle.load(f)
+        if index["fingerprint"] != _directories_fingerprint(root, index["directories"]):
+            index = None
+        elif deep and index["stats"] is None:
+            index = None
+        elif deep:
+            for (path, _), (size, mtime) in zip(index["samples"], index["stats"]):
+                st = os.stat(os.path.join(root, path))
+                if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                    index = None
+                    break
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        index = None
+
+    if index is None:
+        print("Indexing images in", root)
+        index = _scan_image_folder(root, use_manifest=not deep)
+        try:
+            tmp = _tmp_path(index_file)
+            with open(tmp, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, index_file)
+        except OSError as e:
+            print("WARNING: could not store the file index of", root, ":", e)
+
+    _file_indexes[key] = index
+    return index
+
+
+# Drop-in replacement of ImageFolder built from the cached file index instead of a directory scan.
+# Same samples, targets and class ordering as ImageFolder.
+class IndexedImageFolder(torch.utils.data.Dataset):
+    def __init__(self, root, transform=None, target_transform=None, loader=default_loader, deep=False):
+        index = load_file_index(root, deep)
+        self.root = root
+        self.classes = index["classes"]
+        self.class_to_idx = dict((c, k) for k, c in enumerate(self.classes))
+        self.samples = [(os.path.join(root, path), target) for path, target in index["samples"]]
+        self.imgs = self.samples
+        self.targets = [target for _, target in self.samples]
+        self.transform = transform
+        self.target_transform = target_transform
+        self.loader = loader
+        if not self.samples:
+            raise RuntimeError("Found 0 images in subfolders of " + root)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        path, target = self.samples[idx]
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    # File names of the images without extension, in dataset order
+    def names(self):
+        return [os.path.splitext(os.path.basename(path))[0] for path, _ in self.samples]
+
+
+# DistributedSampler whose epochs can be interrupted and resumed. The order of an epoch only depends
+# on the seed and the epoch, so it is the same after a restart, and set_start() skips the samples
+# already trained on in the next iteration. With a single process it shuffles like DistributedSampler
+# over one replica.
+class ResumableSampler(torch.utils.data.distributed.DistributedSampler):
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True,
+                                               seed=seed)
+        self.start = 0
+
+    # Start the next iteration after the first 'start' samples of the shard of this process
+    def set_start(self, start):
+        self.start = start
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())[self.start:]
+        self.start = 0
+        return iter(indices)
@@ -0,0 +1,128 @@
+import inspect
+
+import torch
+import torch.nn as nn
+
+from model import _netG
+
+
+# Build _netG from the options of the experiment and load a checkpoint saved by train.py
+def load_netG(path, opt):
+    netG = _netG(opt)
+    netG.load_state_dict(torch.load(path, map_location=lambda storage, location: storage)['state_dict'])
+    return netG.eval()
+
+
+# Convolution with the affine transformation of the following eval-mode BatchNorm folded in its
+# weights and bias. Output channels are the first dimension of Conv2d weights and the second of
+# ConvTranspose2d weights.
+def fold_conv_bn(conv, bn):
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = bn.bias.detach() - bn.running_mean * scale
+    if conv.bias is not None:
+        bias = bias + conv.bias.detach() * scale
+
+    folded = type(conv)(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                        bias=True, dilation=conv.dilation, groups=conv.groups)
+    if isinstance(conv, nn.ConvTranspose2d):
+        folded.output_padding = conv.output_padding
+        folded.weight.data.copy_(conv.weight.detach() * scale.view(1, -1, 1, 1))
+    else:
+        folded.weight.data.copy_(conv.weight.detach() * scale.view(-1, 1, 1, 1))
+    folded.bias.data.copy_(bias)
+    return folded
+
+
+# Copy of a Sequential with every BatchNorm2d folded in the Conv2d/ConvTranspose2d preceding it
+def fold_batchnorm(sequential):
+    modules = []
+    for module in sequential.children():
+        if isinstance(module, nn.BatchNorm2d) and modules and isinstance(modules[-1], (nn.Conv2d, nn.ConvTranspose2d)):
+            modules[-1] = fold_conv_bn(modules[-1], module)
+        else:
+            modules.append(module)
+    return nn.Sequential(*modules).eval()
+
+
+# Frozen TorchScript module of the generator with folded BatchNorms, traced on example
+def script_netG(netG, example):
+    folded = fold_batchnorm(netG.eval().main)
+    with torch.no_grad():
+        traced = torch.jit.trace(folded, example)
+    return torch.jit.freeze(traced.eval())
+
+
+# Load an exported module optimized for inference on this machine. The optimizations (e.g. MKLDNN
+# layouts) depend on the host and are not serializable, so they are applied after loading.
+def load_torchscript(path):
+    return torch.jit.optimize_for_inference(torch.jit.load(path, map_location='cpu'))
+
+
+# Largest absolute difference between the outputs of two models on the same batch
+def max_difference(model, reference, batch):
+    with torch.no_grad():
+        return (model(batch) - reference(batch)).abs().max().item()
+
+
+# Export a model to ONNX with a dynamic batch dimension. The TorchScript-based exporter is used
+# where torch also has the dynamo one, which needs the onnxscript package.
+def export_onnx(model, example, path, opset=13):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), example, path, input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}, opset_version=opset,
+                          **kwargs)
+
+
+# Inference backends of the generator: called on a batch of masked inputs, they return the
+# reconstructed centers as a tensor on the device of the batch
+
+# Eager PyTorch module
+class TorchBackend(object):
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.model(batch)
+
+
+# TorchScript module exported by export.py
+class TorchScriptBackend(TorchBackend):
+    def __init__(self, path):
+        super(TorchScriptBackend, self).__init__(load_torchscript(path))
+
+    def __call__(self, batch):
+        return super(TorchScriptBackend, self).__call__(batch.cpu()).to(batch.device)
+
+
+# ONNX model exported by export.py, run by ONNX Runtime on the CPU with all graph optimizations.
+# threads=0 lets ONNX Runtime use one thread per physical core.
+class ONNXRuntimeBackend(object):
+    def __init__(self, path, threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        output = self.session.run(None, {self.input_name: batch.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(output).to(batch.device)
+
+
+BACKENDS = ['torch', 'torchscript', 'onnxruntime']
+
+
+# Backend by name: 'torch' runs netG itself, the others load the model exported in path
+def load_backend(name, path='', netG=None, threads=0):
+    if name == 'torch':
+        return TorchBackend(netG)
+    if name == 'torchscript':
+        return TorchScriptBackend(path)
+    if name == 'onnxruntime':
+        return ONNXRuntimeBackend(path, threads)
+    raise ValueError("Unknown backend " + name + ", expected one of " + ", ".join(BACKENDS))
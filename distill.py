@@ -0,0 +1,218 @@
+'''
+Knowledge distillation of a trained generator into narrower students
+
+A student _netG of every width in --widths (its --ndf and --nef) is trained on the patches used by
+train.py to reproduce the centers reconstructed by the teacher (--netG), with the weighted L2 loss
+of train.py (overlapping edges weighted overlapL2Weight times more). With --adversarial a local
+discriminator is trained against every student and its loss is added as in train.py.
+At the end a table with the parameters, the CPU latency and the test PSNR of the teacher and of
+every student (against the real centers and against the teacher reconstructions) is printed and
+written in '<output>/distill_table.txt'. Students are saved in '<output>/netG_student_<width>.pth'.
+'''
+
+from __future__ import print_function
+import argparse
+import copy
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.utils.data
+import torchvision.transforms as transforms
+
+from model import _netG, _netlocalD
+from metrics import batch_psnr
+from datasets import IndexedImageFolder, PackedImageDataset
+from batching import BatchPrefetcher
+from deploy import load_netG
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--netG', default='netG_context_encoder.pth', help='teacher netG checkpoint saved by train.py')
+parser.add_argument('--widths', default='16,32', help='comma separated ndf/nef of the students')
+parser.add_argument('--train', default='dataset_lungs/train_randomPatches', help='training patches, ImageFolder or packed store')
+parser.add_argument('--test', default='dataset_lungs/healthy880patch', help='test patches, ImageFolder or packed store')
+parser.add_argument('--output', default='outputs/distill', help='directory of the students and of the table')
+parser.add_argument('--adversarial', action='store_true', help='add the adversarial loss of a local discriminator')
+parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
+parser.add_argument('--batchSize', type=int, default=64, help='input batch size')
+parser.add_argument('--niter', type=int, default=5, help='number of epochs to train every student for')
+parser.add_argument('--lr', type=float, default=0.0002, help='learning rate, default=0.0002')
+parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for adam. default=0.5')
+parser.add_argument('--wtl2', type=float, default=0.998, help='0 means do not use else use with this weight')
+parser.add_argument('--imageSize', type=int, default=128, help='the height / width of the input image to network')
+parser.add_argument('--patchSize', type=int, default=64, help='the height / width of the patch to be reconstructed')
+parser.add_argument('--patch_with_margin_size', type=int, default=80)
+parser.add_argument('--overlapPred', type=int, default=4, help='overlapping edges')
+parser.add_argument('--ndf', type=int, default=64, help='ndf of the teacher')
+parser.add_argument('--nef', type=int, default=64, help='nef of the teacher')
+parser.add_argument('--nc', type=int, default=1)
+parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
+parser.add_argument('--cuda', action='store_true', help='enables cuda')
+parser.add_argument('--prefetchBatches', type=int, default=2, help='batches assembled ahead by a background thread')
+parser.add_argument('--manualSeed', type=int, default=1234, help='manual seed')
+
+opt = parser.parse_args()
+print(opt)
+
+try:
+    os.makedirs(opt.output)
+except OSError:
+    pass
+
+random.seed(opt.manualSeed)
+torch.manual_seed(opt.manualSeed)
+device = torch.device('cuda' if opt.cuda else 'cpu')
+
+wtl2 = float(opt.wtl2)
+overlapL2Weight = 10
+
+
+# custom weights initialization called on netG and netD
+def weights_init(m):
+    classname = m.__class__.__name__
+    if classname.find('Conv') != -1:
+        m.weight.data.normal_(0.0, 0.02)
+    elif classname.find('BatchNorm') != -1:
+        m.weight.data.normal_(1.0, 0.02)
+        m.bias.data.fill_(0)
+
+
+def patches_loader(path, shuffle):
+    if os.path.exists(os.path.join(path, "index.json")):
+        dataset = PackedImageDataset(path)
+    else:
+        dataset = IndexedImageFolder(root=path, transform=transforms.Compose([
+            transforms.Grayscale(),
+            transforms.ToTensor(),
+        ]))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize, shuffle=shuffle,
+                                         num_workers=int(opt.workers))
+    return BatchPrefetcher(loader, opt, opt.prefetchBatches)
+
+
+# Options of a student of the given width
+def student_options(width):
+    student_opt = copy.copy(opt)
+    student_opt.ndf = width
+    student_opt.nef = width
+    return student_opt
+
+
+def n_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+# Mean time of a forward pass on a CPU batch
+def cpu_latency(model, repeats=5):
+    model = copy.deepcopy(model).cpu().eval()
+    batch = torch.rand(opt.batchSize, opt.nc, opt.imageSize, opt.imageSize)
+    with torch.no_grad():
+        model(batch)
+        start = time.time()
+        for _ in range(repeats):
+            model(batch)
+    return (time.time() - start) / repeats
+
+
+# Mean patch PSNR on the test patches against the real centers and against the teacher. The model is
+# evaluated in eval mode and left in the mode it was in, the teacher always stays in eval mode.
+def evaluate(model):
+    training = model.training
+    model.eval()
+    psnr_real = []
+    psnr_teacher = []
+    with torch.no_grad():
+        for batch in test_batches:
+            _, input_cropped, real_center, _ = [t.to(device) for t in batch.tensors]
+            fake = model(input_cropped)
+            psnr_real += batch_psnr(real_center * 255, fake * 255).tolist()
+            psnr_teacher += batch_psnr(netG(input_cropped) * 255, fake * 255).tolist()
+    model.train(training)
+    return np.mean(psnr_real), np.mean(psnr_teacher)
+
+
+# Weights of the L2 loss as in train.py: the overlapping edges count overlapL2Weight times more
+def l2_weights(real_center):
+    wtl2Matrix = torch.empty_like(real_center).fill_(wtl2 * overlapL2Weight)
+    wtl2Matrix[:, :, int(opt.overlapPred):int(opt.imageSize / 2 - opt.overlapPred),
+               int(opt.overlapPred):int(opt.imageSize / 2 - opt.overlapPred)] = wtl2
+    return wtl2Matrix
+
+
+def distill(width):
+    student_opt = student_options(width)
+    student = _netG(student_opt).to(device)
+    student.apply(weights_init)
+    optimizerG = optim.Adam(student.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+    if opt.adversarial:
+        netD = _netlocalD(student_opt).to(device)
+        netD.apply(weights_init)
+        optimizerD = optim.Adam(netD.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+        criterion = nn.BCELoss()
+
+    for epoch in range(opt.niter):
+        epoch_time = time.time()
+        for i, batch in enumerate(train_batches):
+            _, input_cropped, real_center, _ = [t.to(device) for t in batch.tensors]
+            with torch.no_grad():
+                target = netG(input_cropped)
+            fake = student(input_cropped)
+
+            if opt.adversarial:
+                # Discriminator: real centers against the student reconstructions
+                netD.zero_grad()
+                output = netD(real_center)
+                errD = criterion(output, torch.ones_like(output))
+                output = netD(fake.detach())
+                errD = errD + criterion(output, torch.zeros_like(output))
+                errD.backward()
+                optimizerD.step()
+
+            student.zero_grad()
+            errG_l2 = ((fake - target).pow(2) * l2_weights(real_center)).mean()
+            if opt.adversarial:
+                output = netD(fake)
+                errG_D = criterion(output, torch.ones_like(output))
+                errG = (1 - wtl2) * errG_D + wtl2 * errG_l2
+            else:
+                errG = errG_l2
+            errG.backward()
+            optimizerG.step()
+
+            if i % 100 == 0:
+                print('[width %d][%d/%d][%d/%d] Loss_G: %.4f | Loss_L2 (teacher): %.4f'
+                      % (width, epoch + 1, opt.niter, i + 1, len(train_batches), errG.item(), errG_l2.item()))
+
+        psnr_real, psnr_teacher = evaluate(student)
+        print('[width %d] Epoch %d took %.1f minutes | PSNR per Patch: %.4f | PSNR against teacher: %.4f'
+              % (width, epoch + 1, (time.time() - epoch_time) / 60, psnr_real, psnr_teacher))
+        torch.save({'epoch': epoch + 1, 'state_dict': student.state_dict(), 'ndf': width, 'nef': width},
+                   os.path.join(opt.output, "netG_student_%d.pth" % width))
+
+    return student.eval()
+
+
+netG = load_netG(opt.netG, opt).to(device)
+train_batches = patches_loader(opt.train, True)
+test_batches = patches_loader(opt.test, False)
+
+teacher_latency = cpu_latency(netG)
+psnr_real, _ = evaluate(netG)
+rows = [("teacher %d" % opt.nef, n_parameters(netG), teacher_latency, psnr_real, float('nan'))]
+for width in [int(w) for w in opt.widths.split(",")]:
+    student = distill(width)
+    psnr_real, psnr_teacher = evaluate(student)
+    rows.append(("student %d" % width, n_parameters(student), cpu_latency(student), psnr_real, psnr_teacher))
+
+lines = ["%-12s %12s %12s %8s %10s %14s" % ("model", "parameters", "latency ms", "speedup", "PSNR", "PSNR teacher")]
+for name, params, latency, psnr_real, psnr_teacher in rows:
+    lines.append("%-12s %12d %12.1f %7.1fx %10.4f %14.4f"
+                 % (name, params, latency * 1000, teacher_latency / latency, psnr_real, psnr_teacher))
+print("\n".join(lines))
+with open(os.path.join(opt.output, "distill_table.txt"), "w") as f:
+    f.write("Latency of a CPU forward pass on a batch of %d\n" % opt.batchSize)
+    f.write("\n".join(lines) + "\n")
@@ -0,0 +1,142 @@
+import builtins
+import contextlib
+import datetime
+import os
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.distributed.nn.functional as dist_nn
+
+# Collectives wait this long for the other ranks, e.g. while rank 0 tests and saves the models
+TIMEOUT = datetime.timedelta(hours=2)
+
+
+def rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return rank() == 0
+
+
+# Start nproc copies of the running script on this machine, with the environment torchrun would
+# give them, and exit with the first failure. As soon as a worker fails the others are terminated,
+# instead of waiting in collectives for TIMEOUT. Does nothing in a worker or with a single process.
+def launch(nproc, port=29500, poll_interval=0.5):
+    if nproc <= 1 or 'RANK' in os.environ:
+        return
+    workers = []
+    for local_rank in range(nproc):
+        env = dict(os.environ, RANK=str(local_rank), LOCAL_RANK=str(local_rank), WORLD_SIZE=str(nproc),
+                   MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+        workers.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    while True:
+        codes = [worker.poll() for worker in workers]
+        failure = next((code for code in codes if code not in (None, 0)), None)
+        if failure is not None:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.terminate()
+            for worker in workers:
+                worker.wait()
+            sys.exit(failure)
+        if all(code == 0 for code in codes):
+            sys.exit(0)
+        time.sleep(poll_interval)
+
+
+# Join the process group of a run started by launch() or torchrun (RANK, WORLD_SIZE, MASTER_ADDR and
+# MASTER_PORT in the environment) with the gloo backend, which also runs on CPU-only machines.
+# With CUDA every process uses the GPU of its LOCAL_RANK. Only rank 0 prints.
+def setup(opt):
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 0, 1
+    dist.init_process_group('gloo', timeout=TIMEOUT)
+    if opt.cuda:
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+    if not is_main_process():
+        builtins.print = lambda *args, **kwargs: None
+    return rank(), world_size()
+
+
+# BatchNorm2d normalizing with the statistics of the whole distributed batch. Unlike
+# nn.SyncBatchNorm it also runs on the CPU. Forwards under no_grad, which are not backpropagated
+# (e.g. testing on rank 0 only), use the local batch statistics and do not communicate.
+# Statistics are computed and reduced in float32 whatever the input dtype: in bfloat16 the variance
+# E[x^2] - E[x]^2 is lost to cancellation.
+class GlooSyncBatchNorm(nn.BatchNorm2d):
+    def forward(self, input):
+        if not (self.training and torch.is_grad_enabled() and world_size() > 1):
+            return super(GlooSyncBatchNorm, self).forward(input)
+
+        x = input.float()
+        count = torch.full([1], x.numel() // x.size(1), dtype=x.dtype, device=x.device)
+        stats = dist_nn.all_reduce(torch.cat([x.sum((0, 2, 3)), x.pow(2).sum((0, 2, 3)), count]))
+        n = stats[-1]
+        mean = stats[:self.num_features] / n
+        var = (stats[self.num_features:-1] / n - mean.pow(2)).clamp(min=0)
+
+        with torch.no_grad():
+            self.num_batches_tracked += 1
+            momentum = self.momentum if self.momentum is not None else 1.0 / self.num_batches_tracked.item()
+            self.running_mean.mul_(1 - momentum).add_(mean.detach() * momentum)
+            self.running_var.mul_(1 - momentum).add_(var.detach() * (n / (n - 1)) * momentum)
+
+        shape = (1, -1, 1, 1)
+        output = (x - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            output = output * self.weight.view(shape) + self.bias.view(shape)
+        return output.to(input.dtype)
+
+
+# Replace in place every BatchNorm2d of a model with a GlooSyncBatchNorm sharing its parameters
+# and statistics, so that state_dict keys are unchanged
+def convert_sync_batchnorm(module):
+    for name, child in module._modules.items():
+        if type(child) is nn.BatchNorm2d:
+            synced = GlooSyncBatchNorm(child.num_features, child.eps, child.momentum, child.affine,
+                                       child.track_running_stats)
+            synced.load_state_dict(child.state_dict())
+            synced.to(child.weight.device if child.affine else child.running_mean.device)
+            module._modules[name] = synced
+        else:
+            convert_sync_batchnorm(child)
+    return module
+
+
+# DistributedDataParallel model, the model itself when training in a single process
+def wrap(net, opt):
+    if world_size() <= 1:
+        return net
+    if opt.syncBN:
+        convert_sync_batchnorm(net)
+    device_ids = [torch.cuda.current_device()] if opt.cuda else None
+    return nn.parallel.DistributedDataParallel(net, device_ids=device_ids)
+
+
+# Model wrapped by wrap(), for saving checkpoints with the keys of the single process models and
+# for forwards run on one rank only
+def unwrap(net):
+    return net.module if isinstance(net, nn.parallel.DistributedDataParallel) else net
+
+
+# Forward passes whose gradients are not averaged across processes, e.g. the discriminator in the
+# generator step, whose gradients are discarded, or all the micro-batches of a batch but the last
+def no_sync(net, enabled=True):
+    if enabled and isinstance(net, nn.parallel.DistributedDataParallel):
+        return net.no_sync()
+    return contextlib.nullcontext()
+
+
+# Wait for all the processes
+def barrier():
+    if world_size() > 1:
+        dist.barrier()
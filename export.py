@@ -0,0 +1,90 @@
+'''
+Export a trained generator for CPU inference
+
+The BatchNorm layers of netG are folded into the preceding convolutions, the network is traced and
+saved either as a frozen TorchScript module, optimized for the host when loaded
+(deploy.load_torchscript), or with '--format onnx' as an ONNX model with a dynamic batch dimension,
+run by ONNX Runtime (deploy.ONNXRuntimeBackend). With '--format onnx' a local discriminator
+checkpoint (--netD) can be exported as well, for scoring reconstructed patches.
+Exported models are checked against the original checkpoints on a batch of masked inputs, taken
+from --images or random, and are removed if their outputs differ by more than --tolerance.
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+
+from batching import load_masked_batch
+from datasets import IndexedImageFolder
+from model import _netlocalD
+from deploy import (ONNXRuntimeBackend, export_onnx, fold_batchnorm, load_netG, load_torchscript,
+                    max_difference, script_netG)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--netG', default='netG_context_encoder.pth', help='netG checkpoint saved by train.py')
+parser.add_argument('--output', default='netG_context_encoder.pt', help='path of the exported generator')
+parser.add_argument('--format', default='torchscript', choices=['torchscript', 'onnx'])
+parser.add_argument('--netD', default='', help='netlocalD checkpoint also exported with --format onnx')
+parser.add_argument('--outputD', default='netlocalD.onnx', help='path of the exported discriminator')
+parser.add_argument('--images', default='', help='ImageFolder of imageSize patches for the check, random inputs if empty')
+parser.add_argument('--batchSize', type=int, default=64, help='size of the batch used for tracing and the check')
+parser.add_argument('--tolerance', type=float, default=1e-4, help='largest absolute difference accepted with the checkpoint')
+parser.add_argument('--imageSize', type=int, default=128, help='the height / width of the input image to network')
+parser.add_argument('--patchSize', type=int, default=64, help='the height / width of the patch to be reconstructed')
+parser.add_argument('--overlapPred', type=int, default=4, help='overlapping edges')
+parser.add_argument('--ndf', type=int, default=64)
+parser.add_argument('--nef', type=int, default=64, help='of encoder filters in first conv layer')
+parser.add_argument('--nc', type=int, default=1)
+parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
+parser.add_argument('--manualSeed', type=int, default=1234, help='manual seed')
+
+opt = parser.parse_args()
+print(opt)
+torch.manual_seed(opt.manualSeed)
+
+netG = load_netG(opt.netG, opt)
+
+# Masked inputs as in training
+if opt.images != '':
+    dataset = IndexedImageFolder(root=opt.images, transform=transforms.Compose([
+        transforms.Grayscale(),
+        transforms.CenterCrop(opt.imageSize),
+        transforms.ToTensor(),
+    ]))
+    batch = next(iter(torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize, shuffle=True)))[0]
+else:
+    batch = torch.rand(opt.batchSize, opt.nc, opt.imageSize, opt.imageSize)
+_, example = load_masked_batch(batch, torch.FloatTensor(), torch.FloatTensor(), opt)
+
+
+# Remove an export differing from its checkpoint
+def check(path, model, reference, batch):
+    difference = max_difference(model, reference, batch)
+    print("Largest absolute difference with the checkpoint: %.3g" % difference)
+    if difference > opt.tolerance:
+        os.remove(path)
+        print("ERROR:", path, "differs from the checkpoint by more than", opt.tolerance)
+        sys.exit(1)
+    print("Saved", path)
+
+
+if opt.format == 'torchscript':
+    torch.jit.save(script_netG(netG, example), opt.output)
+    # Check the module as it is loaded for inference
+    check(opt.output, load_torchscript(opt.output), netG, example)
+else:
+    export_onnx(fold_batchnorm(netG.main), example, opt.output)
+    check(opt.output, ONNXRuntimeBackend(opt.output), netG, example)
+    if opt.netD != '':
+        netD = _netlocalD(opt)
+        netD.load_state_dict(torch.load(opt.netD, map_location=lambda storage, location: storage)['state_dict'])
+        netD.eval()
+        with torch.no_grad():
+            patches = netG(example)
+        export_onnx(netD, patches, opt.outputD)
+        check(opt.outputD, ONNXRuntimeBackend(opt.outputD), netD, patches)
@@ -0,0 +1,87 @@
+import math
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from PIL import Image
+
+
+# Region-first equivalent of
+#   Grayscale() -> Resize(scale_to) -> CenterCrop(center_size) -> RandomCrop(crop_size)
+# The crop window is drawn in the coordinates of the resized image, mapped back to the source image,
+# and only that region is converted and resampled, instead of the whole radiograph.
+# For PIL images the result matches the chained transforms up to rounding, as PIL computes every
+# output pixel of a resize with a source box exactly as in the full resize. Crop positions are drawn
+# with torch.randint like RandomCrop, so the same seed gives the same windows.
+class RegionCrop(object):
+    def __init__(self, scale_to, center_size, crop_size, grayscale=True, interpolation=Image.BILINEAR):
+        self.scale_to = scale_to
+        self.center_size = center_size
+        self.crop_size = crop_size
+        self.grayscale = grayscale
+        self.interpolation = interpolation
+
+    # Size (h, w) of the image after Resize(scale_to), the shorter side is matched
+    def _resized_size(self, h, w):
+        if w <= h:
+            return int(self.scale_to * h / w), self.scale_to
+        return self.scale_to, int(self.scale_to * w / h)
+
+    # Crop window (top, left) in the resized image coordinates
+    def _window(self, rh, rw):
+        top = int(round((rh - self.center_size) / 2.))
+        left = int(round((rw - self.center_size) / 2.))
+        if self.center_size == self.crop_size:
+            return top, left
+        i = torch.randint(0, self.center_size - self.crop_size + 1, size=(1,)).item()
+        j = torch.randint(0, self.center_size - self.crop_size + 1, size=(1,)).item()
+        return top + i, left + j
+
+    def __call__(self, img):
+        if isinstance(img, torch.Tensor):
+            return self._crop_tensor(img)
+
+        w, h = img.size
+        rh, rw = self._resized_size(h, w)
+        top, left = self._window(rh, rw)
+        if (rh, rw) == (h, w):  # Resize is the identity, plain crop
+            img = img.crop((left, top, left + self.crop_size, top + self.crop_size))
+            return img.convert('L') if self.grayscale else img
+
+        # Source box of the window, plus a margin covering the support of the resampling filter
+        sy, sx = h / float(rh), w / float(rw)
+        box = (left * sx, top * sy, (left + self.crop_size) * sx, (top + self.crop_size) * sy)
+        margin = int(math.ceil(3 * max(sx, sy, 1.0))) + 1
+        region = (max(0, int(box[0]) - margin), max(0, int(box[1]) - margin),
+                  min(w, int(math.ceil(box[2])) + margin), min(h, int(math.ceil(box[3])) + margin))
+        img = img.crop(region)
+        if self.grayscale:
+            img = img.convert('L')
+        return img.resize((self.crop_size, self.crop_size), self.interpolation,
+                          box=(box[0] - region[0], box[1] - region[1], box[2] - region[0], box[3] - region[1]))
+
+    # Tensors (C, H, W) are cropped on the source region rounded to whole pixels and resized with
+    # antialiasing, which matches the chained transforms within resampling tolerance
+    def _crop_tensor(self, img):
+        h, w = img.shape[-2:]
+        rh, rw = self._resized_size(h, w)
+        top, left = self._window(rh, rw)
+        if self.grayscale and img.shape[-3] == 3:
+            img = TF.rgb_to_grayscale(img)
+        if (rh, rw) == (h, w):
+            return img[..., top:top + self.crop_size, left:left + self.crop_size]
+        sy, sx = h / float(rh), w / float(rw)
+        return TF.resized_crop(img, int(round(top * sy)), int(round(left * sx)),
+                               int(round(self.crop_size * sy)), int(round(self.crop_size * sx)),
+                               [self.crop_size, self.crop_size], antialias=True)
+
+
+# Replacement of ToTensor for --uint8Loader: PIL image to a (C, H, W) uint8 tensor, without
+# scaling. Batches stay 4x smaller through the DataLoader workers and are converted once per
+# batch in the main process (see batching.copy_batch).
+class ToUInt8Tensor(object):
+    def __call__(self, img):
+        image = torch.from_numpy(np.array(img, dtype=np.uint8, copy=True))
+        if image.dim() == 2:
+            return image.unsqueeze(0)
+        return image.permute(2, 0, 1).contiguous()
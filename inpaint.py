@@ -0,0 +1,118 @@
+'''
+Full-resolution inpainting of radiographs with a trained generator
+
+Every image is covered with a regular grid of overlapping imageSize windows (see tiled_inpaint.py),
+the masked center of every window is reconstructed by netG and the patches are blended together.
+For every image '<name>_recon.png' and '<name>_diff.png' (absolute difference with the source) are
+written in --output, and a line with the PSNR and MSE of the reconstruction in 'measures.txt'.
+With --bbox_csv only the patches overlapping the lungs bounding boxes are reconstructed, the rest
+of the image is left as it is and measures are computed on the reconstructed pixels.
+With --adaptiveMSE images are first scanned on a coarse grid (--coarseStride) and the dense grid is
+only reconstructed around the coarse patches with a larger MSE (pixel values in [0, 255]).
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import time
+
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+import torchvision.utils as vutils
+
+from model import _netG
+import math
+from datasets import IndexedImageFolder
+from tiled_inpaint import LungROI, TiledInpainter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--images', default='dataset_lungs/test_64', help='ImageFolder root of the images to inpaint')
+parser.add_argument('--netG', default='', help='path to the netG checkpoint')
+parser.add_argument('--output', default='inpaint', help='directory of the reconstructions and difference maps')
+parser.add_argument('--workers', type=int, default=2, help='number of data loading workers')
+parser.add_argument('--batchSize', type=int, default=256, help='windows per generator forward pass')
+parser.add_argument('--stride', type=int, default=32, help='stride of the grid of reconstructed patches')
+parser.add_argument('--limit', type=int, default=-1, help='number of images to inpaint, -1 for all')
+parser.add_argument('--bbox_csv', default='', help='lungs bounding boxes, only the lungs are reconstructed')
+parser.add_argument('--bboxSize', type=int, default=1024, help='size of the images the bounding boxes refer to')
+parser.add_argument('--adaptiveMSE', type=float, default=0, help='coarse patches MSE above which the dense grid is used, 0 always scans densely')
+parser.add_argument('--coarseStride', type=int, default=64, help='stride of the coarse grid with --adaptiveMSE')
+parser.add_argument('--imageSize', type=int, default=128, help='the height / width of the input image to network')
+parser.add_argument('--patchSize', type=int, default=64, help='the height / width of the patch to be reconstructed')
+parser.add_argument('--initialScaleTo', type=int, default=1024, help='the height / width to rescale the original image')
+parser.add_argument('--overlapPred', type=int, default=4, help='overlapping edges')
+parser.add_argument('--ndf', type=int, default=64)
+parser.add_argument('--nef', type=int, default=64, help='of encoder filters in first conv layer')
+parser.add_argument('--nc', type=int, default=1)
+parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
+parser.add_argument('--cuda', action='store_true', help='enables cuda')
+
+opt = parser.parse_args()
+print(opt)
+
+try:
+    os.makedirs(opt.output)
+except OSError:
+    pass
+
+transform = transforms.Compose([
+    transforms.Grayscale(),
+    transforms.Resize(opt.initialScaleTo),
+    transforms.ToTensor(),
+])
+dataset = IndexedImageFolder(root=opt.images, transform=transform)
+names = dataset.names()
+dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=opt.workers)
+
+netG = _netG(opt)
+netG.load_state_dict(torch.load(opt.netG, map_location=lambda storage, location: storage)['state_dict'])
+device = 'cuda' if opt.cuda else 'cpu'
+netG.to(device)
+netG.eval()
+
+inpainter = TiledInpainter(netG, opt.imageSize, opt.patchSize, opt.overlapPred, opt.stride, opt.batchSize, device)
+roi = None
+if opt.bbox_csv != '':
+    roi = LungROI(opt.bbox_csv, opt.patchSize, opt.stride, opt.bboxSize)
+
+
+# Images of the loader with their names, up to --limit
+def images():
+    for i, (image, _) in enumerate(dataloader):
+        if i == opt.limit:
+            break
+        yield names[i], image[0]
+
+
+start = time.time()
+n_images = 0
+forward_passes = 0
+dense_passes = 0  # Dense scan of the lungs, or of the whole images
+grid_passes = 0  # Dense scan of the whole images
+with open(os.path.join(opt.output, "measures.txt"), "w") as measures:
+    if opt.adaptiveMSE > 0:
+        results = inpainter.inpaint_adaptive(images(), opt.adaptiveMSE, opt.coarseStride, roi)
+    else:
+        results = inpainter.inpaint(images(), roi)
+    for name, result in results:
+        vutils.save_image(result.reconstruction, os.path.join(opt.output, name + "_recon.png"))
+        vutils.save_image(result.difference(), os.path.join(opt.output, name + "_diff.png"))
+        mse = result.mse()
+        psnr = 100 if mse == 0 else 20 * math.log10(255.0 / math.sqrt(mse))
+        measures.write("%s\t%.4f\t%.4f\n" % (name, psnr, mse))
+        n_images += 1
+        forward_passes += result.forward_passes
+        grid_passes += len(inpainter.grid(*result.image.shape[-2:]))
+        dense_passes += result.dense_tiles
+        print('[%d] %s PSNR: %.4f | MSE: %.4f | %d windows' % (n_images, name, psnr, mse, result.forward_passes))
+
+elapsed = time.time() - start
+print("Inpainted", n_images, "images with", forward_passes, "windows in %.1fs" % elapsed)
+if roi is not None:
+    print("Lungs only: %d windows for a dense scan instead of %d for the whole images (%.1fx fewer)"
+          % (dense_passes, grid_passes, grid_passes / float(max(dense_passes, 1))))
+if opt.adaptiveMSE > 0:
+    print("Adaptive scan: %d windows instead of %d for a dense scan, %d forward passes saved (%.1f%%)"
+          % (forward_passes, dense_passes, dense_passes - forward_passes,
+             100.0 * (dense_passes - forward_passes) / max(dense_passes, 1)))
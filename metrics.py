@@ -0,0 +1,69 @@
+import torch
+import torch.nn.functional as F
+
+# Batched reconstruction measures. Inputs are (B, C, H, W) tensors already scaled to the
+# 0-255 range used by utils.psnr, outputs are vectors with one value per sample.
+
+PIXEL_MAX = 255.0
+
+_ssim_windows = {}
+
+
+# Mean squared error per sample, accumulated in double precision like numpy does on CPU
+def batch_mse(img1, img2):
+    diff = img1.float() - img2.float()
+    return diff.pow(2).view(diff.size(0), -1).mean(1, dtype=torch.float64)
+
+
+# PSNR per sample, 100 for identical images as in utils.psnr
+def batch_psnr(img1, img2, mse=None):
+    if mse is None:
+        mse = batch_mse(img1, img2)
+    psnr = 20 * torch.log10(PIXEL_MAX / mse.sqrt())
+    return torch.where(mse == 0, torch.full_like(psnr, 100), psnr)
+
+
+# Normalized 11x11 gaussian window with sigma 1.5, cached per device and number of channels
+def _ssim_window(channels, device, size=11, sigma=1.5):
+    key = (channels, str(device))
+    if key not in _ssim_windows:
+        coords = torch.arange(size, dtype=torch.float64) - size // 2
+        gauss = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+        gauss = gauss / gauss.sum()
+        window = (gauss.view(-1, 1) * gauss.view(1, -1)).float().expand(channels, 1, size, size).contiguous()
+        _ssim_windows[key] = window.to(device)
+    return _ssim_windows[key]
+
+
+# SSIM per sample (Wang et al. 2004) with the same settings as MATLAB ssim used in
+# dataset_scripts/measures.m: gaussian window, replicate padding, mean over the whole map
+def batch_ssim(img1, img2):
+    img1 = img1.float()
+    img2 = img2.float()
+    channels = img1.size(1)
+    window = _ssim_window(channels, img1.device)
+    pad = window.size(-1) // 2
+
+    def filt(x):
+        return F.conv2d(F.pad(x, (pad, pad, pad, pad), mode='replicate'), window, groups=channels)
+
+    C1 = (0.01 * PIXEL_MAX) ** 2
+    C2 = (0.03 * PIXEL_MAX) ** 2
+
+    mu1 = filt(img1)
+    mu2 = filt(img2)
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = filt(img1 * img1) - mu1_sq
+    sigma2_sq = filt(img2 * img2) - mu2_sq
+    sigma12 = filt(img1 * img2) - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+    return ssim_map.view(ssim_map.size(0), -1).mean(1, dtype=torch.float64)
+
+
+# MSE, PSNR and SSIM per sample for a batch of real and reconstructed images
+def batch_measures(real, recon):
+    mse = batch_mse(real, recon)
+    return mse, batch_psnr(real, recon, mse), batch_ssim(real, recon)
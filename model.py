@@ -1,5 +1,9 @@
+import contextlib
+import functools
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 class _netG(nn.Module):
@@ -75,16 +79,48 @@ class _netG(nn.Module):
                         nn.Tanh())
         
         self.main = main
-        
+        self.segments = []
+    
+    # Checkpoint main in segments of `stages` resolution stages, a stage being an ENC_imsize/DEC_imsize
+    # convolution with the BatchNorm and activation following it: only the inputs of the segments are
+    # kept for the backward pass and the activations inside them are recomputed. 0 disables it.
+    # The modules of main and the state_dict keys are unchanged.
+    def checkpoint_stages(self, stages):
+        resolution_stages = []
+        for module in self.main.children():
+            if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)) or not resolution_stages:
+                resolution_stages.append([])
+            resolution_stages[-1].append(module)
+        self.segments = []
+        if stages > 0:
+            for start in range(0, len(resolution_stages), stages):
+                self.segments.append(nn.Sequential(*sum(resolution_stages[start:start + stages], [])))
+        return self
+    
     def forward(self, input):
         if isinstance(input.data, torch.cuda.FloatTensor) and self.ngpu > 1:
             output = nn.parallel.data_parallel(self.main, input, range(self.ngpu))
+        elif self.segments and self.training and torch.is_grad_enabled():
+            output = input
+            for segment in self.segments:
+                # BatchNorm running statistics are only updated in the first forward of a segment
+                output = checkpoint(segment, output, use_reentrant=False,
+                                    context_fn=functools.partial(_recompute_context, segment))
         else:
             output = self.main(input)
         return output
 
 
 
+# Final layers of a discriminator, its last convolution or linear layer and the sigmoid. Under autocast
+# they run in float32: in bfloat16 confident outputs round to exactly 0 or 1, where BCELoss saturates.
+def _float32_head(head, input):
+    if not torch.is_autocast_enabled(input.device.type):
+        return head(input)
+    with torch.autocast(input.device.type, enabled=False):
+        return head(input.float())
+
+
 class _netlocalD(nn.Module):
     def __init__(self, opt):
         super(_netlocalD, self).__init__()
@@ -124,7 +160,7 @@ class _netlocalD(nn.Module):
         if isinstance(input.data, torch.cuda.FloatTensor) and self.ngpu > 1:
             output = nn.parallel.data_parallel(self.main, input, range(self.ngpu))
         else:
-            output = self.main(input)
+            output = _float32_head(self.main[-2:], self.main[:-2](input))
         
         return output.view(-1, 1)
 
@@ -170,7 +206,7 @@ class _netmarginD(nn.Module):
         if isinstance(input.data, torch.cuda.FloatTensor) and self.ngpu > 1:
             output = nn.parallel.data_parallel(self.main, input, range(self.ngpu))
         else:
-            output = self.main(input)
+            output = _float32_head(self.main[-2:], self.main[:-2](input))
             
         return output.view(-1, 1)
 
@@ -275,6 +311,52 @@ class _netjointD(nn.Module):
             # print(output_local.size(), type(output_local))
             # print(output_joint.size(), type(output_joint))
             # input()
-            output = self.main_joint(output_joint)
+            output = _float32_head(self.main_joint, output_joint)
         
         return output.view(-1, 1)
+
+
+
+# BatchNorm forward on the chunks of a batch, one after the other
+def _split_batchnorm_forward(forward, splits, input):
+    return torch.cat([forward(chunk) for chunk in input.chunk(splits)])
+
+
+# Within this context the BatchNorm layers of net normalize each of the `splits` equal chunks of
+# their input batch with its own statistics, and update the running statistics once per chunk. A
+# forward on concatenated batches then gives the outputs and gradients of separate forwards, as
+# mixing real and reconstructed patches in the same batch statistics would change what the
+# discriminator learns, while the convolutions still run once on the whole batch.
+@contextlib.contextmanager
+def split_batchnorm(net, splits):
+    layers = [m for m in net.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    for m in layers:
+        m.forward = functools.partial(_split_batchnorm_forward, type(m).forward.__get__(m), splits)
+    try:
+        yield
+    finally:
+        for m in layers:
+            del m.forward
+
+
+# Contexts of the forward of a checkpointed segment and of its recomputation in the backward pass
+def _recompute_context(segment):
+    return contextlib.nullcontext(), frozen_batchnorm_stats(segment)
+
+
+# Within this context the BatchNorm layers of net do not update their running statistics, for
+# forwards computing again a batch they have already seen
+@contextlib.contextmanager
+def frozen_batchnorm_stats(net):
+    layers = [m for m in net.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in layers]
+    counts = [m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None for m in layers]
+    for m in layers:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum, count in zip(layers, momenta, counts):
+            m.momentum = momentum
+            if count is not None:
+                m.num_batches_tracked.copy_(count)
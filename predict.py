@@ -15,7 +15,11 @@ from torch.autograd import Variable
 import numpy as np
 
 from model import _netlocalD, _netG
-from psnr import psnr
+from metrics import batch_psnr
+from image_transforms import ToUInt8Tensor
+from batching import load_masked_batch
+from datasets import IndexedImageFolder
+from checkpoint import load as load_checkpoint
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset', default='lungs', help='streetview | tiny-imagenet | lungs ')
@@ -45,6 +49,7 @@ parser.add_argument('--overlapPred', type=int, default=4, help='overlapping edge
 parser.add_argument('--nef', type=int, default=64, help='of encoder filters in first conv layer')
 parser.add_argument('--wtl2', type=float, default=0.998, help='0 means do not use else use with this weight')
 parser.add_argument('--wtlD', type=float, default=0.001, help='0 means do not use else use with this weight')
+parser.add_argument('--uint8Loader', action='store_true', help='loader workers return uint8 batches, converted to float once per batch')
 
 opt = parser.parse_args()
 opt.cuda = True
@@ -73,15 +78,21 @@ cudnn.benchmark = True
 if torch.cuda.is_available() and not opt.cuda:
     print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
+# With --uint8Loader samples stay uint8 through the loader workers, see batching.copy_batch
+if opt.uint8Loader:
+    to_tensor = ToUInt8Tensor()
+else:
+    to_tensor = transforms.ToTensor()
+
 if opt.dataset == 'tiny-imagenet':
     # folder dataset
-    dataset = dset.ImageFolder(root='dataset_tiny_imagenet/test',
-                               transform=transforms.Compose([
-                                   transforms.Resize(opt.imageSize),
-                                   transforms.CenterCrop(opt.imageSize),
-                                   transforms.ToTensor(),
-                                   # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                               ]))
+    dataset = IndexedImageFolder(root='dataset_tiny_imagenet/test',
+                                transform=transforms.Compose([
+                                    transforms.Resize(opt.imageSize),
+                                    transforms.CenterCrop(opt.imageSize),
+                                    to_tensor,
+                                    # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+                                ]))
 elif opt.dataset == 'lungs':
     # folder dataset
     if opt.nc == 1:
@@ -90,21 +101,21 @@ elif opt.dataset == 'lungs':
             transforms.Grayscale(),
             transforms.Resize(opt.imageSize),
             transforms.CenterCrop(opt.imageSize),
-            transforms.ToTensor()
+            to_tensor
         ])
     else:
         transform = transforms.Compose([
             transforms.Resize(opt.imageSize),
             transforms.CenterCrop(opt.imageSize),
-            transforms.ToTensor()
+            to_tensor
         ])
-    dataset = dset.ImageFolder(root='dataset_lungs/test_64', transform=transform)
+    dataset = IndexedImageFolder(root='dataset_lungs/test_64', transform=transform)
 elif opt.dataset == 'streetview':
     transform = transforms.Compose([transforms.Resize(opt.imageSize),
                                     transforms.CenterCrop(opt.imageSize),
                                     transforms.ToTensor(),
                                     transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
-    dataset = dset.ImageFolder(root="dataset/val", transform=transform)
+    dataset = IndexedImageFolder(root="dataset/val", transform=transform)
 
 assert dataset
 dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize,
@@ -136,15 +147,17 @@ resume_epoch = 0
 netG = _netG(opt)
 netG.apply(weights_init)
 if opt.netG != '':
-    netG.load_state_dict(torch.load(opt.netG, map_location=lambda storage, location: storage)['state_dict'])
-    resume_epoch = torch.load(opt.netG)['epoch']
+    checkpointG = load_checkpoint(opt.netG)
+    netG.load_state_dict(checkpointG['state_dict'])
+    resume_epoch = checkpointG['epoch']
 print(netG)
 
 netD = _netlocalD(opt)
 netD.apply(weights_init)
 if opt.netD != '':
-    netD.load_state_dict(torch.load(opt.netD, map_location=lambda storage, location: storage)['state_dict'])
-    resume_epoch = torch.load(opt.netD)['epoch']
+    checkpointD = load_checkpoint(opt.netD)
+    netD.load_state_dict(checkpointD['state_dict'])
+    resume_epoch = checkpointD['epoch']
 print(netD)
 
 print("This model was trained for ", resume_epoch, "epochs.")
@@ -183,25 +196,11 @@ for epoch in range(resume_epoch, opt.niter):
     for i, data in enumerate(dataloader, 0):
         if LIMIT_SAMPLES == -1 or i < LIMIT_SAMPLES:
             real_cpu, _ = data
-            real_center_cpu = real_cpu[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
-                              int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
             batch_size = real_cpu.size(0)
-            input_real.data.resize_(real_cpu.size()).copy_(real_cpu)
-            input_cropped.data.resize_(real_cpu.size()).copy_(real_cpu)
-            real_center.data.resize_(real_center_cpu.size()).copy_(real_center_cpu)
-            input_cropped.data[:, 0,
-            int(opt.imageSize / 4 + opt.overlapPred):int(opt.imageSize / 4 + opt.imageSize / 2 - opt.overlapPred),
-            int(opt.imageSize / 4 + opt.overlapPred):int(
-                opt.imageSize / 4 + opt.imageSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
-            if opt.nc > 1:
-                input_cropped.data[:, 1,
-                int(opt.imageSize / 4 + opt.overlapPred):int(opt.imageSize / 4 + opt.imageSize / 2 - opt.overlapPred),
-                int(opt.imageSize / 4 + opt.overlapPred):int(
-                    opt.imageSize / 4 + opt.imageSize / 2 - opt.overlapPred)] = 2 * 104.0 / 255.0 - 1.0
-                input_cropped.data[:, 2,
-                int(opt.imageSize / 4 + opt.overlapPred):int(opt.imageSize / 4 + opt.imageSize / 2 - opt.overlapPred),
-                int(opt.imageSize / 4 + opt.overlapPred):int(
-                    opt.imageSize / 4 + opt.imageSize / 2 - opt.overlapPred)] = 2 * 123.0 / 255.0 - 1.0
+            load_masked_batch(real_cpu, input_real.data, input_cropped.data, opt)
+            real_center_batch = input_real.data[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
+                                             int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
+            real_center.data.resize_(real_center_batch.size()).copy_(real_center_batch)
             
             # train with real
             netD.zero_grad()
@@ -258,7 +257,7 @@ for epoch in range(resume_epoch, opt.niter):
                   % (i + 1, LIMIT_SAMPLES,
                      errD.data[0], errG_D.data[0], errG_l2.data[0], D_x, D_G_z1,))
             
-            vutils.save_image(real_cpu,
+            vutils.save_image(input_real.data,
                               'predict/' + str(opt.dataset) + '/' + str(i) + '_real.png')
             recon_image = input_cropped.clone()
             recon_image.data[:, :,
@@ -276,18 +275,10 @@ for epoch in range(resume_epoch, opt.niter):
             # print(l1)
             
             
-            real_center_np = (real_center.data.cpu().numpy() + 1) * 127.5
-            fake_np = (fake.data.cpu().numpy() + 1) * 127.5
-            real_cpu_np = (real_cpu.cpu().numpy() + 1) * 127.5
-            recon_image_np = (recon_image.data.cpu().numpy() + 1) * 127.5
-            
-            p = 0
-            total_p = 0
-            for j in range(opt.batchSize):
-                p += psnr(real_center_np[j].transpose(1, 2, 0), fake_np[j].transpose(1, 2, 0))
-                total_p += psnr(real_cpu_np[j].transpose(1, 2, 0), recon_image_np[j].transpose(1, 2, 0))
-            print("\t  PSNR per Patch: ", p / opt.batchSize)
-            print("\t  PSNR per Image: ", total_p / opt.batchSize)
+            p = batch_psnr((real_center.data + 1) * 127.5, (fake.data + 1) * 127.5).mean().item()
+            total_p = batch_psnr((input_real.data + 1) * 127.5, (recon_image.data + 1) * 127.5).mean().item()
+            print("\t  PSNR per Patch: ", p)
+            print("\t  PSNR per Image: ", total_p)
         
         
         else:
@@ -0,0 +1,155 @@
+'''
+Post-training static int8 quantization of a trained generator
+
+The BatchNorm layers of netG are folded into the convolutions (see deploy.py), then the conv and
+transposed-conv stack is quantized with FX graph mode: activation ranges are calibrated on a random
+sample of training patches (--calibration, an ImageFolder or a packed store). Transposed
+convolutions use per-tensor weight scales, per-channel ones are not supported by the quantized
+kernels.
+The quantized model is evaluated against the fp32 one on the healthy and unhealthy test patches
+used by test.py. It is rejected if the mean patch PSNR drops by more than --max_psnr_drop on any
+split, otherwise it is saved as TorchScript, usable with 'test.py --backend torchscript'.
+'''
+
+from __future__ import print_function
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data
+import torchvision.transforms as transforms
+from torch.ao.quantization import HistogramObserver, QConfig, default_weight_observer, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from batching import load_masked_batch
+from datasets import IndexedImageFolder, PackedImageDataset
+from deploy import fold_batchnorm, load_netG
+from metrics import batch_mse, batch_psnr
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--netG', default='netG_context_encoder.pth', help='netG checkpoint saved by train.py')
+parser.add_argument('--output', default='netG_context_encoder_int8.pt', help='path of the quantized TorchScript module')
+parser.add_argument('--calibration', default='dataset_lungs/train_randomPatches', help='training patches used for calibration')
+parser.add_argument('--calibration_batches', type=int, default=32, help='number of batches of patches used for calibration')
+parser.add_argument('--test_healthy', default='dataset_lungs/healthy880patch')
+parser.add_argument('--test_unhealthy', default='dataset_lungs/unhealthy880patch')
+parser.add_argument('--max_psnr_drop', type=float, default=0.5, help='largest mean patch PSNR loss (dB) accepted on each split')
+parser.add_argument('--qengine', default='fbgemm', help='quantized kernels: fbgemm or x86 on servers, qnnpack on ARM')
+parser.add_argument('--workers', type=int, default=2, help='number of data loading workers')
+parser.add_argument('--batchSize', type=int, default=64, help='input batch size')
+parser.add_argument('--imageSize', type=int, default=128, help='the height / width of the input image to network')
+parser.add_argument('--patchSize', type=int, default=64, help='the height / width of the patch to be reconstructed')
+parser.add_argument('--overlapPred', type=int, default=4, help='overlapping edges')
+parser.add_argument('--ndf', type=int, default=64)
+parser.add_argument('--nef', type=int, default=64, help='of encoder filters in first conv layer')
+parser.add_argument('--nc', type=int, default=1)
+parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
+parser.add_argument('--manualSeed', type=int, default=1234, help='manual seed')
+
+opt = parser.parse_args()
+print(opt)
+
+random.seed(opt.manualSeed)
+torch.manual_seed(opt.manualSeed)
+torch.backends.quantized.engine = opt.qengine
+
+transform = transforms.Compose([
+    transforms.Grayscale(),
+    transforms.ToTensor(),
+])
+
+
+def patches_loader(path, shuffle):
+    if os.path.exists(os.path.join(path, "index.json")):
+        dataset = PackedImageDataset(path)
+    else:
+        dataset = IndexedImageFolder(root=path, transform=transform)
+    return torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize, shuffle=shuffle,
+                                       num_workers=opt.workers)
+
+
+# Masked inputs and real centers of the batches of a loader
+def masked_batches(loader, limit=-1):
+    center = slice(int(opt.imageSize / 2 - opt.patchSize / 2), int(opt.imageSize / 2 + opt.patchSize / 2))
+    for i, (batch, _) in enumerate(loader):
+        if i == limit:
+            break
+        input_real, input_cropped = load_masked_batch(batch, torch.FloatTensor(), torch.FloatTensor(), opt)
+        yield input_cropped, input_real[:, :, center, center]
+
+
+# Mean patch PSNR and MSE of a model on a test split, as computed by test.py
+def evaluate(model, loader):
+    psnr = []
+    mse = []
+    with torch.no_grad():
+        for input_cropped, real_center in masked_batches(loader):
+            batch_mse_values = batch_mse(real_center * 255, model(input_cropped) * 255)
+            mse += batch_mse_values.tolist()
+            psnr += batch_psnr(None, None, batch_mse_values).tolist()
+    return np.mean(psnr), np.mean(mse)
+
+
+def latency(model, batch, repeats=5):
+    with torch.no_grad():
+        model(batch)
+        start = time.time()
+        for _ in range(repeats):
+            model(batch)
+    return (time.time() - start) / repeats
+
+
+def serialized_size(state):
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    return buffer.tell()
+
+
+netG = load_netG(opt.netG, opt)
+folded = fold_batchnorm(netG.main)
+for module in folded.modules():
+    if hasattr(module, 'inplace'):
+        module.inplace = False  # In-place activations are not supported by the quantized kernels
+
+qconfig_mapping = get_default_qconfig_mapping(opt.qengine)
+qconfig_mapping.set_object_type(nn.ConvTranspose2d, QConfig(activation=HistogramObserver.with_args(reduce_range=True),
+                                                             weight=default_weight_observer))
+
+print("Calibrating on", opt.calibration_batches, "batches of", opt.calibration)
+calibration = masked_batches(patches_loader(opt.calibration, True), opt.calibration_batches)
+example, _ = next(calibration)
+prepared = prepare_fx(folded, qconfig_mapping, (example,))
+with torch.no_grad():
+    prepared(example)
+    for input_cropped, _ in calibration:
+        prepared(input_cropped)
+quantized = convert_fx(prepared)
+
+rejected = False
+for split, path in (("HEALTHY", opt.test_healthy), ("UNHEALTHY", opt.test_unhealthy)):
+    loader = patches_loader(path, False)
+    psnr_fp32, mse_fp32 = evaluate(netG, loader)
+    psnr_int8, mse_int8 = evaluate(quantized, loader)
+    print('%s: PSNR per Patch fp32 %.4f int8 %.4f (%+.4f) | MSE per Patch fp32 %.4f int8 %.4f (%+.4f)'
+          % (split, psnr_fp32, psnr_int8, psnr_int8 - psnr_fp32, mse_fp32, mse_int8, mse_int8 - mse_fp32))
+    if psnr_fp32 - psnr_int8 > opt.max_psnr_drop:
+        rejected = True
+
+print('Latency per batch of %d: fp32 %.1fms, int8 %.1fms'
+      % (example.size(0), latency(netG, example) * 1000, latency(quantized, example) * 1000))
+print('Model size: fp32 %.1fMB, int8 %.1fMB'
+      % (serialized_size(netG.state_dict()) / 2. ** 20, serialized_size(quantized.state_dict()) / 2. ** 20))
+
+if rejected:
+    print("REJECTED: the int8 model loses more than", opt.max_psnr_drop, "dB of PSNR per patch")
+    sys.exit(1)
+
+with torch.no_grad():
+    torch.jit.save(torch.jit.freeze(torch.jit.trace(quantized, example).eval()), opt.output)
+print("Saved quantized model in", opt.output)
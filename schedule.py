@@ -0,0 +1,73 @@
+# Epochs of the phases of --freezeTraining: the generator is first trained alone with the L2 loss,
+# then the discriminator alone, then both with the adversarial loss
+GEN_EPOCHS = 2
+DISC_EPOCHS = 5
+
+
+# Networks a training step updates, and whether the loss of the generator has the adversarial term
+class StepPlan(object):
+    def __init__(self, update_D, update_G, adversarial):
+        self.update_D = update_D
+        self.update_G = update_G
+        self.adversarial = adversarial
+
+    # The step has nothing to do
+    def idle(self):
+        return not (self.update_D or self.update_G)
+
+    # The discriminator is run in the generator update
+    def needs_D_for_G(self):
+        return self.update_G and self.adversarial
+
+    # Forward and backward passes (D forwards, D backwards, G forwards, G backwards) of the step. The
+    # gradients of the adversarial loss of G are backpropagated through D. With fused_D the real and
+    # the fake batches go through D together.
+    def passes(self, fused_D=False):
+        d_step = 1 if fused_D else 2
+        d_passes = (d_step if self.update_D else 0) + (1 if self.needs_D_for_G() else 0)
+        return (d_passes, d_passes, 0 if self.idle() else 1, 1 if self.update_G else 0)
+
+
+# Decides at every step which networks are updated. With --freezeTraining the phases above are
+# followed, and within them D and G are updated every freeze_disc and freeze_gen steps. Passes that
+# are not needed are skipped, e.g. D is never run while the generator is pretrained alone.
+class UpdateSchedule(object):
+    def __init__(self, freeze_training=False, freeze_disc=1, freeze_gen=1, fused_D=False):
+        self.freeze_training = freeze_training
+        self.freeze_disc = max(1, freeze_disc)
+        self.freeze_gen = max(1, freeze_gen)
+        self.fused_D = fused_D
+        self.reset()
+
+    def phase(self, epoch):
+        if self.freeze_training and epoch < GEN_EPOCHS:
+            return 'generator'
+        if self.freeze_training and epoch < GEN_EPOCHS + DISC_EPOCHS:
+            return 'discriminator'
+        return 'joint'
+
+    def plan(self, epoch, i):
+        phase = self.phase(epoch)
+        plan = StepPlan(update_D=phase != 'generator' and i % self.freeze_disc == 0,
+                        update_G=phase != 'discriminator' and i % self.freeze_gen == 0,
+                        adversarial=phase == 'joint')
+        self.steps += 1
+        for k, (run, full) in enumerate(zip(plan.passes(self.fused_D), self.full_step)):
+            self.run[k] += run
+            self.full[k] += full
+        return plan
+
+    # Start counting the passes of a new epoch
+    def reset(self):
+        self.steps = 0
+        self.run = [0, 0, 0, 0]
+        self.full = [0, 0, 0, 0]
+        self.full_step = StepPlan(True, True, True).passes(self.fused_D)
+
+    # Passes run in the epoch against those of steps updating both networks
+    def report(self):
+        names = ('netD forward', 'netD backward', 'netG forward', 'netG backward')
+        saved = sum(self.full) - sum(self.run)
+        return ('Schedule: %d steps, passes run: ' % self.steps
+                + ', '.join('%s %d/%d' % (name, run, full) for name, run, full in zip(names, self.run, self.full))
+                + ' (%d skipped, %.0f%%)' % (saved, 100.0 * saved / max(1, sum(self.full))))
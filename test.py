@@ -17,10 +17,16 @@ import pickle
 import math
 import time
 import numpy as np
-from os import listdir
 
 from model import _netjointD, _netlocalD, _netG, _netmarginD
-from utils import plotter, generate_directories, psnr
+from utils import plotter, generate_directories
+from metrics import batch_measures, batch_psnr
+from image_transforms import RegionCrop, ToUInt8Tensor
+from batching import load_masked_batch
+from datasets import IndexedImageFolder
+from checkpoint import load as load_checkpoint
+from tiled_inpaint import LungROI, TiledInpainter
+from deploy import BACKENDS, load_backend
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
@@ -61,6 +67,15 @@ parser.add_argument('--randomCrop', action='store_true', help='Run experiment wi
 parser.add_argument('--N_randomCrop', type=int, default=10)
 parser.add_argument('--PAD_randomCrop', type=int, default=0)
 parser.add_argument('--CENTER_SIZE_randomCrop', type=int, default=768)
+parser.add_argument('--uint8Loader', action='store_true', help='loader workers return uint8 batches, converted to float once per batch')
+parser.add_argument('--backend', default='torch', choices=BACKENDS, help='inference backend of the generator')
+parser.add_argument('--backend_model', default='', help='generator exported by export.py for the torchscript and onnxruntime backends')
+parser.add_argument('--fullImages', default='', help='ImageFolder of full radiographs also evaluated with tiled inpainting')
+parser.add_argument('--bbox_csv', default='', help='lungs bounding boxes, full images are only reconstructed inside the lungs')
+parser.add_argument('--stride', type=int, default=32, help='stride of the grid of patches on the full images')
+parser.add_argument('--tileBatch', type=int, default=256, help='windows per generator forward pass on the full images')
+parser.add_argument('--adaptiveMSE', type=float, default=0, help='coarse patches MSE above which full images are scanned densely, 0 always scans densely')
+parser.add_argument('--coarseStride', type=int, default=64, help='stride of the coarse grid with --adaptiveMSE')
 
 parser.add_argument('--jointD', action='store_true', help='Discriminator joins Local and Global Discriminators')
 parser.add_argument('--fullyconn_size', type=int, default=1024, help='Size of the output of Local and Global Discriminator which will be joint in fully conntected layer')
@@ -174,22 +189,35 @@ cudnn.benchmark = True
 if torch.cuda.is_available() and not opt.cuda:
     print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
+# With --uint8Loader samples stay uint8 through the loader workers, see batching.copy_batch
+if opt.uint8Loader:
+    to_tensor = ToUInt8Tensor()
+else:
+    to_tensor = transforms.ToTensor()
+
 if opt.randomCrop:
-    transform = transforms.Compose([
-        transforms.Grayscale(),
-        transforms.Resize(opt.initialScaleTo),
-        transforms.CenterCrop(opt.CENTER_SIZE_randomCrop),
-        transforms.RandomCrop(opt.imageSize, opt.PAD_randomCrop),
-        transforms.ToTensor(),
-    ])
+    if opt.PAD_randomCrop == 0:
+        # Only the cropped region of the radiograph is converted and resampled
+        transform = transforms.Compose([
+            RegionCrop(opt.initialScaleTo, opt.CENTER_SIZE_randomCrop, opt.imageSize),
+            to_tensor,
+        ])
+    else:
+        transform = transforms.Compose([
+            transforms.Grayscale(),
+            transforms.Resize(opt.initialScaleTo),
+            transforms.CenterCrop(opt.CENTER_SIZE_randomCrop),
+            transforms.RandomCrop(opt.imageSize, opt.PAD_randomCrop),
+            to_tensor,
+        ])
     transform_original = transforms.Compose([
         transforms.Grayscale(),
         transforms.Resize(opt.initialScaleTo),
-        transforms.ToTensor(),
+        to_tensor,
     ])
     transform_randomPatches = transforms.Compose([
         transforms.Grayscale(),
-        transforms.ToTensor(),
+        to_tensor,
     ])
     # datasets = []
     # test_datasets = []
@@ -201,9 +229,9 @@ if opt.randomCrop:
     # test_dataset = torch.utils.data.ConcatDataset(test_datasets)
     
     # dataset = dset.ImageFolder(root='dataset_lungs/train_randomPatches', transform=transform_randomPatches)
-    test_healthy = dset.ImageFolder(root=TEST_HEALTHY, transform=transform_randomPatches)
-    test_unhealthy = dset.ImageFolder(root=TEST_UNHEALTHY, transform=transform_randomPatches)
-    test_patches = dset.ImageFolder(root=TEST_PATCHES, transform=transform_randomPatches)
+    test_healthy = IndexedImageFolder(root=TEST_HEALTHY, transform=transform_randomPatches)
+    test_unhealthy = IndexedImageFolder(root=TEST_UNHEALTHY, transform=transform_randomPatches)
+    test_patches = IndexedImageFolder(root=TEST_PATCHES, transform=transform_randomPatches)
     
     # test_original = dset.ImageFolder(root='dataset_lungs/test_64', transform=transform_original)
     # test_original_dataloader = torch.utils.data.DataLoader(test_original, batch_size=opt.batchSize,
@@ -211,13 +239,11 @@ if opt.randomCrop:
 
 else:
     transform = transforms.Compose([
-        transforms.Grayscale(),
-        transforms.Resize(opt.initialScaleTo),
-        transforms.CenterCrop(opt.imageSize),
-        transforms.ToTensor(),
+        RegionCrop(opt.initialScaleTo, opt.imageSize, opt.imageSize),
+        to_tensor,
     ])
-    dataset = dset.ImageFolder(root='dataset_lungs/train', transform=transform)
-    test_dataset = dset.ImageFolder(root='dataset_lungs/test_64', transform=transform)
+    dataset = IndexedImageFolder(root='dataset_lungs/train', transform=transform)
+    test_dataset = IndexedImageFolder(root='dataset_lungs/test_64', transform=transform)
 
 # assert dataset
 # dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize,
@@ -265,24 +291,15 @@ def save_single_image(image, path_to_save, name):
 #     vutils.save_image(image.data,
 #                       PATHS["train"] + '/epoch_%03d_' % epoch +  str(time.time()) +'.png')
 
-def recursive_image_finder(path, images_list):
-    file_list = listdir(path)
-    for f in file_list:
-        if ".png" not in f:
-            images_list = recursive_image_finder(path + "/" + f, images_list)
-        else:
-            images_list.append((f.replace(".png", "")))
-    
-    return images_list
-
 resume_epoch = 0
 
 netG = _netG(opt)
 netG.apply(weights_init)
 if opt.continueTraining:
     print("Loading model netG from: ", PATHS["netG"])
-    netG.load_state_dict(torch.load(PATHS["netG"], map_location=lambda storage, location: storage)['state_dict'])
-    resume_epoch = torch.load(PATHS["netG"])['epoch']
+    checkpointG = load_checkpoint(PATHS["netG"])
+    netG.load_state_dict(checkpointG['state_dict'])
+    resume_epoch = checkpointG['epoch']
 print(netG)
 
 if opt.jointD:
@@ -295,8 +312,9 @@ netD.apply(weights_init)
 
 if opt.continueTraining:
     print("Loading model netD from: ", PATHS["netD"])
-    netD.load_state_dict(torch.load(PATHS["netD"], map_location=lambda storage, location: storage)['state_dict'])
-    resume_epoch = torch.load(PATHS["netD"])['epoch']
+    checkpointD = load_checkpoint(PATHS["netD"])
+    netD.load_state_dict(checkpointD['state_dict'])
+    resume_epoch = checkpointD['epoch']
 print(netD)
 
 print("\n")
@@ -353,6 +371,9 @@ real_center_plus_margin = Variable(real_center_plus_margin)
 netG.eval()
 netD.eval()
 
+# Reconstructions go through the selected backend, eager netG by default
+generator = load_backend(opt.backend, opt.backend_model, netG)
+
 print("Starting testing in 3s...")
 time.sleep(3)
 
@@ -367,12 +388,10 @@ PSNR_UNHEALTHY = opt.output + "/UNHEALTHY_PSNRs.txt"
 PSNR_PATCHES = opt.output + "/PATCHES_PSNRs.txt"
 
 
-names_healthy = recursive_image_finder(TEST_HEALTHY, [])
-names_unhealthy = recursive_image_finder(TEST_UNHEALTHY, [])
-names_patches = recursive_image_finder(TEST_PATCHES, [])
-names_healthy.sort()
-names_unhealthy.sort()
-names_patches.sort()
+# Sample names in dataset order, from the cached file indexes
+names_healthy = test_healthy.names()
+names_unhealthy = test_unhealthy.names()
+names_patches = test_patches.names()
 # print(len(names_patches), len(names_healthy), len(names_unhealthy))
 
 
@@ -392,63 +411,40 @@ with open(PSNR_PATCHES, "w") as myfile:
 print("Testing healthy images...")
 tot_psnr_patch_healthy = []
 tot_psnr_image_healthy = []
+tot_mse_patch_healthy = []
+tot_ssim_patch_healthy = []
 
 for i, data in enumerate(healthy_dataloader, 0):
     real_cpu, _ = data
-    real_center_cpu = real_cpu[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
-                      int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
     batch_size = real_cpu.size(0)
-    input_real.data.resize_(real_cpu.size()).copy_(real_cpu)
-    input_cropped.data.resize_(real_cpu.size()).copy_(real_cpu)
-    real_center.data.resize_(real_center_cpu.size()).copy_(real_center_cpu)
-    input_cropped.data[:, 0,
-    int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-        opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-    int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-        opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
-    if opt.nc > 1:
-        input_cropped.data[:, 1,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 104.0 / 255.0 - 1.0
-        input_cropped.data[:, 2,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 123.0 / 255.0 - 1.0
-
-    fake = netG(input_cropped)
+    load_masked_batch(real_cpu, input_real.data, input_cropped.data, opt)
+    real_center_batch = input_real.data[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
+                                     int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
+    real_center.data.resize_(real_center_batch.size()).copy_(real_center_batch)
+
+    fake = generator(input_cropped)
     recon_image = input_cropped.clone()
     recon_image.data[:, :,
     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
     
-    # print(real_center.data[0,0,0:2,:])
-    # input()
-    # print(np.amin(real_center.data.cpu().numpy()), np.amax(real_center.data.cpu().numpy()))
-    real_center_np = (real_center.data.cpu().numpy()) * 255
-    fake_np = (fake.data.cpu().numpy()) * 255
-    real_cpu_np = (real_cpu.cpu().numpy()) * 255
-    recon_image_np = (recon_image.data.cpu().numpy())* 255
-    # print(real_center_np[0,0,0:2,:])
-    # input()
+    # Compute measures for the whole batch at once
+    mse_patch, psnr_patch, ssim_patch = batch_measures(real_center.data * 255, fake.data * 255)
+    psnr_image = batch_psnr(input_real.data * 255, recon_image.data * 255)
+    mse_patch, psnr_patch, ssim_patch, psnr_image = \
+        mse_patch.tolist(), psnr_patch.tolist(), ssim_patch.tolist(), psnr_image.tolist()
+    
+    with open(PSNR_HEALTHY, "a") as myfile:
+        for j in range(len(psnr_patch)):
+            myfile.write('\n\t[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f | MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                         % (j + opt.batchSize * i, psnr_patch[j], psnr_image[j], mse_patch[j], ssim_patch[j]))
+            save_single_image(input_real.data[j], OUT_HEALTHY, names_healthy[j + opt.batchSize * i] + "_" + "real")
+            save_single_image(recon_image.data[j], OUT_HEALTHY, names_healthy[j + opt.batchSize * i] + "_" + "recon")
     
-    # Compute PSNR
-    p = 0
-    total_p = 0
-    for j in range(real_center_np.shape[0]):
-        this_p = psnr(real_center_np[j].transpose(1, 2, 0), fake_np[j].transpose(1, 2, 0))
-        this_total_p = psnr(real_cpu_np[j].transpose(1, 2, 0), recon_image_np[j].transpose(1, 2, 0))
-        with open(PSNR_HEALTHY, "a") as myfile:
-            myfile.write('\n\t[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f'
-                  % (j + opt.batchSize*i, this_p, this_total_p))
-        # print('[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f' % (j + opt.batchSize*i, this_p, this_total_p))
-        save_single_image(real_cpu[j], OUT_HEALTHY, names_healthy[j + opt.batchSize*i] + "_" + "real")
-        save_single_image(recon_image.data[j], OUT_HEALTHY, names_healthy[j + opt.batchSize*i] + "_" + "recon")
-        
-        tot_psnr_patch_healthy.append(this_p)
-        tot_psnr_image_healthy.append(this_total_p)
+    tot_psnr_patch_healthy += psnr_patch
+    tot_psnr_image_healthy += psnr_image
+    tot_mse_patch_healthy += mse_patch
+    tot_ssim_patch_healthy += ssim_patch
     
     
 
@@ -458,58 +454,40 @@ print("Testing unhealthy images...")
 
 tot_psnr_patch_unhealthy = []
 tot_psnr_image_unhealthy = []
+tot_mse_patch_unhealthy = []
+tot_ssim_patch_unhealthy = []
 
 for i, data in enumerate(unhealthy_dataloader, 0):
     real_cpu, _ = data
-    real_center_cpu = real_cpu[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
-                      int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
     batch_size = real_cpu.size(0)
-    input_real.data.resize_(real_cpu.size()).copy_(real_cpu)
-    input_cropped.data.resize_(real_cpu.size()).copy_(real_cpu)
-    real_center.data.resize_(real_center_cpu.size()).copy_(real_center_cpu)
-    input_cropped.data[:, 0,
-    int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-        opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-    int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-        opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
-    if opt.nc > 1:
-        input_cropped.data[:, 1,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 104.0 / 255.0 - 1.0
-        input_cropped.data[:, 2,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 123.0 / 255.0 - 1.0
-
-    fake = netG(input_cropped)
+    load_masked_batch(real_cpu, input_real.data, input_cropped.data, opt)
+    real_center_batch = input_real.data[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
+                                     int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
+    real_center.data.resize_(real_center_batch.size()).copy_(real_center_batch)
+
+    fake = generator(input_cropped)
     recon_image = input_cropped.clone()
     recon_image.data[:, :,
     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
 
-    real_center_np = (real_center.data.cpu().numpy()) * 255
-    fake_np = (fake.data.cpu().numpy()) * 255
-    real_cpu_np = (real_cpu.cpu().numpy()) * 255
-    recon_image_np = (recon_image.data.cpu().numpy()) * 255
-
-    # Compute PSNR
-    p = 0
-    total_p = 0
-    for j in range(real_center_np.shape[0]):
-        this_p = psnr(real_center_np[j].transpose(1, 2, 0), fake_np[j].transpose(1, 2, 0))
-        this_total_p = psnr(real_cpu_np[j].transpose(1, 2, 0), recon_image_np[j].transpose(1, 2, 0))
-        with open(PSNR_UNHEALTHY, "a") as myfile:
-            myfile.write('\n\t[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f'
-                         % (j + opt.batchSize*i, this_p, this_total_p))
-        # print('[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f' % ((j + opt.batchSize*i), this_p, this_total_p))
-        save_single_image(real_cpu[j], OUT_UNHEALTHY, names_unhealthy[j + opt.batchSize*i] + "_" + "real")
-        save_single_image(recon_image.data[j], OUT_UNHEALTHY, names_unhealthy[j + opt.batchSize*i] + "_" + "recon")
-
-        tot_psnr_patch_unhealthy.append(this_p)
-        tot_psnr_image_unhealthy.append(this_total_p)
+    # Compute measures for the whole batch at once
+    mse_patch, psnr_patch, ssim_patch = batch_measures(real_center.data * 255, fake.data * 255)
+    psnr_image = batch_psnr(input_real.data * 255, recon_image.data * 255)
+    mse_patch, psnr_patch, ssim_patch, psnr_image = \
+        mse_patch.tolist(), psnr_patch.tolist(), ssim_patch.tolist(), psnr_image.tolist()
+    
+    with open(PSNR_UNHEALTHY, "a") as myfile:
+        for j in range(len(psnr_patch)):
+            myfile.write('\n\t[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f | MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                         % (j + opt.batchSize * i, psnr_patch[j], psnr_image[j], mse_patch[j], ssim_patch[j]))
+            save_single_image(input_real.data[j], OUT_UNHEALTHY, names_unhealthy[j + opt.batchSize * i] + "_" + "real")
+            save_single_image(recon_image.data[j], OUT_UNHEALTHY, names_unhealthy[j + opt.batchSize * i] + "_" + "recon")
+    
+    tot_psnr_patch_unhealthy += psnr_patch
+    tot_psnr_image_unhealthy += psnr_image
+    tot_mse_patch_unhealthy += mse_patch
+    tot_ssim_patch_unhealthy += ssim_patch
 
 
 
@@ -518,63 +496,40 @@ for i, data in enumerate(unhealthy_dataloader, 0):
 print("Testing patches images...")
 tot_psnr_patch_patches = []
 tot_psnr_image_patches = []
+tot_mse_patch_patches = []
+tot_ssim_patch_patches = []
 
 for i, data in enumerate(patches_dataloader, 0):
     real_cpu, _ = data
-    real_center_cpu = real_cpu[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
-                      int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
     batch_size = real_cpu.size(0)
-    input_real.data.resize_(real_cpu.size()).copy_(real_cpu)
-    input_cropped.data.resize_(real_cpu.size()).copy_(real_cpu)
-    real_center.data.resize_(real_center_cpu.size()).copy_(real_center_cpu)
-    input_cropped.data[:, 0,
-    int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-        opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-    int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-        opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
-    if opt.nc > 1:
-        input_cropped.data[:, 1,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 104.0 / 255.0 - 1.0
-        input_cropped.data[:, 2,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 123.0 / 255.0 - 1.0
+    load_masked_batch(real_cpu, input_real.data, input_cropped.data, opt)
+    real_center_batch = input_real.data[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
+                                     int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
+    real_center.data.resize_(real_center_batch.size()).copy_(real_center_batch)
     
-    fake = netG(input_cropped)
+    fake = generator(input_cropped)
     recon_image = input_cropped.clone()
     recon_image.data[:, :,
     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
     
-    # print(real_center.data[0,0,0:2,:])
-    # input()
-    # print(np.amin(real_center.data.cpu().numpy()), np.amax(real_center.data.cpu().numpy()))
-    real_center_np = (real_center.data.cpu().numpy()) * 255
-    fake_np = (fake.data.cpu().numpy()) * 255
-    real_cpu_np = (real_cpu.cpu().numpy()) * 255
-    recon_image_np = (recon_image.data.cpu().numpy()) * 255
-    # print(real_center_np[0,0,0:2,:])
-    # input()
+    # Compute measures for the whole batch at once
+    mse_patch, psnr_patch, ssim_patch = batch_measures(real_center.data * 255, fake.data * 255)
+    psnr_image = batch_psnr(input_real.data * 255, recon_image.data * 255)
+    mse_patch, psnr_patch, ssim_patch, psnr_image = \
+        mse_patch.tolist(), psnr_patch.tolist(), ssim_patch.tolist(), psnr_image.tolist()
     
-    # Compute PSNR
-    p = 0
-    total_p = 0
-    for j in range(real_center_np.shape[0]):
-        this_p = psnr(real_center_np[j].transpose(1, 2, 0), fake_np[j].transpose(1, 2, 0))
-        this_total_p = psnr(real_cpu_np[j].transpose(1, 2, 0), recon_image_np[j].transpose(1, 2, 0))
-        with open(PSNR_PATCHES, "a") as myfile:
-            myfile.write('\n\t[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f'
-                         % (j + opt.batchSize * i, this_p, this_total_p))
-        # print('[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f' % (j + opt.batchSize*i, this_p, this_total_p))
-        save_single_image(real_cpu[j], OUT_PATCHES, names_patches[j + opt.batchSize * i] + "_" + "real")
-        save_single_image(recon_image.data[j], OUT_PATCHES, names_patches[j + opt.batchSize * i] + "_" + "recon")
-        
-        tot_psnr_patch_patches.append(this_p)
-        tot_psnr_image_patches.append(this_total_p)
+    with open(PSNR_PATCHES, "a") as myfile:
+        for j in range(len(psnr_patch)):
+            myfile.write('\n\t[Image %d] PSNR per Patch: %.4f | PSNR per Image: %.4f | MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                         % (j + opt.batchSize * i, psnr_patch[j], psnr_image[j], mse_patch[j], ssim_patch[j]))
+            save_single_image(input_real.data[j], OUT_PATCHES, names_patches[j + opt.batchSize * i] + "_" + "real")
+            save_single_image(recon_image.data[j], OUT_PATCHES, names_patches[j + opt.batchSize * i] + "_" + "recon")
+    
+    tot_psnr_patch_patches += psnr_patch
+    tot_psnr_image_patches += psnr_image
+    tot_mse_patch_patches += mse_patch
+    tot_ssim_patch_patches += ssim_patch
 
 
 
@@ -619,7 +574,86 @@ with open(PSNR_TOTAL, "a") as myfile:
     myfile.write('\nTOTAL STD PSNRs: PSNR per Patch: %.4f | PSNR per Image: %.4f'
                  % (np.std(np.array(tot_psnr_patch_unhealthy + tot_psnr_patch_healthy)),
                     np.std(np.array(tot_psnr_image_unhealthy + tot_psnr_image_healthy))))
+
+with open(PSNR_TOTAL, "a") as myfile:
+    myfile.write('\n\nHEALTHY MEAN MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.mean(tot_mse_patch_healthy), np.mean(tot_ssim_patch_healthy)))
+    myfile.write('\nUNHEALTHY MEAN MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.mean(tot_mse_patch_unhealthy), np.mean(tot_ssim_patch_unhealthy)))
+    myfile.write('\nPATCHES MEAN MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.mean(tot_mse_patch_patches), np.mean(tot_ssim_patch_patches)))
+    myfile.write('\nTOTAL MEAN MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.mean(tot_mse_patch_healthy + tot_mse_patch_unhealthy),
+                    np.mean(tot_ssim_patch_healthy + tot_ssim_patch_unhealthy)))
+
+with open(PSNR_TOTAL, "a") as myfile:
+    myfile.write('\n\nHEALTHY STD MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.std(tot_mse_patch_healthy), np.std(tot_ssim_patch_healthy)))
+    myfile.write('\nUNHEALTHY STD MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.std(tot_mse_patch_unhealthy), np.std(tot_ssim_patch_unhealthy)))
+    myfile.write('\nPATCHES STD MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.std(tot_mse_patch_patches), np.std(tot_ssim_patch_patches)))
+    myfile.write('\nTOTAL STD MSE/SSIM: MSE per Patch: %.4f | SSIM per Patch: %.4f'
+                 % (np.std(tot_mse_patch_healthy + tot_mse_patch_unhealthy),
+                    np.std(tot_ssim_patch_healthy + tot_ssim_patch_unhealthy)))
+
+
+# FULL IMAGES TEST
+if opt.fullImages != '':
+    print("Testing full images...")
+    OUT_FULL = opt.output + "full/"
+    PSNR_FULL = opt.output + "/FULL_PSNRs.txt"
+    try:
+        os.makedirs(OUT_FULL)
+    except OSError:
+        pass
+    
+    full_images = IndexedImageFolder(root=opt.fullImages, transform=transforms.Compose([
+        transforms.Grayscale(),
+        transforms.Resize(opt.initialScaleTo),
+        transforms.ToTensor(),
+    ]))
+    names_full = full_images.names()
+    full_dataloader = torch.utils.data.DataLoader(full_images, batch_size=1, shuffle=False,
+                                                  num_workers=int(opt.test_workers))
+    
+    inpainter = TiledInpainter(generator, opt.imageSize, opt.patchSize, opt.overlapPred, opt.stride, opt.tileBatch,
+                               'cuda' if opt.cuda else 'cpu')
+    roi = None
+    if opt.bbox_csv != '':
+        roi = LungROI(opt.bbox_csv, opt.patchSize, opt.stride)
     
+    tot_psnr_full = []
+    tot_mse_full = []
+    forward_passes = 0
+    dense_passes = 0
+    items = ((names_full[k], image[0]) for k, (image, _) in enumerate(full_dataloader))
+    if opt.adaptiveMSE > 0:
+        results = inpainter.inpaint_adaptive(items, opt.adaptiveMSE, opt.coarseStride, roi)
+    else:
+        results = inpainter.inpaint(items, roi)
+    with open(PSNR_FULL, "w") as myfile:
+        for k, (name, result) in enumerate(results):
+            mse = result.mse()
+            psnr = 100 if mse == 0 else 20 * math.log10(255.0 / math.sqrt(mse))
+            forward_passes += result.forward_passes
+            dense_passes += len(inpainter.grid(*result.image.shape[-2:]))
+            myfile.write('\n\t[Image %d] PSNR: %.4f | MSE: %.4f | Windows: %d'
+                         % (k, psnr, mse, result.forward_passes))
+            save_single_image(result.reconstruction, OUT_FULL, name + "_recon")
+            save_single_image(result.difference(), OUT_FULL, name + "_diff")
+            tot_psnr_full.append(psnr)
+            tot_mse_full.append(mse)
+    
+    with open(PSNR_TOTAL, "a") as myfile:
+        myfile.write('\n\nFULL IMAGES MEAN PSNR/MSE: PSNR: %.4f | MSE: %.4f'
+                     % (np.mean(tot_psnr_full), np.mean(tot_mse_full)))
+        myfile.write('\nFULL IMAGES STD PSNR/MSE: PSNR: %.4f | MSE: %.4f'
+                     % (np.std(tot_psnr_full), np.std(tot_mse_full)))
+        myfile.write('\nFULL IMAGES WINDOWS: %d, %d for a dense scan of the whole images (%d forward passes saved)'
+                     % (forward_passes, dense_passes, dense_passes - forward_passes))
+    print("Full images:", forward_passes, "windows,", dense_passes, "for a dense scan of the whole images")
+
 
 print("Done, see results in ", opt.output)
 
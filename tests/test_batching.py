@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import unittest
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import AssembledBatch, BatchGeometry
+
+
+class AssembledBatchSplitTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        opt = argparse.Namespace(imageSize=32, patchSize=16, overlapPred=2, patch_with_margin_size=20, nc=1)
+        self.batch = AssembledBatch(torch.rand(10, 1, 32, 32), BatchGeometry(opt))
+        # Generator stand-in without batch statistics, mapping the masked input to the center
+        self.net = nn.Sequential(nn.Conv2d(1, 4, 3, padding=1), nn.ReLU(), nn.Conv2d(4, 1, 3, padding=1),
+                                 nn.AdaptiveAvgPool2d(16))
+
+    def loss(self, batch):
+        _, cropped, center, _ = batch.tensors
+        return nn.functional.mse_loss(self.net(cropped), center)
+
+    def gradients(self):
+        return [p.grad.clone() for p in self.net.parameters()]
+
+    # Weighted by their share of the batch, as in train.py, the losses and the accumulated gradients of
+    # the micro-batches are those of the full batch, also when they are of different sizes
+    def test_weighted_micro_batches_equal_the_full_batch(self):
+        self.net.zero_grad()
+        full = self.loss(self.batch)
+        full.backward()
+        full_gradients = self.gradients()
+
+        for n in (1, 2, 3, 4):
+            parts = self.batch.split(n)
+            self.assertEqual(sum(part.size(0) for part in parts), self.batch.size(0))
+            self.net.zero_grad()
+            total = 0
+            for part in parts:
+                weight = part.size(0) / float(self.batch.size(0))
+                loss = self.loss(part)
+                (weight * loss).backward()
+                total += weight * loss.item()
+            self.assertAlmostEqual(total, full.item(), places=6)
+            for accumulated, expected in zip(self.gradients(), full_gradients):
+                self.assertTrue(torch.allclose(accumulated, expected, atol=1e-6))
+
+    def test_split_views_the_batch(self):
+        parts = self.batch.split(3)
+        self.assertEqual([part.size(0) for part in parts], [4, 4, 2])
+        for k in range(4):
+            self.assertTrue(torch.equal(torch.cat([part.tensors[k] for part in parts]), self.batch.tensors[k]))
+
+
+if __name__ == '__main__':
+    unittest.main()
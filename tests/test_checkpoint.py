@@ -0,0 +1,78 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import checkpoint
+
+
+class CheckpointWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = dict((name, os.path.join(self.directory, name + ".pth")) for name in ("netG", "netD", "state"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Save a generation of netG and netD with the given value, committed unless commit=False
+    def save_generation(self, writer, value, commit=True):
+        weights = torch.full((3, 3), float(value))
+        writer.save({'epoch': value, 'state_dict': {'weight': weights}}, self.paths["netG"])
+        writer.save((value, [value] * 3), self.paths["netD"], use_pickle=True)
+        # Updated in place after save(), the queued snapshot must not see it
+        weights.add_(100)
+        if commit:
+            writer.commit({'epoch': value}, self.paths["state"])
+
+    def test_flush_writes_complete_files(self):
+        writer = checkpoint.CheckpointWriter()
+        for value in range(3):
+            self.save_generation(writer, value)
+        writer.close()
+
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["netD.pth", "netD.pth.prev", "netG.pth", "netG.pth.prev", "state.pth"])
+        state = checkpoint.load_generation(self.paths["state"])
+        self.assertEqual(state['epoch'], 2)
+        self.assertEqual(sorted(state['files']), ["netD.pth", "netG.pth"])
+        netG = checkpoint.load(self.paths["netG"])
+        self.assertEqual(netG['epoch'], 2)
+        self.assertTrue(torch.equal(netG['state_dict']['weight'], torch.full((3, 3), 2.0)))
+
+        umask = os.umask(0)
+        os.umask(umask)
+        for name in os.listdir(self.directory):
+            mode = stat.S_IMODE(os.stat(os.path.join(self.directory, name)).st_mode)
+            self.assertEqual(mode, 0o666 & ~umask)
+
+    def test_interrupted_generation_is_rolled_back(self):
+        writer = checkpoint.CheckpointWriter()
+        self.save_generation(writer, 1)
+        self.save_generation(writer, 2, commit=False)
+        writer.close()
+
+        self.assertEqual(checkpoint.load(self.paths["netG"])['epoch'], 2)
+        state = checkpoint.load_generation(self.paths["state"])
+        self.assertEqual(state['epoch'], 1)
+        self.assertEqual(checkpoint.load(self.paths["netG"])['epoch'], 1)
+        for name in ("netG", "netD"):
+            self.assertEqual(checkpoint.file_digest(self.paths[name]), state['files'][name + ".pth"])
+
+    def test_file_of_another_generation_is_refused(self):
+        writer = checkpoint.CheckpointWriter()
+        self.save_generation(writer, 1)
+        writer.close()
+
+        torch.save({'epoch': 7}, self.paths["netG"])
+        with self.assertRaises(RuntimeError):
+            checkpoint.load_generation(self.paths["state"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_transforms import RegionCrop
+
+
+class RegionCropTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Smooth gradients with noise, so that a shifted window would not match
+        y, x = np.mgrid[0:1024, 0:1024]
+        pixels = (x * 0.1 + y * 0.15 + rng.rand(1024, 1024) * 40) % 256
+        self.gray = Image.fromarray(pixels.astype(np.uint8))
+        self.rgb = Image.fromarray(np.stack([pixels, pixels[::-1], pixels.T], 2).astype(np.uint8))
+
+    # Crops of RegionCrop and of the chained transforms with the same seeds, as uint8 arrays
+    def crops(self, image, scale_to, center_size, crop_size, seeds=range(5)):
+        chain = transforms.Compose([
+            transforms.Grayscale(),
+            transforms.Resize(scale_to),
+            transforms.CenterCrop(center_size),
+            transforms.RandomCrop(crop_size),
+        ])
+        region = RegionCrop(scale_to, center_size, crop_size)
+        for seed in seeds:
+            torch.manual_seed(seed)
+            expected = np.asarray(chain(image), dtype=np.int16)
+            after_chain = torch.randint(0, 1000, size=(1,)).item()
+            torch.manual_seed(seed)
+            actual = np.asarray(region(image), dtype=np.int16)
+            # Same random draws, so the same window
+            self.assertEqual(torch.randint(0, 1000, size=(1,)).item(), after_chain)
+            yield expected, actual
+
+    def assert_within_one_gray_level(self, image, scale_to, center_size, crop_size):
+        for expected, actual in self.crops(image, scale_to, center_size, crop_size):
+            self.assertEqual(actual.shape, (crop_size, crop_size))
+            self.assertLessEqual(np.abs(expected - actual).max(), 1)
+
+    def test_without_resize(self):
+        self.assert_within_one_gray_level(self.gray, 1024, 768, 128)
+
+    def test_with_resize(self):
+        self.assert_within_one_gray_level(self.gray, 512, 384, 128)
+
+    def test_rgb_with_resize(self):
+        self.assert_within_one_gray_level(self.rgb, 600, 400, 128)
+
+    def test_center_crop_only(self):
+        self.assert_within_one_gray_level(self.gray, 512, 128, 128)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+import torch
+import torch.utils.data
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datasets import ResumableSampler
+
+
+class ResumableSamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.dataset = torch.utils.data.TensorDataset(torch.arange(50))
+
+    # Sampler of a freshly started process, at the given epoch
+    def sampler(self, epoch, rank=0, num_replicas=1, seed=3):
+        sampler = ResumableSampler(self.dataset, num_replicas=num_replicas, rank=rank, seed=seed)
+        sampler.set_epoch(epoch)
+        return sampler
+
+    # Batches of sample indices of a loader over the sampler
+    def batches(self, sampler, batch_size=4):
+        loader = torch.utils.data.DataLoader(self.dataset, batch_size=batch_size, sampler=sampler)
+        return [batch[0].tolist() for batch in loader]
+
+    def test_order_is_the_same_after_a_restart(self):
+        self.assertEqual(list(self.sampler(2)), list(self.sampler(2)))
+        self.assertNotEqual(list(self.sampler(2)), list(self.sampler(3)))
+        self.assertEqual(sorted(self.sampler(2)), list(range(50)))
+
+    def test_restart_skips_the_trained_batches(self):
+        epoch = self.batches(self.sampler(1))
+        for step in (0, 1, 5, len(epoch) - 1, len(epoch)):
+            restarted = self.sampler(1)
+            # As train.py does with the step saved in the checkpoint
+            restarted.set_start(step * 4)
+            self.assertEqual(epoch[:step] + self.batches(restarted), epoch)
+
+    def test_start_only_applies_to_the_next_iteration(self):
+        sampler = self.sampler(1)
+        full = list(sampler)
+        sampler.set_start(7)
+        self.assertEqual(list(sampler), full[7:])
+        self.assertEqual(list(sampler), full)
+
+    def test_restarted_shards_cover_the_epoch(self):
+        samples = []
+        for rank in range(2):
+            sampler = self.sampler(4, rank, num_replicas=2)
+            trained = list(sampler)[:6]
+            restarted = self.sampler(4, rank, num_replicas=2)
+            restarted.set_start(6)
+            samples += trained + list(restarted)
+        self.assertEqual(sorted(samples), list(range(50)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from schedule import DISC_EPOCHS, GEN_EPOCHS, UpdateSchedule
+
+
+class UpdateScheduleTest(unittest.TestCase):
+    # (update_D, update_G, adversarial) of the first steps of an epoch
+    def plans(self, schedule, epoch, steps=4):
+        plans = [schedule.plan(epoch, i) for i in range(steps)]
+        return [(p.update_D, p.update_G, p.adversarial) for p in plans]
+
+    def test_joint_training_updates_both_every_step(self):
+        schedule = UpdateSchedule()
+        self.assertEqual(self.plans(schedule, 0), [(True, True, True)] * 4)
+        self.assertEqual(schedule.run, schedule.full)
+
+    def test_freeze_training_phases(self):
+        schedule = UpdateSchedule(freeze_training=True)
+        self.assertEqual(self.plans(schedule, GEN_EPOCHS - 1, 1), [(False, True, False)])
+        self.assertEqual(self.plans(schedule, GEN_EPOCHS, 1), [(True, False, False)])
+        self.assertEqual(self.plans(schedule, GEN_EPOCHS + DISC_EPOCHS, 1), [(True, True, True)])
+
+    def test_updates_every_freeze_steps(self):
+        schedule = UpdateSchedule(freeze_disc=2, freeze_gen=3)
+        self.assertEqual([p[:2] for p in self.plans(schedule, 0, 6)],
+                         [(True, True), (False, False), (True, False), (False, True), (True, False), (False, False)])
+
+    def test_skipped_passes_are_counted(self):
+        schedule = UpdateSchedule(freeze_training=True)
+        # Generator pretraining: netD is never run, netG once forward and once backward per step
+        self.plans(schedule, 0, 5)
+        self.assertEqual(schedule.steps, 5)
+        self.assertEqual(schedule.run, [0, 0, 5, 5])
+        self.assertEqual(schedule.full, [15, 15, 5, 5])
+        schedule.reset()
+        self.assertEqual((schedule.steps, schedule.run, schedule.full), (0, [0, 0, 0, 0], [0, 0, 0, 0]))
+
+    def test_fused_D_runs_D_once_per_update(self):
+        self.assertEqual(UpdateSchedule(fused_D=True).plan(0, 0).passes(True), (2, 2, 1, 1))
+        self.assertEqual(UpdateSchedule().plan(0, 0).passes(), (3, 3, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
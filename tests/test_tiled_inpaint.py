@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tiled_inpaint import TiledInpainter
+
+
+# Generator reconstructing every patch as black
+class _BlackGenerator(nn.Module):
+    def forward(self, windows):
+        return torch.zeros_like(windows[:, :, 32:96, 32:96])
+
+
+class TiledInpainterTest(unittest.TestCase):
+    def setUp(self):
+        self.read = []
+
+    # Stream of images counting the images read
+    def images(self, n, size=256):
+        for k in range(n):
+            self.read.append(k)
+            yield k, torch.full((1, size, size), 0.5)
+
+    # Healthy images have no flagged coarse patch, so no fine patch: every result is handed back before
+    # the next image is read, instead of waiting for a fine batch that never fills
+    def test_adaptive_streams_healthy_images(self):
+        # 16 coarse patches per 256 x 256 image fill exactly one batch
+        inpainter = TiledInpainter(_BlackGenerator(), batch_size=16)
+        keys = []
+        for key, result in inpainter.inpaint_adaptive(self.images(5), threshold=float('inf')):
+            self.assertEqual(self.read, list(range(key + 1)))
+            self.assertEqual(result.forward_passes, 16)
+            keys.append(key)
+        self.assertEqual(keys, list(range(5)))
+
+    def test_inpaint_streams_images_without_tiles(self):
+        inpainter = TiledInpainter(_BlackGenerator(), batch_size=256)
+        for key, result in inpainter.inpaint(self.images(3), lambda key, image: []):
+            self.assertEqual(self.read, list(range(key + 1)))
+            self.assertFalse(result.coverage.any())
+
+    def test_adaptive_dense_tiles(self):
+        inpainter = TiledInpainter(_BlackGenerator(), batch_size=16)
+        for key, result in inpainter.inpaint_adaptive(self.images(2), threshold=float('inf')):
+            self.assertEqual(result.dense_tiles, len(inpainter.grid(256, 256)))
+
+
+if __name__ == '__main__':
+    unittest.main()
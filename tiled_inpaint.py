@@ -0,0 +1,233 @@
+import math
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from batching import MASK_VALUES
+from datasets import load_lung_boxes
+
+
+# Blending weights of a reconstructed patch: a tent peaking in the middle of the patch, so that
+# overlapping patches fade into each other instead of leaving seams at their borders
+def blend_window(size):
+    ramp = torch.arange(size, dtype=torch.float32)
+    ramp = torch.min(ramp + 1, size - ramp)
+    return ramp[:, None] * ramp[None, :] / float(ramp.max() ** 2)
+
+
+# Positions of a regular grid of patches covering [0, n), the last one flush with the border
+def grid_axis(n, patch_size, stride):
+    last = max(n - patch_size, 0)
+    positions = list(range(0, last + 1, stride))
+    if positions[-1] != last:
+        positions.append(last)
+    return positions
+
+
+# Top-left corners (y, x) of the patches of a regular grid covering an image of size (h, w)
+def grid_positions(h, w, patch_size, stride):
+    return [(y, x) for y in grid_axis(h, patch_size, stride) for x in grid_axis(w, patch_size, stride)]
+
+
+# Mask (h, w) of the lung bounding boxes of an image, rows of (x0, y0, x1, y1) for the left and
+# the right lung as in the bounding-box csv files. As in generate_randomCrop.py x indexes the rows of
+# the image and y the columns. Boxes refer to images of box_size pixels and are scaled to (h, w).
+def lung_mask(boxes, h, w, box_size=1024):
+    mask = torch.zeros(h, w, dtype=torch.bool)
+    sy, sx = h / float(box_size), w / float(box_size)
+    for x0, y0, x1, y1 in np.asarray(boxes).reshape(-1, 4):
+        mask[max(0, int(x0 * sy)):int(math.ceil(x1 * sy)), max(0, int(y0 * sx)):int(math.ceil(y1 * sx))] = True
+    return mask
+
+
+# Positions of the grid patches overlapping a region of interest, which is then fully covered
+def roi_positions(mask, patch_size, stride):
+    h, w = mask.shape
+    return [(y, x) for y, x in grid_positions(h, w, patch_size, stride)
+            if mask[y:y + patch_size, x:x + patch_size].any()]
+
+
+# Patches to reconstruct restricted to the lungs, for TiledInpainter.inpaint. Keys are image names
+# without extension, images missing in the csv file are covered with the whole grid.
+# The mask of the last image is kept for the calls with other strides of the adaptive scan.
+class LungROI(object):
+    def __init__(self, bbox_csv, patch_size=64, stride=32, box_size=1024):
+        names, boxes = load_lung_boxes(bbox_csv)
+        self.boxes = dict(zip(names, boxes))
+        self.patch_size = patch_size
+        self.stride = stride
+        self.box_size = box_size
+        self.missing = 0
+        self._last = (None, None)
+
+    # Lungs mask of an image, None if the image is missing in the csv file
+    def mask(self, key, image):
+        h, w = image.shape[-2:]
+        if self._last[0] != (key, h, w):
+            mask = None
+            if key not in self.boxes:
+                self.missing += 1
+            else:
+                mask = lung_mask(self.boxes[key], h, w, self.box_size)
+            self._last = ((key, h, w), mask)
+        return self._last[1]
+
+    def __call__(self, key, image, stride=None):
+        stride = stride or self.stride
+        mask = self.mask(key, image)
+        if mask is None:
+            return grid_positions(image.shape[-2], image.shape[-1], self.patch_size, stride)
+        return roi_positions(mask, self.patch_size, stride)
+
+
+# Reconstruction of a full image, with the mean squared error of every reconstructed patch. dense_tiles
+# is the number of patches of a dense scan of the same region, forward_passes by default.
+class InpaintResult(object):
+    def __init__(self, image, reconstruction, coverage, tile_errors, forward_passes, dense_tiles=None):
+        self.image = image
+        self.reconstruction = reconstruction
+        self.coverage = coverage
+        self.tile_errors = tile_errors
+        self.forward_passes = forward_passes
+        self.dense_tiles = forward_passes if dense_tiles is None else dense_tiles
+
+    # Absolute pixel-wise difference between the image and its reconstruction, 0 where not covered
+    def difference(self):
+        return (self.image - self.reconstruction).abs()
+
+    # Mean squared error over the reconstructed pixels, with pixel values multiplied by scale
+    def mse(self, scale=255.0):
+        if not self.coverage.any():
+            return 0.0
+        return (self.difference() * scale).pow(2)[:, self.coverage].double().mean().item()
+
+
+# Accumulators of an image whose tiles are being reconstructed
+class _ImageJob(object):
+    def __init__(self, key, image, padded, n_tiles, device):
+        self.key = key
+        self.image = image
+        self.padded = padded
+        self.remaining = n_tiles
+        self.forward_passes = n_tiles
+        self.recon = torch.zeros(image.size(), device=device)
+        self.weights = torch.zeros(image.size()[1:], device=device)
+        self.tile_errors = {}
+
+    def result(self):
+        covered = self.weights > 0
+        image = self.image.to(self.recon.device)
+        recon = torch.where(covered, self.recon / self.weights.clamp(min=1e-8), image)
+        return InpaintResult(self.image, recon.cpu(), covered.cpu(), self.tile_errors, self.forward_passes)
+
+
+# Full-resolution inpainting with a generator trained on imageSize windows: every patch of the
+# image is reconstructed by the generator from the window around it, with the patch masked as in
+# training. Tiles of consecutive images are batched together into large forward passes, and the
+# overlapping patches are blended. Images are streamed, so only the few images whose tiles are in
+# the current batch are kept in memory.
+class TiledInpainter(object):
+    def __init__(self, netG, image_size=128, patch_size=64, overlap_pred=4, stride=32, batch_size=256,
+                 device='cpu'):
+        self.netG = netG
+        self.image_size = image_size
+        self.patch_size = patch_size
+        self.margin = (image_size - patch_size) // 2
+        self.mask = slice(self.margin + overlap_pred, self.margin + patch_size - overlap_pred)
+        self.stride = stride
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.blend = blend_window(patch_size).to(self.device)
+
+    def grid(self, h, w, stride=None):
+        return grid_positions(h, w, self.patch_size, stride or self.stride)
+
+    # Reconstruct the patches at the given positions of a batch of windows, accumulated in their jobs
+    def _run(self, tiles):
+        windows = torch.stack([job.padded[:, y:y + self.image_size, x:x + self.image_size] for job, y, x in tiles])
+        real = windows[:, :, self.margin:self.margin + self.patch_size, self.margin:self.margin + self.patch_size].clone()
+        for c in range(min(windows.size(1), len(MASK_VALUES))):
+            windows[:, c, self.mask, self.mask] = MASK_VALUES[c]
+        with torch.no_grad():
+            fake = self.netG(windows).float()
+        errors = (fake - real).pow(2).flatten(1).mean(1).tolist()
+
+        p = self.patch_size
+        for (job, y, x), patch, error in zip(tiles, fake, errors):
+            job.recon[:, y:y + p, x:x + p] += patch * self.blend
+            job.weights[y:y + p, x:x + p] += self.blend
+            job.tile_errors[(y, x)] = error
+            job.remaining -= 1
+
+    # Reconstruct a stream of (key, image) pairs, images being (C, H, W) tensors in the range used in
+    # training. positions(key, image) gives the patches to reconstruct, the dense grid by default.
+    # Yields (key, InpaintResult) in the order of the input.
+    def inpaint(self, items, positions=None):
+        jobs = deque()
+        tiles = []
+        for key, image in items:
+            h, w = image.shape[-2:]
+            selected = positions(key, image) if positions is not None else self.grid(h, w)
+            padded = F.pad(image.to(self.device).unsqueeze(0), [self.margin] * 4, mode='reflect')[0]
+            job = _ImageJob(key, image, padded, len(selected), self.device)
+            jobs.append(job)
+            tiles.extend((job, y, x) for y, x in selected)
+
+            while len(tiles) >= self.batch_size:
+                self._run(tiles[:self.batch_size])
+                tiles = tiles[self.batch_size:]
+            # Finished images, also those without tiles, are handed back at once: only the images with
+            # tiles waiting for a batch are kept
+            while jobs and jobs[0].remaining == 0:
+                job = jobs.popleft()
+                yield job.key, job.result()
+
+        for start in range(0, len(tiles), self.batch_size):
+            self._run(tiles[start:start + self.batch_size])
+        while jobs:
+            job = jobs.popleft()
+            yield job.key, job.result()
+
+    # Coarse-to-fine reconstruction: images are first covered with a grid of stride coarse_stride
+    # (the patch size by default, without overlaps), then the dense grid is reconstructed only around
+    # the coarse patches whose mean squared error, on pixel values multiplied by scale, is above
+    # threshold. Dense patches replace the coarse reconstruction where they are computed.
+    # positions(key, image, stride) restricts both grids, keys must be unique.
+    def inpaint_adaptive(self, items, threshold, coarse_stride=None, positions=None, scale=255.0):
+        coarse_stride = coarse_stride or self.patch_size
+        p = self.patch_size
+        coarse = {}
+        dense_tiles = {}
+
+        # The size of the dense scan is recorded for reporting
+        def coarse_positions(key, image):
+            if positions is not None:
+                selected = positions(key, image, coarse_stride)
+                dense_tiles[key] = len(positions(key, image, self.stride))
+            else:
+                selected = self.grid(image.shape[-2], image.shape[-1], coarse_stride)
+                dense_tiles[key] = len(self.grid(image.shape[-2], image.shape[-1]))
+            return selected
+
+        def coarse_items():
+            for key, result in self.inpaint(items, coarse_positions):
+                coarse[key] = result
+                yield key, result.image
+
+        def fine_positions(key, image):
+            flagged = torch.zeros(image.shape[-2:], dtype=torch.bool)
+            for (y, x), error in coarse[key].tile_errors.items():
+                if error * scale ** 2 > threshold:
+                    flagged[y:y + p, x:x + p] = True
+            return roi_positions(flagged, p, self.stride)
+
+        for key, fine in self.inpaint(coarse_items(), fine_positions):
+            result = coarse.pop(key)
+            tile_errors = dict(result.tile_errors)
+            tile_errors.update(fine.tile_errors)
+            yield key, InpaintResult(result.image,
+                                     torch.where(fine.coverage, fine.reconstruction, result.reconstruction),
+                                     result.coverage | fine.coverage, tile_errors,
+                                     result.forward_passes + fine.forward_passes, dense_tiles.pop(key))
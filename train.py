@@ -13,12 +13,20 @@ import torchvision.datasets as dset
 import torchvision.transforms as transforms
 import torchvision.utils as vutils
 from torch.autograd import Variable
+import copy
 import pickle
 import math
 import time
 
-from model import _netjointD, _netlocalD, _netG, _netmarginD
-from utils import plotter, generate_directories, psnr
+from model import _netjointD, _netlocalD, _netG, _netmarginD, frozen_batchnorm_stats, split_batchnorm
+from utils import plotter, generate_directories, peak_memory, reset_peak_memory
+from metrics import batch_psnr
+from image_transforms import RegionCrop, ToUInt8Tensor
+from datasets import IndexedImageFolder, PackedImageDataset, LungPatchDataset, PackedRandomCropDataset, ResumableSampler, build_resized_cache, to_float_tensor
+from batching import BatchPrefetcher, copy_batch
+from schedule import UpdateSchedule
+import distributed
+import checkpoint
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
@@ -37,7 +45,8 @@ parser.add_argument('--nc', type=int, default=1)  # By default convert image inp
 parser.add_argument('--niter', type=int, default=50, help='number of epochs to train for')
 parser.add_argument('--lr', type=float, default=0.0002, help='learning rate, default=0.0002')
 parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for adam. default=0.5')
-parser.add_argument('--cuda', action='store_true', help='enables cuda')
+parser.add_argument('--cuda', action='store_true', help='enables cuda, the default when a GPU is available')
+parser.add_argument('--cpu', action='store_true', help='train on the CPU even if a GPU is available')
 parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
 parser.add_argument('--update_train_img', type=int, default=10000, help='how often (iterations) to update training set images')
 parser.add_argument('--update_measures_plots', type=int, default=200, help='how often (iterations) to add a new datapoint in measure plots')
@@ -59,15 +68,33 @@ parser.add_argument('--randomCrop', action='store_true', help='Run experiment wi
 parser.add_argument('--N_randomCrop', type=int, default=10)
 parser.add_argument('--PAD_randomCrop', type=int, default=0)
 parser.add_argument('--CENTER_SIZE_randomCrop', type=int, default=768)
+parser.add_argument('--bf16', action='store_true', help='train on the CPU with the forward and backward passes in bfloat16 autocast')
+parser.add_argument('--nproc', type=int, default=1, help='training processes started on this machine, see also torchrun; batchSize is per process')
+parser.add_argument('--syncBN', action='store_true', help='normalize with the statistics of the batches of all the processes')
+parser.add_argument('--checkpointG', type=int, default=0, help='recompute the activations of netG in the backward pass, checkpointing every this many resolution stages, 0 keeps them all')
+parser.add_argument('--checkpointMinutes', type=float, default=15, help='also checkpoint during epochs, every this many minutes, so that a killed run resumes at the next batch, 0 checkpoints only at the end of epochs')
+parser.add_argument('--accumSteps', type=int, default=1, help='micro-batches every batch is split in, gradients accumulate and the networks are stepped once per batch')
+parser.add_argument('--prefetchBatches', type=int, default=2, help='batches assembled ahead by a background thread, 0 assembles them inline')
+parser.add_argument('--uint8Loader', action='store_true', help='loader workers return uint8 batches, converted to float once per batch')
+parser.add_argument('--testCache', default='', help='directory caching the resized test images, test crops are sampled from it')
+parser.add_argument('--lungSampler', action='store_true', help='sample fresh random lung crops every epoch instead of the generated train patches')
+parser.add_argument('--bbox_csv', default='traindata_bb.csv', help='lungs bounding boxes of the train images')
+parser.add_argument('--lungImages', default='dataset_lungs/train/train', help='train images, as a folder of PNGs or a packed store')
+parser.add_argument('--lungCache', default='dataset_lungs/train_lungs_packed', help='directory where a folder of PNG --lungImages is packed once, empty to decode a whole PNG for every crop')
+parser.add_argument('--N_lungCrops', type=int, default=20, help='random lung crops per image in every epoch')
+parser.add_argument('--packedPatches', default='', help='packed train patches (dataset_scripts/pack_dataset.py) used instead of train_randomPatches')
 
 parser.add_argument('--jointD', action='store_true', help='Discriminator joins Local and Global Discriminators')
 parser.add_argument('--fullyconn_size', type=int, default=1024, help='Size of the output of Local and Global Discriminator which will be joint in fully conntected layer')
 parser.add_argument('--patch_with_margin_size', type=int, default=80, help='the size of image with margin to extend the reconstructed center to be input in Local Discriminator')
 parser.add_argument('--marginD', action='store_true', help='Discriminator with margins')
+parser.add_argument('--fusedD', action='store_true', help='run the discriminator on the real and the reconstructed batches in a single forward')
 parser.add_argument('--freezeTraining', action='store_true', help='2 Epochs Gen, 5 Epochs Disc, then combined')
 
 opt = parser.parse_args()
-opt.cuda = True
+opt.cuda = (opt.cuda or torch.cuda.is_available()) and not opt.cpu
+if opt.bf16:
+    opt.cuda = False  # bfloat16 autocast runs on the CPU
 
 # opt.ndf = 128 #Discriminator
 # opt.nef = 128 #Generator
@@ -92,6 +119,12 @@ opt.fullyconn_size = 512
 # LIMIT_TRAINING = 1000000
 LIMIT_TRAINING = 200
 
+# Distributed training: one process per --nproc, or per process started by torchrun
+distributed.launch(opt.nproc)
+rank, world_size = distributed.setup(opt)
+if world_size > 1:
+    opt.ngpu = 1  # Every process trains on a single device
+
 
 # torch.set_printoptions(threshold=5000)
 
@@ -118,70 +151,111 @@ PATHS = dict()
 PATHS["netG"] = "outputs/" + EXP_NAME + "/netG_context_encoder.pth"
 PATHS["netD"] = "outputs/" + EXP_NAME + "/netD_discriminator.pth"
 PATHS["measures"] = "outputs/" + EXP_NAME + "/measures.pickle"
+PATHS["state"] = "outputs/" + EXP_NAME + "/training_state.pth"
 PATHS["train"] = "outputs/" + EXP_NAME + "/train_results"
 PATHS["test"] = "outputs/" + EXP_NAME + "/test_results"
 PATHS["plots"] = "outputs/" + EXP_NAME + "/plots"
 PATHS["randomCrops"] = "outputs/" + EXP_NAME + "/test_results/randomCrops"
 
-generate_directories(PATHS, EXP_NAME, opt.randomCrop)
+if rank == 0:
+    generate_directories(PATHS, EXP_NAME, opt.randomCrop)
 
-# Seeds
-random.seed(opt.manualSeed)
-torch.manual_seed(opt.manualSeed)
+# Seeds, different random crops in every process. The initial weights of rank 0 are broadcast.
+random.seed(opt.manualSeed + rank)
+torch.manual_seed(opt.manualSeed + rank)
 if opt.cuda:
-    torch.cuda.manual_seed_all(opt.manualSeed)
+    torch.cuda.manual_seed_all(opt.manualSeed + rank)
 
 cudnn.benchmark = True
 
 if torch.cuda.is_available() and not opt.cuda:
     print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
+# With --uint8Loader samples stay uint8 through the loader workers, see batching.copy_batch
+if opt.uint8Loader:
+    to_tensor = ToUInt8Tensor()
+    packed_transform = None
+else:
+    to_tensor = transforms.ToTensor()
+    packed_transform = to_float_tensor
+
+# The first process builds the image caches and file indexes, the others wait for it and load them
+if rank != 0:
+    distributed.barrier()
+
 if opt.randomCrop:
-    transform = transforms.Compose([
-        transforms.Grayscale(),
-        transforms.Resize(opt.initialScaleTo),
-        transforms.CenterCrop(opt.CENTER_SIZE_randomCrop),
-        transforms.RandomCrop(opt.imageSize, opt.PAD_randomCrop),
-        transforms.ToTensor(),
-    ])
+    if opt.PAD_randomCrop == 0:
+        # Only the cropped region of the radiograph is converted and resampled
+        transform = transforms.Compose([
+            RegionCrop(opt.initialScaleTo, opt.CENTER_SIZE_randomCrop, opt.imageSize),
+            to_tensor,
+        ])
+    else:
+        transform = transforms.Compose([
+            transforms.Grayscale(),
+            transforms.Resize(opt.initialScaleTo),
+            transforms.CenterCrop(opt.CENTER_SIZE_randomCrop),
+            transforms.RandomCrop(opt.imageSize, opt.PAD_randomCrop),
+            to_tensor,
+        ])
     transform_original = transforms.Compose([
         transforms.Grayscale(),
         transforms.Resize(opt.initialScaleTo),
-        transforms.ToTensor(),
+        to_tensor,
     ])
     transform_randomPatches = transforms.Compose([
         transforms.Grayscale(),
-        transforms.ToTensor(),
+        to_tensor,
     ])
-    # datasets = []
-    test_datasets = []
-    test_original = []
-    for i in range(opt.N_randomCrop):
-        # datasets.append(dset.ImageFolder(root='dataset_lungs/train', transform=transform))
-        test_datasets.append(dset.ImageFolder(root='dataset_lungs/test_64', transform=transform))
-    # dataset = torch.utils.data.ConcatDataset(datasets)
-    test_dataset = torch.utils.data.ConcatDataset(test_datasets)
+    if opt.testCache != '':
+        # Test images are decoded and resized once, both test loaders crop from the memory-mapped cache
+        test_cache = build_resized_cache('dataset_lungs/test_64', opt.testCache, opt.initialScaleTo)
+        test_dataset = PackedRandomCropDataset(test_cache, opt.CENTER_SIZE_randomCrop, opt.imageSize,
+                                               opt.N_randomCrop, opt.PAD_randomCrop, packed_transform)
+        test_original = PackedImageDataset(test_cache, packed_transform)
+    else:
+        # datasets = []
+        test_datasets = []
+        test_original = []
+        for i in range(opt.N_randomCrop):
+            # datasets.append(dset.ImageFolder(root='dataset_lungs/train', transform=transform))
+            test_datasets.append(IndexedImageFolder(root='dataset_lungs/test_64', transform=transform))
+        # dataset = torch.utils.data.ConcatDataset(datasets)
+        test_dataset = torch.utils.data.ConcatDataset(test_datasets)
+        test_original = IndexedImageFolder(root='dataset_lungs/test_64', transform=transform_original)
     
-    dataset = dset.ImageFolder(root='dataset_lungs/train_randomPatches', transform=transform_randomPatches)
+    if opt.lungSampler:
+        dataset = LungPatchDataset(opt.bbox_csv, opt.lungImages, opt.imageSize, opt.N_lungCrops, packed_transform,
+                                   opt.lungCache or None)
+    elif opt.packedPatches != '':
+        dataset = PackedImageDataset(opt.packedPatches, packed_transform)
+    else:
+        dataset = IndexedImageFolder(root='dataset_lungs/train_randomPatches', transform=transform_randomPatches)
     # test_dataset = dset.ImageFolder(root='dataset_lungs/test_randomPatches', transform=transform_randomPatches)
     
-    test_original = dset.ImageFolder(root='dataset_lungs/test_64', transform=transform_original)
     test_original_dataloader = torch.utils.data.DataLoader(test_original, batch_size=opt.batchSize,
                                                   shuffle=False, num_workers=int(opt.test_workers))
 
 else:
     transform = transforms.Compose([
-        transforms.Grayscale(),
-        transforms.Resize(opt.initialScaleTo),
-        transforms.CenterCrop(opt.imageSize),
-        transforms.ToTensor(),
+        RegionCrop(opt.initialScaleTo, opt.imageSize, opt.imageSize),
+        to_tensor,
     ])
-    dataset = dset.ImageFolder(root='dataset_lungs/train', transform=transform)
-    test_dataset = dset.ImageFolder(root='dataset_lungs/test_64', transform=transform)
+    dataset = IndexedImageFolder(root='dataset_lungs/train', transform=transform)
+    test_dataset = IndexedImageFolder(root='dataset_lungs/test_64', transform=transform)
 
 assert dataset
-dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize,
-                                         shuffle=True, num_workers=int(opt.workers))
+if rank == 0:
+    distributed.barrier()
+# Every process trains on its own shard of the patches, in an order that can be resumed within an epoch
+train_sampler = ResumableSampler(dataset, num_replicas=world_size, rank=rank, seed=opt.manualSeed)
+# The seeds of the loader workers are drawn from a generator of their own, so that starting the loader
+# in the middle of a resumed epoch does not shift the global random generators
+loader_generator = torch.Generator()
+loader_generator.manual_seed(opt.manualSeed + rank)
+dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize, shuffle=False,
+                                         sampler=train_sampler, num_workers=int(opt.workers),
+                                         generator=loader_generator)
 assert test_dataset
 test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=opt.batchSize,
                                               shuffle=False, num_workers=int(opt.test_workers))
@@ -216,12 +290,24 @@ def save_grad(image):
 
 resume_epoch = 0
 
+# Training state of the checkpoint to resume from, the manifest of the models, measures and optimizers
+# saved with it. The first process rolls back the files of an interrupted save, the others wait for it.
+training_state = None
+if opt.continueTraining and os.path.exists(PATHS["state"]):
+    if rank != 0:
+        distributed.barrier()
+    training_state = checkpoint.load_generation(PATHS["state"])
+    if rank == 0:
+        distributed.barrier()
+
 netG = _netG(opt)
 netG.apply(weights_init)
 if opt.continueTraining:
     print("Loading model netG from: ", PATHS["netG"])
-    netG.load_state_dict(torch.load(PATHS["netG"], map_location=lambda storage, location: storage)['state_dict'])
-    resume_epoch = torch.load(PATHS["netG"])['epoch']
+    checkpointG = checkpoint.load(PATHS["netG"])
+    netG.load_state_dict(checkpointG['state_dict'])
+    resume_epoch = checkpointG['epoch']
+netG.checkpoint_stages(opt.checkpointG)
 print(netG)
 
 if opt.jointD:
@@ -234,8 +320,9 @@ netD.apply(weights_init)
 
 if opt.continueTraining:
     print("Loading model netD from: ", PATHS["netD"])
-    netD.load_state_dict(torch.load(PATHS["netD"], map_location=lambda storage, location: storage)['state_dict'])
-    resume_epoch = torch.load(PATHS["netD"])['epoch']
+    checkpointD = checkpoint.load(PATHS["netD"])
+    netD.load_state_dict(checkpointD['state_dict'])
+    resume_epoch = checkpointD['epoch']
 print(netD)
 
 print("\n")
@@ -252,14 +339,16 @@ paddingLayerMargin = nn.ZeroPad2d((opt.patch_with_margin_size - opt.patchSize)//
 criterion = nn.BCELoss()
 criterionMSE = nn.MSELoss()
 
-input_real = torch.FloatTensor(opt.batchSize, 1, opt.imageSize, opt.imageSize)
-input_cropped = torch.FloatTensor(opt.batchSize, 1, opt.imageSize, opt.imageSize)
-label = torch.FloatTensor(opt.batchSize)
+# Buffers of a micro-batch, see --accumSteps
+micro_batch_size = int(math.ceil(opt.batchSize / float(opt.accumSteps)))
+input_real = torch.FloatTensor(micro_batch_size, 1, opt.imageSize, opt.imageSize)
+input_cropped = torch.FloatTensor(micro_batch_size, 1, opt.imageSize, opt.imageSize)
+label = torch.FloatTensor(micro_batch_size)
 real_label = 1
 fake_label = 0
 
-real_center = torch.FloatTensor(opt.batchSize, 1, int(opt.patchSize), int(opt.patchSize))
-real_center_plus_margin = torch.FloatTensor(opt.batchSize, 1, int(opt.patch_with_margin_size), int(opt.patch_with_margin_size))
+real_center = torch.FloatTensor(micro_batch_size, 1, int(opt.patchSize), int(opt.patchSize))
+real_center_plus_margin = torch.FloatTensor(micro_batch_size, 1, int(opt.patch_with_margin_size), int(opt.patch_with_margin_size))
 
 
 print("Moving models to CUDA...")
@@ -278,9 +367,11 @@ if opt.cuda:
     
 if opt.randomCrop:
     image_1024 = torch.FloatTensor(opt.batchSize, 1, opt.initialScaleTo, opt.initialScaleTo)
-    image_1024 = Variable(image_1024.cuda())
     input_rc_cropped = torch.FloatTensor(opt.batchSize, 1, opt.imageSize, opt.imageSize)
-    input_rc_cropped = Variable(input_rc_cropped.cuda())
+    if opt.cuda:
+        image_1024, input_rc_cropped = image_1024.cuda(), input_rc_cropped.cuda()
+    image_1024 = Variable(image_1024)
+    input_rc_cropped = Variable(input_rc_cropped)
 
 input_real = Variable(input_real)
 input_cropped = Variable(input_cropped)
@@ -289,9 +380,19 @@ label = Variable(label)
 real_center = Variable(real_center)
 real_center_plus_margin = Variable(real_center_plus_margin)
 
+# Gradients are averaged across the processes
+netG = distributed.wrap(netG, opt)
+netD = distributed.wrap(netD, opt)
+
 # setup optimizer
 optimizerD = optim.Adam(netD.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
 optimizerG = optim.Adam(netG.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+if opt.continueTraining:
+    if 'optimizer' in checkpointG and 'optimizer' in checkpointD:
+        optimizerD.load_state_dict(checkpointD['optimizer'])
+        optimizerG.load_state_dict(checkpointG['optimizer'])
+    else:
+        print("WARNING: the checkpoints have no optimizer state, Adam restarts from scratch")
 
 D_G_zs = []
 D_xs = []
@@ -312,135 +413,260 @@ this_Adv = 0
 this_L2 = 0
 this_G_tot = 0
 this_D_tot = 0
+this_D_steps = 0
+this_G_steps = 0
 
 print("Starting training in 3s...")
 time.sleep(3)
 
 step_counter = 0
 
+# Measures of the datapoint not plotted yet, random generators and step to resume at. Checkpoints
+# written during an epoch resume at the next batch of the epoch of the models.
+resume_step = 0
+if training_state is not None:
+    position = (training_state['epoch'], training_state.get('step', 0))
+    if not position == (checkpointG['epoch'], checkpointG.get('step', 0)) == (checkpointD['epoch'], checkpointD.get('step', 0)):
+        raise SystemExit("The checkpoints in outputs/%s are of different steps, not resuming" % EXP_NAME)
+    (this_DGz, this_Dx, this_Adv, this_L2, this_G_tot, this_D_tot, this_D_steps, this_G_steps,
+     step_counter) = training_state['measures']
+    resume_step = position[1]
+    print("Continuing from step", resume_step, "of resume epoch", resume_epoch)
+
+
+# Forward pass, under bfloat16 autocast with --bf16. Weights stay in float32 and outputs are cast
+# back to float32, so that the weighted L2 loss is computed in full precision. The final layers and
+# sigmoid of the discriminators already run in float32, see model._float32_head, so that BCELoss does
+# not get probabilities rounded to exactly 0 or 1.
+def forward(net, *inputs):
+    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=opt.bf16):
+        output = net(*inputs)
+    return output.float()
+
+
+# Load a micro-batch in the persistent buffers and reconstruct its centers, with the gradients of G
+# if requires_grad. Returns the reconstructed centers, their images and centers with margin (with
+# --jointD or --marginD) and the inputs of the discriminator for the real images and for the
+# reconstructions.
+def reconstruct(micro_batch, requires_grad):
+    micro_batch.load(input_real, input_cropped, real_center, real_center_plus_margin)
+    with torch.set_grad_enabled(requires_grad):
+        fake = forward(netG, input_cropped)
+    
+    recon_image = recon_center_plus_margin = None
+    if opt.jointD or opt.marginD:
+        recon_image = paddingLayerWhole(fake)
+        # recon_image = F.pad(fake, paddingWhole, 'constant', 0)
+        recon_image.data = input_cropped.data
+        recon_image.data[:, :,
+            int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
+            int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
+
+        recon_center_plus_margin = paddingLayerMargin(fake)
+        # recon_center_plus_margin = F.pad(fake, paddingMargin, 'constant', 0)
+        recon_center_plus_margin.data = recon_image.data[:, :,
+                                                   int(opt.imageSize / 2 - opt.patch_with_margin_size / 2):int(
+                                                       opt.imageSize / 2 + opt.patch_with_margin_size / 2),
+                                                   int(opt.imageSize / 2 - opt.patch_with_margin_size / 2):int(
+                                                       opt.imageSize / 2 + opt.patch_with_margin_size / 2)]
+    
+    if opt.jointD:
+        real_inputs = (real_center_plus_margin, input_real)
+        if opt.patchSize != opt.patch_with_margin_size:
+            fake_inputs = (recon_center_plus_margin, recon_image)
+        else:
+            fake_inputs = (fake, recon_image)
+            # fake_inputs = (recon_center_plus_margin, recon_image)
+    elif opt.marginD:
+        real_inputs = (real_center_plus_margin,)
+        fake_inputs = (recon_center_plus_margin,)
+    else:
+        real_inputs = (real_center,)
+        fake_inputs = (fake,)
+    return fake, recon_image, recon_center_plus_margin, real_inputs, fake_inputs
+
+
+# Weighted L2 loss of the reconstructed centers of the micro-batch in the buffers, the overlapping
+# edges weigh overlapL2Weight times more
+def l2_loss(fake):
+    wtl2Matrix = real_center.clone()
+    wtl2Matrix.data.fill_(wtl2 * overlapL2Weight)
+    wtl2Matrix.data[:, :, int(opt.overlapPred):int(opt.imageSize / 2 - opt.overlapPred),
+    int(opt.overlapPred):int(opt.imageSize / 2 - opt.overlapPred)] = wtl2
+    return ((fake - real_center).pow(2) * wtl2Matrix).mean()
+
+
+# Images per second of a training step (forward and backward passes of G, and of D on the
+# reconstructed centers with the local discriminator) on a random batch. Copies of the networks are
+# used, so that their weights and statistics are not touched.
+def step_throughput(bf16, steps=3):
+    G, D = copy.deepcopy(distributed.unwrap(netG)), copy.deepcopy(distributed.unwrap(netD))
+    batch = torch.rand(opt.batchSize, opt.nc, opt.imageSize, opt.imageSize)
+    for k in range(steps + 1):
+        if k == 1:
+            start = time.time()  # The first step is a warm up
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+            fake = G(batch)
+            loss = fake.float().pow(2).mean()
+            if not (opt.jointD or opt.marginD):
+                loss = loss + D(fake).float().mean()
+        loss.backward()
+    return steps * opt.batchSize / (time.time() - start)
+
+
+# Time and peak memory of a generator step (forward, local D on the reconstructions and backward) on
+# a random micro-batch, with netG checkpointed every `stages` resolution stages
+def generator_step_cost(stages, steps=3):
+    G = copy.deepcopy(distributed.unwrap(netG)).checkpoint_stages(stages)
+    D = copy.deepcopy(distributed.unwrap(netD))
+    batch = input_cropped.data.new(micro_batch_size, opt.nc, opt.imageSize, opt.imageSize).uniform_()
+    for k in range(steps + 1):
+        if k == 1:
+            # The first step is a warm up, allocating the gradients and the buffers of the kernels
+            start = time.time()
+            start_memory = reset_peak_memory(opt.cuda)
+        fake = forward(G, batch)
+        loss = fake.pow(2).mean()
+        if not (opt.jointD or opt.marginD):
+            loss = loss + forward(D, fake).mean()
+        loss.backward()
+    if opt.cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / steps, peak_memory(opt.cuda, start_memory)
+
+
+def format_memory(mb):
+    return 'n/a' if mb is None else '%.0fMB' % mb
+
+
+if opt.checkpointG > 0:
+    for stages in (0, opt.checkpointG):
+        step_time, memory = generator_step_cost(stages)
+        print("Generator step on %d images with %s: %.3fs, peak memory %s"
+              % (micro_batch_size, "checkpoints every %d stages" % stages if stages else "no checkpoints",
+                 step_time, format_memory(memory)))
+
+if opt.bf16:
+    print("Training step throughput: float32 %.1f images/s, bfloat16 %.1f images/s"
+          % (step_throughput(False), step_throughput(True)))
+
+# Masked inputs, centers and margin crops are assembled off the main thread
+train_batches = BatchPrefetcher(dataloader, opt, opt.prefetchBatches)
+test_batches = BatchPrefetcher(test_dataloader, opt, opt.prefetchBatches)
+
+# Networks updated at every step, see --freezeTraining, --freeze_disc and --freeze_gen
+schedule = UpdateSchedule(opt.freezeTraining, opt.freeze_disc, opt.freeze_gen, opt.fusedD)
+
+# Checkpoints are written in the background, the training loop only waits for a copy on the CPU
+checkpoints = checkpoint.CheckpointWriter()
+
+
+# Queue the checkpoints of the models with the states of their optimizers, of the measure lists and of
+# the rest of the training state, resuming at the given step of the given epoch. The training state
+# is written last, as the manifest of the files of the checkpoint.
+def save_checkpoint(epoch, step):
+    checkpoints.save({'epoch': epoch, 'step': step, 'state_dict': distributed.unwrap(netG).state_dict(),
+                      'optimizer': optimizerG.state_dict()}, PATHS["netG"])
+    checkpoints.save({'epoch': epoch, 'step': step, 'state_dict': distributed.unwrap(netD).state_dict(),
+                      'optimizer': optimizerD.state_dict()}, PATHS["netD"])
+    checkpoints.save((D_G_zs, D_xs, Advs, L2s, G_tots, D_tots), PATHS["measures"], use_pickle=True)
+    checkpoints.commit({'epoch': epoch, 'step': step, 'rng': checkpoint.rng_state(),
+                        'loader_rng': loader_generator.get_state(),
+                        'measures': (this_DGz, this_Dx, this_Adv, this_L2, this_G_tot, this_D_tot, this_D_steps,
+                                     this_G_steps, step_counter)}, PATHS["state"])
+
+
+# The random generators are restored after the random draws of the setup. Only the state of rank 0
+# is saved, the other processes are seeded again.
+if training_state is not None:
+    if rank == 0:
+        checkpoint.set_rng_state(training_state['rng'])
+        if 'loader_rng' in training_state:
+            loader_generator.set_state(training_state['loader_rng'])
+    else:
+        random.seed(opt.manualSeed + rank + world_size * resume_epoch)
+        torch.manual_seed(opt.manualSeed + rank + world_size * resume_epoch)
+        loader_generator.manual_seed(opt.manualSeed + rank + world_size * resume_epoch)
+train_sampler.set_start(resume_step * opt.batchSize)
+last_checkpoint = time.time()
+
 for epoch in range(resume_epoch, opt.niter):
     epoch_time = time.time()
+    epoch_images = 0
+    schedule.reset()
+    epoch_memory = reset_peak_memory(opt.cuda)
+    train_sampler.set_epoch(epoch)
 
     #################################
     # Training part for every epoch #
     #################################
-    for i, data in enumerate(dataloader, 0):
+    for i, batch in enumerate(train_batches, resume_step if epoch == resume_epoch else 0):
         if i < LIMIT_TRAINING:
+            # Networks updated at this step, the passes that are not needed are skipped
+            plan = schedule.plan(epoch, i)
+            if plan.idle():
+                continue
             step_counter += 1
             
-            real_cpu, _ = data
-            real_center_cpu = real_cpu[:, :,
-                              int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
-                              int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)]
-            batch_size = real_cpu.size(0)
-            input_real.data.resize_(real_cpu.size()).copy_(real_cpu)
-            input_cropped.data.resize_(real_cpu.size()).copy_(real_cpu)
-            real_center.data.resize_(real_center_cpu.size()).copy_(real_center_cpu)
-            input_cropped.data[:, 0,
-            int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-            int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
-            if opt.nc > 1:
-                input_cropped.data[:, 1,
-                int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                    opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-                int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                    opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 104.0 / 255.0 - 1.0
-                input_cropped.data[:, 2,
-                int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                    opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-                int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                    opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 123.0 / 255.0 - 1.0
-            
-            # print(type(input_real), type(input_real.data), type(input_cropped), type(real_cpu), type(real_center_cpu), type(real_center), type(label))
-            # train with real
-            netD.zero_grad()
-            paddingLayerMargin.zero_grad()
-            paddingLayerWhole.zero_grad()
-            label.data.resize_(batch_size, 1).fill_(real_label)
+            batch_size = batch.size(0)
+            epoch_images += batch_size
+            # The batch is processed in micro-batches whose gradients accumulate, the networks are
+            # stepped once. Losses are weighted by the share of the batch of every micro-batch, so that
+            # gradients and measures are those of the whole batch.
+            micro_batches = batch.split(opt.accumSteps)
+            last = len(micro_batches) - 1
             
-            # input("Proceed..." + str(real_center.data.size()))
+            # Measures of the networks not run at this step are not logged
+            errD = errG_D = errG = D_x = D_G_z1 = float('nan')
+            errG_l2 = 0
             
-            # print(real_center.data.size(), input_real.data.size())
-            real_center_plus_margin.data.resize_(real_cpu.size(0), 1, opt.patch_with_margin_size,
-                                                 opt.patch_with_margin_size).copy_(real_cpu[:, :,
-                                                                                   int(
-                                                                                       opt.imageSize / 2 - opt.patch_with_margin_size / 2):int(
-                                                                                       opt.imageSize / 2 + opt.patch_with_margin_size / 2),
-                                                                                   int(
-                                                                                       opt.imageSize / 2 - opt.patch_with_margin_size / 2):int(
-                                                                                       opt.imageSize / 2 + opt.patch_with_margin_size / 2)])
+            ############################
+            # (1) Update D network
+            ###########################
             
-            if opt.jointD:
-                if opt.patchSize != opt.patch_with_margin_size:
-                    output = netD(real_center_plus_margin, input_real)
-                else:
-                    # output = netD(real_center, input_real)
-                    output = netD(real_center_plus_margin, input_real)
-            elif opt.marginD:
-                output = netD(real_center_plus_margin)
-            else:
-                output = netD(real_center)
+            if plan.update_D:
+                netD.zero_grad()
+                paddingLayerMargin.zero_grad()
+                paddingLayerWhole.zero_grad()
+                errD = D_x = D_G_z1 = 0
                 
-            # print(real_center_plus_margin.size())
-            # print(output.data.size())
-            # print(label.data.size())
-            # input()
-            errD_real = criterion(output, label)
-            # if i % opt.freeze_disc == 0:  # Step Discriminator every freeze_gen iterations
-            if not opt.freezeTraining or epoch >= 2:
-                errD_real.backward()
-            D_x = output.data.mean()
-            
-            # train with fake
-    
-            # print(input_cropped.size())
-            fake = netG(input_cropped)
-            
-    
-            # fake = Variable(torch.randn(64, 1, 64, 64).cuda(), requires_grad=True)
-            
-            if opt.jointD or opt.marginD:
-                recon_image = paddingLayerWhole(fake)
-                # recon_image = F.pad(fake, paddingWhole, 'constant', 0)
-                recon_image.data = input_cropped.data
-                recon_image.data[:, :,
-                    int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
-                    int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
-    
-                recon_center_plus_margin = paddingLayerMargin(fake)
-                # recon_center_plus_margin = F.pad(fake, paddingMargin, 'constant', 0)
-                recon_center_plus_margin.data = recon_image.data[:, :,
-                                                           int(opt.imageSize / 2 - opt.patch_with_margin_size / 2):int(
-                                                               opt.imageSize / 2 + opt.patch_with_margin_size / 2),
-                                                           int(opt.imageSize / 2 - opt.patch_with_margin_size / 2):int(
-                                                               opt.imageSize / 2 + opt.patch_with_margin_size / 2)]
-    
-            # print(type(fake)) #Variable
-            # print(fake.data.size(), " ", input_cropped.data.size())
-            label.data.fill_(fake_label)
-            if opt.jointD:
-                if opt.patchSize != opt.patch_with_margin_size:
-                    recon_center_plus_margin_det = recon_center_plus_margin.detach()
-                    recon_image_det = recon_image.detach()
-                    output = netD(recon_center_plus_margin_det, recon_image_det)
-                else:
-                    output = netD(fake.detach(), recon_image.detach())
-                    # output = netD(recon_center_plus_margin.detach(), recon_image.detach())
-            elif opt.marginD:
-                output = netD(recon_center_plus_margin.detach())
-            else:
-                output = netD(fake.detach())
-    
-            errD_fake = criterion(output, label)
-            # if i % opt.freeze_disc == 0:  # Step Discriminator every freeze_gen iterations
-            if not opt.freezeTraining or epoch >= 2:
-                errD_fake.backward()
-            D_G_z1 = output.data.mean()
-            errD = errD_real + errD_fake
-            # if i % opt.freeze_disc == 0:
-            if not opt.freezeTraining or epoch >= 2:
+                for k, micro_batch in enumerate(micro_batches):
+                    weight = micro_batch.size(0) / float(batch_size)
+                    # With a single micro-batch the reconstruction is kept for the update of G
+                    fake, recon_image, recon_center_plus_margin, real_inputs, fake_inputs = reconstruct(
+                        micro_batch, plan.update_G and last == 0)
+                    with torch.no_grad():
+                        errG_l2 += weight * l2_loss(fake).item()
+                    label.resize_(micro_batch.size(0), 1).fill_(real_label)
+                    
+                    # Gradients are averaged across processes once, in the last micro-batch
+                    with distributed.no_sync(netD, k < last):
+                        if opt.fusedD:
+                            # train with real and fake in a single forward of D, BatchNorm layers normalize
+                            # the two halves of the batch separately as in two forwards
+                            n = micro_batch.size(0)
+                            with split_batchnorm(netD, 2):
+                                output = forward(netD, *[torch.cat((real, fake_input.detach()))
+                                                         for real, fake_input in zip(real_inputs, fake_inputs)])
+                            errD_real = criterion(output[:n], label)
+                            errD_fake = criterion(output[n:], torch.full_like(label, fake_label))
+                            (weight * (errD_real + errD_fake)).backward()
+                            D_x += weight * output.data[:n].mean().item()
+                            D_G_z1 += weight * output.data[n:].mean().item()
+                        else:
+                            # train with real
+                            output = forward(netD, *real_inputs)
+                            errD_real = criterion(output, label)
+                            (weight * errD_real).backward()
+                            D_x += weight * output.data.mean().item()
+                            
+                            # train with fake
+                            label.data.fill_(fake_label)
+                            output = forward(netD, *[fake_input.detach() for fake_input in fake_inputs])
+                            errD_fake = criterion(output, label)
+                            (weight * errD_fake).backward()
+                            D_G_z1 += weight * output.data.mean().item()
+                    errD += weight * (errD_real + errD_fake).item()
                 optimizerD.step()
                 
             
@@ -448,87 +674,81 @@ for epoch in range(resume_epoch, opt.niter):
             # (2) Update G network: maximize log(D(G(z)))
             ###########################
             
-            netG.zero_grad()
-            label.data.fill_(real_label)  # fake labels are real for generator cost
-            if opt.jointD:
-                if opt.patchSize != opt.patch_with_margin_size:
-                    output = netD(recon_center_plus_margin, recon_image)
-                else:
-                    output = netD(fake, recon_image)
-                    # output = netD(recon_center_plus_margin, recon_image)
-            elif opt.marginD:
-                output = netD(recon_center_plus_margin)
-                # output = netD(fake)
-            else:
-                output = netD(fake)
-    
-            errG_D = criterion(output, label)
-    
-            wtl2Matrix = real_center.clone()
-            wtl2Matrix.data.fill_(wtl2 * overlapL2Weight)
-            wtl2Matrix.data[:, :, int(opt.overlapPred):int(opt.imageSize / 2 - opt.overlapPred),
-            int(opt.overlapPred):int(opt.imageSize / 2 - opt.overlapPred)] = wtl2
-    
-            errG_l2 = (fake - real_center).pow(2)
-            errG_l2 = errG_l2 * wtl2Matrix
-            errG_l2 = errG_l2.mean()
-            if opt.freezeTraining and epoch < 2:
-                errG = errG_l2
-            if not opt.freezeTraining or epoch > 6:
-                errG = (1 - wtl2) * errG_D + wtl2 * errG_l2
-            # errG = errG_D
-    
-            # z_layer = torch.nn.Conv2d(1, 4, opt.patch_with_margin_size).cuda()
-            # output = z_layer(recon_center_plus_margin)
-            # errG = output.sum()
-            
-            
-            # print(fake.data[0,0,0])
-            # print(recon_center_plus_margin.data[0,0,0])
-            # if i % opt.freeze_gen == 0:  # Step Generator every freeze_gen iterations
-            if not opt.freezeTraining or epoch < 2 or epoch > 6:
-                if opt.register_hooks:
-                    fake.register_hook(print)
-                    recon_center_plus_margin.register_hook(print)
-                # recon_center_plus_margin_det.register_hook(print)
-                # paddingLayerMargin.register_hook(print)
-                # errG.backward(retain_variables=True)
-                # print(paddingLayerMargin.grad)
-                errG.backward()
-                # for param in paddingLayerMargin.parameters():
-                #     print(param.grad.data.sum())
-                # if i % opt.update_train_img == 0:
-                #     print("Gradients")
-                #     for param in netG.parameters():
-                #         print(param.grad.data.sum())
+            if plan.update_G:
+                netG.zero_grad()
+                errG_D = errG = 0
+                
+                for k, micro_batch in enumerate(micro_batches):
+                    weight = micro_batch.size(0) / float(batch_size)
+                    if not plan.update_D:
+                        with distributed.no_sync(netG, k < last):
+                            fake, recon_image, recon_center_plus_margin, real_inputs, fake_inputs = reconstruct(
+                                micro_batch, True)
+                        with torch.no_grad():
+                            errG_l2 += weight * l2_loss(fake).item()
+                    elif last > 0:
+                        # Reconstructed again with gradients, the running statistics of the BatchNorm
+                        # layers of G were already updated with this micro-batch
+                        with distributed.no_sync(netG, k < last), frozen_batchnorm_stats(netG):
+                            fake, recon_image, recon_center_plus_margin, real_inputs, fake_inputs = reconstruct(
+                                micro_batch, True)
+                    
+                    errG_l2_micro = l2_loss(fake)
+                    if plan.adversarial:
+                        label.resize_(micro_batch.size(0), 1).fill_(real_label)  # fake labels are real for generator cost
+                        # The gradients of D computed here are discarded, they are not averaged across processes
+                        with distributed.no_sync(netD):
+                            output = forward(netD, *fake_inputs)
+                        errG_D_micro = criterion(output, label)
+                        errG_micro = (1 - wtl2) * errG_D_micro + wtl2 * errG_l2_micro
+                        errG_D += weight * errG_D_micro.item()
+                    else:
+                        # Generator pretraining with the L2 loss only, D is not run
+                        errG_micro = errG_l2_micro
+                    
+                    if opt.register_hooks:
+                        fake.register_hook(print)
+                        recon_center_plus_margin.register_hook(print)
+                    # recon_center_plus_margin_det.register_hook(print)
+                    # paddingLayerMargin.register_hook(print)
+                    # errG.backward(retain_variables=True)
+                    # print(paddingLayerMargin.grad)
+                    (weight * errG_micro).backward()
+                    # for param in paddingLayerMargin.parameters():
+                    #     print(param.grad.data.sum())
+                    # if i % opt.update_train_img == 0:
+                    #     print("Gradients")
+                    #     for param in netG.parameters():
+                    #         print(param.grad.data.sum())
+                    errG += weight * errG_micro.item()
                 
-                D_G_z2 = output.data.mean()
                 optimizerG.step()
             
-            # print('[%d/%d][%d/%d] Loss_D: %.4f | Loss_G (Adv/L2->Tot): %.4f / %.4f -> %.4f | p_D(x): %.4f | p_D(G(z)): %.4f'
-            #       % (epoch + 1, opt.niter, i + 1, len(dataloader),
-            #          0, 0 * (1 - wtl2), 0 * wtl2, 0, 0, 0))
-    
             print('[%d/%d][%d/%d] Loss_D: %.4f | Loss_G (Adv/L2->Tot): %.4f / %.4f -> %.4f | p_D(x): %.4f | p_D(G(z)): %.4f'
                   % (epoch + 1, opt.niter, i + 1, len(dataloader),
-                     errD.data[0], errG_D.data[0] * (1 - wtl2), errG_l2.data[0] * wtl2, errG.data[0], D_x, D_G_z1))
-    
-            this_DGz += D_G_z1
-            this_Dx += D_x
-            this_Adv += errG_D.data[0]
-            this_L2 += errG_l2.data[0]
-            this_G_tot += errG.data[0]
-            this_D_tot += errD.data[0]
+                     errD, errG_D * (1 - wtl2), errG_l2 * wtl2, errG, D_x, D_G_z1))
+            
+            # Measures are averaged over the steps that computed them
+            if plan.update_D:
+                this_DGz += D_G_z1
+                this_Dx += D_x
+                this_D_tot += errD
+                this_D_steps += 1
+            if plan.update_G:
+                this_Adv += errG_D
+                this_G_tot += errG
+                this_G_steps += 1
+            this_L2 += errG_l2
             
             if step_counter == opt.update_measures_plots:
                 this_Adv *= (1 - wtl2)
                 this_L2 *= wtl2
-                this_DGz /= opt.update_measures_plots
-                this_Dx /= opt.update_measures_plots
-                this_Adv /= opt.update_measures_plots
+                this_DGz /= this_D_steps or float('nan')
+                this_Dx /= this_D_steps or float('nan')
+                this_Adv /= this_G_steps or float('nan')
                 this_L2 /= opt.update_measures_plots
-                this_G_tot /= opt.update_measures_plots
-                this_D_tot /= opt.update_measures_plots
+                this_G_tot /= this_G_steps or float('nan')
+                this_D_tot /= this_D_steps or float('nan')
                 
                 D_G_zs.append(this_DGz)
                 D_xs.append(this_Dx)
@@ -537,7 +757,8 @@ for epoch in range(resume_epoch, opt.niter):
                 G_tots.append(this_G_tot)
                 D_tots.append(this_D_tot)
                 
-                plotter(D_G_zs, D_xs, Advs, L2s, G_tots, D_tots, (len(dataloader) / opt.update_measures_plots), PATHS["plots"])
+                if rank == 0:
+                    plotter(D_G_zs, D_xs, Advs, L2s, G_tots, D_tots, (len(dataloader) / opt.update_measures_plots), PATHS["plots"])
                 
                 this_DGz = 0
                 this_Dx = 0
@@ -545,15 +766,17 @@ for epoch in range(resume_epoch, opt.niter):
                 this_L2 = 0
                 this_G_tot = 0
                 this_D_tot = 0
+                this_D_steps = 0
+                this_G_steps = 0
                 step_counter = 0
             
-            if i % opt.update_train_img == 0:
+            if i % opt.update_train_img == 0 and rank == 0:
                 if not opt.jointD:
                     recon_image = input_cropped.clone()
                     recon_image.data[:, :,
                     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
                     int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
-                save_image(real_cpu, epoch+1, PATHS["train"], str(i//opt.update_train_img) + "_real")
+                save_image(input_real.data, epoch+1, PATHS["train"], str(i//opt.update_train_img) + "_real")
                 save_image(recon_image.data, epoch + 1, PATHS["train"], str(i//opt.update_train_img) + "_recon")
                 if opt.jointD or opt.marginD:
                     save_image(recon_center_plus_margin.data, epoch + 1, PATHS["train"], str(i//opt.update_train_img) + "_center_recon")
@@ -561,17 +784,31 @@ for epoch in range(resume_epoch, opt.niter):
                         save_image(real_center_plus_margin.data, epoch + 1, PATHS["train"], str(i//opt.update_train_img) + "_center_real")
                     else:
                         save_image(real_center.data, epoch + 1, PATHS["train"], str(i//opt.update_train_img) + "_center_real")
+            
+            # Checkpoint within the epoch, a killed run loses at most --checkpointMinutes of training
+            if rank == 0 and 0 < opt.checkpointMinutes * 60 < time.time() - last_checkpoint:
+                save_checkpoint(epoch, i + 1)
+                last_checkpoint = time.time()
                         
         
         else:
             break
     
-    
+    print('Training throughput: %.1f images/s (%s), %.3fs per step, peak memory %s'
+          % (epoch_images / (time.time() - epoch_time), 'bfloat16' if opt.bf16 else 'float32',
+             (time.time() - epoch_time) / max(1, schedule.steps), format_memory(peak_memory(opt.cuda, epoch_memory))))
+    print(schedule.report())
     
     #####################################
     # Testing at the end of every epoch #
     #####################################
     
+    # Testing and checkpoints in the first process only, the others wait for it
+    if rank != 0:
+        distributed.barrier()
+        continue
+    testG = distributed.unwrap(netG)
+    
     if epoch == 0:
         # Clear existing file if any
         with open(PATHS["test"] + "/PSNRs.txt", "w") as myfile:
@@ -583,61 +820,33 @@ for epoch in range(resume_epoch, opt.niter):
     tot_psnr_patch = []
     tot_psnr_image = []
     
-    for i, data in enumerate(test_dataloader, 0):
-        real_cpu, _ = data
-        real_center_cpu = real_cpu[:, :, int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2),
-                          int(opt.imageSize / 4):int(opt.imageSize / 4) + int(opt.imageSize / 2)]
-        batch_size = real_cpu.size(0)
-        input_real.data.resize_(real_cpu.size()).copy_(real_cpu)
-        input_cropped.data.resize_(real_cpu.size()).copy_(real_cpu)
-        real_center.data.resize_(real_center_cpu.size()).copy_(real_center_cpu)
-        input_cropped.data[:, 0,
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-        int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-            opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
-        if opt.nc > 1:
-            input_cropped.data[:, 1,
-            int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-            int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 104.0 / 255.0 - 1.0
-            input_cropped.data[:, 2,
-            int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred),
-            int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
-                opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 123.0 / 255.0 - 1.0
-
-        fake = netG(input_cropped)
+    for i, batch in enumerate(test_batches, 0):
+        batch_size = batch.size(0)
+        batch.load(input_real, input_cropped, real_center, real_center_plus_margin)
+
+        with torch.no_grad():
+            fake = testG(input_cropped)
         recon_image = input_cropped.clone()
         recon_image.data[:, :,
         int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2),
         int(opt.imageSize / 2 - opt.patchSize / 2):int(opt.imageSize / 2 + opt.patchSize / 2)] = fake.data
         
-        real_center_np = (real_center.data.cpu().numpy() + 1) * 127.5
-        fake_np = (fake.data.cpu().numpy() + 1) * 127.5
-        real_cpu_np = (real_cpu.cpu().numpy() + 1) * 127.5
-        recon_image_np = (recon_image.data.cpu().numpy() + 1) * 127.5
+        # Compute PSNR for the whole batch at once
+        p = batch_psnr((real_center.data + 1) * 127.5, (fake.data + 1) * 127.5).mean().item()
+        total_p = batch_psnr((input_real.data + 1) * 127.5, (recon_image.data + 1) * 127.5).mean().item()
         
-        # Compute PSNR
-        p = 0
-        total_p = 0
-        for j in range(opt.batchSize):
-            p += psnr(real_center_np[j].transpose(1, 2, 0), fake_np[j].transpose(1, 2, 0))
-            total_p += psnr(real_cpu_np[j].transpose(1, 2, 0), recon_image_np[j].transpose(1, 2, 0))
-        
-        tot_psnr_image.append(total_p/opt.batchSize)
-        tot_psnr_patch.append(p/opt.batchSize)
+        tot_psnr_image.append(total_p)
+        tot_psnr_patch.append(p)
         
         print('[%d/%d] PSNR per Patch: %.4f | PSNR per Image: %.4f'
-              % (i + 1, len(test_dataloader), p / opt.batchSize, total_p / opt.batchSize))
+              % (i + 1, len(test_dataloader), p, total_p))
 
         # with open(PATHS["test"] + "/PSNRs.txt", "a") as myfile:
         #     myfile.write('\n\t[%d/%d] PSNR per Patch: %.4f | PSNR per Image: %.4f'
-        #       % (i + 1, len(test_dataloader), p / opt.batchSize, total_p / opt.batchSize))
+        #       % (i + 1, len(test_dataloader), p, total_p))
         
         if i <= 1:
-            save_image(real_cpu, epoch+1, PATHS["test"], "_"+str(i)+"real")
+            save_image(input_real.data, epoch+1, PATHS["test"], "_"+str(i)+"real")
             save_image(recon_image.data, epoch + 1, PATHS["test"], "_"+str(i)+"recon")
 
     print('EPOCH [%d] AVERAGES: PSNR per Patch: %.4f | PSNR per Image: %.4f'
@@ -654,7 +863,7 @@ for epoch in range(resume_epoch, opt.niter):
         for data in test_original_dataloader:
             
             image_1024_cpu, _ = data
-            image_1024.data.resize_(image_1024_cpu.size()).copy_(image_1024_cpu)
+            copy_batch(image_1024_cpu, image_1024.data)
             image_1024_recon = image_1024.clone()
             
             for l in range(3):
@@ -669,7 +878,8 @@ for epoch in range(resume_epoch, opt.niter):
                 int(opt.imageSize / 2 - opt.patchSize / 2 + opt.overlapPred):int(
                     opt.imageSize / 2 + opt.patchSize / 2 - opt.overlapPred)] = 2 * 117.0 / 255.0 - 1.0
                 
-                fake = netG(input_rc_cropped)
+                with torch.no_grad():
+                    fake = testG(input_rc_cropped)
                 
                 recon_image = input_rc_cropped.clone()
                 recon_image.data[:, :,
@@ -686,11 +896,11 @@ for epoch in range(resume_epoch, opt.niter):
             save_image(image_1024.data[0:4], epoch+1, PATHS["randomCrops"], "real")
             save_image(image_1024_recon.data[0:4], epoch + 1, PATHS["randomCrops"], "recon")
 
-    # Store model checkpoint
-    torch.save({'epoch': epoch + 1, 'state_dict': netG.state_dict()}, PATHS["netG"])
-    torch.save({'epoch': epoch + 1, 'state_dict': netD.state_dict()}, PATHS["netD"])
+    # Store model checkpoints, measure lists and training state, resuming at the next epoch
+    save_checkpoint(epoch + 1, 0)
+    last_checkpoint = time.time()
 
-    # Store measure lists
-    pickle.dump((D_G_zs, D_xs, Advs, L2s, G_tots, D_tots), open(PATHS["measures"], "wb"))
-    
     print("\tEpoch", epoch + 1, "took ", (time.time() - epoch_time) / 60, "minutes")
+    distributed.barrier()
+
+checkpoints.close()
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import math
 import os
 import numpy as np
+import torch
 
 # Compute PSNR over images
 def psnr(img1, img2):
@@ -104,4 +105,41 @@ def generate_directories(PATHS, EXP_NAME, is_randomCrop_exp):
         except OSError:
             pass
     
-    return
\ No newline at end of file
+    return
+
+
+# Current and peak resident memory of the process in kB, None where /proc is not available
+def _resident_memory():
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0])
+    except (IOError, OSError, KeyError):
+        return None
+
+
+# Start measuring the peak memory: allocated memory of the current GPU with cuda, resident memory of
+# the process otherwise, whose peak is reset through /proc/self/clear_refs (Linux)
+def reset_peak_memory(cuda):
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return None
+    memory = _resident_memory()
+    return memory[0] * 1024 if memory else None
+
+
+# Peak memory in MB since reset_peak_memory, above the memory in use then. None if not measurable.
+def peak_memory(cuda, start):
+    if start is None:
+        return None
+    if cuda:
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - start) / 2. ** 20
+    memory = _resident_memory()
+    return (memory[1] * 1024 - start) / 2. ** 20 if memory else None